@@ -0,0 +1,88 @@
+"""
+Animated quote cards: the cost of one card with the background frames prepared once against decoding,
+scaling and quantizing `assets/background.gif` for every card, and where the time of a card goes.
+
+The naive path mirrors what a renderer without the frame cache does: decode every frame, scale it,
+composite the card in RGB and let the GIF encoder quantize each frame on its own.
+
+    python benchmarks/bench_animated.py
+"""
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from PIL import Image, ImageDraw, ImageSequence
+from util.animation import GIF_MAX_FRAMES
+from util.images import create_quote_image, animated_background, ASSETS_DIR
+
+QUOTE = '''"Ich würd sagen up your ass" - Nina, okay, crazy statement
+"dann würd ich sagen gerne" - Jonathan nein danke'''
+RUNS = 5
+
+def timed(function, runs=RUNS):
+    result = function()
+    start = time.perf_counter()
+    for _ in range(runs):
+        function()
+    return (time.perf_counter() - start) / runs * 1000, result
+
+def card():
+    # the still card as drawn for a png, and the mask of its rounded rectangle
+    image = Image.open(create_quote_image(QUOTE, "John Doe", image_format='png')).convert('RGB')
+    mask = Image.new('L', image.size)
+    ImageDraw.Draw(mask).rounded_rectangle([50, 50, image.width - 50, image.height - 50], radius=20, fill=255)
+    return image, mask
+
+def naive(image, mask):
+    with Image.open(os.path.join(ASSETS_DIR, 'background.gif')) as gif:
+        sequence = [(frame.convert('RGB'), frame.info.get('duration', 100)) for frame in ImageSequence.Iterator(gif)]
+    step = max(1, -(-len(sequence) // GIF_MAX_FRAMES))
+    frames = []
+    for background, _ in sequence[::step]:
+        scale = max(image.width / background.width, image.height / background.height)
+        size = (round(background.width * scale), round(background.height * scale))
+        left, top = (size[0] - image.width) // 2, (size[1] - image.height) // 2
+        frame = background.resize(size, Image.BICUBIC).crop((left, top, left + image.width, top + image.height))
+        frame.paste(image, (0, 0), mask)
+        frames.append(frame)
+    buffer = io.BytesIO()
+    frames[0].save(buffer, format='GIF', save_all=True, append_images=frames[1:],
+                   duration=[duration * step for _, duration in sequence[::step]], loop=0)
+    return buffer.getbuffer().nbytes
+
+if __name__ == '__main__':
+    start = time.perf_counter()
+    animated_background.load()
+    print(f'frames decoded and prepared once: {(time.perf_counter() - start) * 1000:.0f} ms, '
+          f'{len(animated_background.frames)} frames of {animated_background.width}x{animated_background.height}')
+    image, mask = card()
+    top = (animated_background.height - image.height) // 2
+    box = (0, top, image.width, top + image.height)
+
+    def overlay():
+        return image.quantize(palette=animated_background.palette, dither=Image.Dither.NONE)
+
+    def composite():
+        quantized = overlay()
+        frames = []
+        for index, background in enumerate(animated_background.frames):
+            frame = background.crop(box)
+            frame.paste(quantized if index == 0 else 255, (0, 0, image.width, image.height), mask)
+            frames.append(frame)
+        return frames
+
+    frames = composite()
+    rows = [
+        ('naive: decode + scale + quantize per card', timed(lambda: naive(image, mask), 2)),
+        ('cached: whole animated card', timed(lambda: create_quote_image(QUOTE, "John Doe", image_format='gif').getbuffer().nbytes)),
+        ('  the card (layout, text, png)', timed(lambda: create_quote_image(QUOTE, "John Doe", image_format='png').getbuffer().nbytes)),
+        ('  overlay quantized to the palette', timed(lambda: None if overlay() else None)),
+        ('  overlay pasted on the cached frames', timed(lambda: None if composite() else None)),
+        ('  gif encoding', timed(lambda: animated_background._encode(frames, animated_background.durations).getbuffer().nbytes)),
+    ]
+    print(f'{"path":<44} {"ms":>8} {"bytes":>9}')
+    for name, (ms, size) in rows:
+        print(f'{name:<44} {ms:>8.1f} {size if size else "":>9}')
@@ -0,0 +1,73 @@
+"""
+Per-message quote extraction cost as the number of guilds with a custom regex grows.
+
+The legacy path mirrors the old `extractQuote`, which appended every custom regex to the
+module-global pattern list on each call. The extractor path uses the per-guild `QuoteExtractor`.
+
+    python benchmarks/bench_extract.py
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from util.regexes import regexes, get_extractor
+
+MESSAGES = [
+    '"Da haste mich geghosted" - Nina',
+    'Toa: Ich persönlich halte das für eine Lüge',
+    '"Up your ass" Jonathan',
+    'just a normal chat message without any quote in it',
+    'lunch at 12?',
+]
+GUILD_COUNTS = [1, 10, 100, 1000]
+MESSAGES_PER_RUN = 2000
+
+def legacy_extract(patterns, message, customRegex=None, customReverse=False):
+    if customRegex:
+        if customReverse:
+            patterns.append((customRegex, lambda match: (match.group(2), match.group(1))))
+        else:
+            patterns.append((customRegex, lambda match: (match.group(1), match.group(2))))
+    for regex, handler in patterns:
+        matches = list(re.finditer(regex, message))
+        if matches:
+            last_match = matches[-1]
+            return handler(last_match)
+    return None
+
+def custom_regex(guild):
+    # a distinct pattern per guild that never matches the sample messages
+    return rf'<<{guild}>>(.+)\|(.+)'
+
+def bench_legacy(guilds):
+    patterns = list(regexes)
+    rng = random.Random(guilds)
+    # every guild has seen one message already, so each custom regex is in the list once
+    for guild in range(guilds):
+        legacy_extract(patterns, MESSAGES[0], custom_regex(guild))
+    start = time.perf_counter()
+    for _ in range(MESSAGES_PER_RUN):
+        guild = rng.randrange(guilds)
+        legacy_extract(patterns, rng.choice(MESSAGES), custom_regex(guild))
+    return (time.perf_counter() - start) / MESSAGES_PER_RUN, len(patterns)
+
+def bench_extractor(guilds):
+    rng = random.Random(guilds)
+    for guild in range(guilds):
+        get_extractor(guild, custom_regex(guild))
+    start = time.perf_counter()
+    for _ in range(MESSAGES_PER_RUN):
+        guild = rng.randrange(guilds)
+        get_extractor(guild, custom_regex(guild)).extract(rng.choice(MESSAGES))
+    return (time.perf_counter() - start) / MESSAGES_PER_RUN, len(get_extractor(0, custom_regex(0)).patterns)
+
+if __name__ == '__main__':
+    print(f'{"guilds":>8} {"legacy us/msg":>14} {"patterns":>9} {"extractor us/msg":>17} {"patterns":>9}')
+    for guilds in GUILD_COUNTS:
+        legacy, legacy_patterns = bench_legacy(guilds)
+        extractor, extractor_patterns = bench_extractor(guilds)
+        print(f'{guilds:>8} {legacy * 1e6:>14.1f} {legacy_patterns:>9} {extractor * 1e6:>17.1f} {extractor_patterns:>9}')
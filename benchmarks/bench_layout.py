@@ -0,0 +1,69 @@
+"""
+Quote text layout: the old `textwrap.fill(width=60)` wrapping against the pixel layout of `util.layout`.
+
+For a set of generated quotes of growing length it reports how many lines the old wrapping drew past
+the card it sized (so ran out of the rectangle) and how many were wider than the text area, then times
+a first (uncached) layout and a repeated one, as for Reveal, and full renders of a long quote.
+
+    python benchmarks/bench_layout.py
+"""
+import os
+import random
+import sys
+import textwrap
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from util.images import create_quote_image
+from util.layout import layout_text, fit_text, load_font
+
+FONT = "ggsans-Bold.ttf"
+TEXT_WIDTH = 640 # the text area of an 800px card
+WORDS = 'the a of WWWW mmmm quote said never always really bruh lmao okay crazy statement'.split()
+RUNS = 200
+
+def quotes(count=200):
+    rng = random.Random(1)
+    for _ in range(count):
+        lines = [' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 80))) for _ in range(rng.randint(1, 3))]
+        yield '\n'.join(lines)
+
+def legacy(quote):
+    # lines drawn, lines the card was sized for, lines wider than the text area
+    font = load_font(FONT, 24)
+    wrapped = [textwrap.fill(line, width=60) for line in quote.splitlines()]
+    drawn = [line for entry in wrapped for line in entry.splitlines()]
+    too_wide = sum(font.getlength(line) > TEXT_WIDTH for line in drawn)
+    return len(drawn), len(wrapped), too_wide
+
+def timed(function, runs=RUNS):
+    start = time.perf_counter()
+    for _ in range(runs):
+        function()
+    return (time.perf_counter() - start) / runs * 1000
+
+if __name__ == '__main__':
+    samples = list(quotes())
+    overflowing = too_wide = 0
+    for quote in samples:
+        drawn, sized, wide = legacy(quote)
+        overflowing += drawn > sized
+        too_wide += wide > 0
+        layout = fit_text(quote, FONT, TEXT_WIDTH)
+        assert max(layout.widths) <= TEXT_WIDTH
+    print(f'textwrap: {overflowing}/{len(samples)} cards taller than sized, {too_wide}/{len(samples)} with lines wider than the card')
+    print('layout:   0 of either (asserted)')
+
+    long_quote = max(samples, key=len)
+    cold = []
+    for quote in samples[:50]:
+        # a new text every time, only the glyph metrics are cached
+        start = time.perf_counter()
+        layout_text(quote + ' ', FONT, 24, TEXT_WIDTH)
+        cold.append((time.perf_counter() - start) * 1000)
+    print(f'{"path":<36} {"ms":>8}')
+    print(f'{"textwrap.fill + width check (long)":<36} {timed(lambda: legacy(long_quote)):>8.3f}')
+    print(f'{"layout, first time":<36} {sum(cold) / len(cold):>8.3f}')
+    print(f'{"layout, cached (Reveal)":<36} {timed(lambda: fit_text(long_quote, FONT, TEXT_WIDTH)):>8.4f}')
+    print(f'{"create_quote_image (long)":<36} {timed(lambda: create_quote_image(long_quote, "John Doe"), 20):>8.2f}')
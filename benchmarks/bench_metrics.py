@@ -0,0 +1,46 @@
+"""
+Cost of recording metrics on the hot paths, compared to doing nothing, and of one scrape.
+
+Recording has to stay cheap enough to leave on when nobody scrapes, rendering only happens on scrape.
+
+    python benchmarks/bench_metrics.py
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from util import metrics
+
+ITERATIONS = 200000
+SQL = 'SELECT "t1"."messageid" FROM "quotes" AS "t1" WHERE ("t1"."guildid" = ?)'
+MODELS = (('quotes', 'Quote'), ('guilds', 'Guild'))
+
+def bench(name, func):
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        func()
+    elapsed = time.perf_counter() - start
+    print(f'{name:<28} {elapsed / ITERATIONS * 1e9:8.0f} ns/op')
+
+def main():
+    bench('baseline (no-op)', lambda: None)
+    bench('counter.inc', lambda: metrics.api_calls.inc('PUT /channels/{channel_id}', '2xx'))
+    bench('histogram.observe', lambda: metrics.command_latency.observe(0.042, 'guess'))
+    def timed():
+        with metrics.event_latency.time('on_message'):
+            pass
+    bench('histogram.time', timed)
+    bench('sql_labels (cached)', lambda: metrics.sql_labels(SQL, MODELS))
+
+    # a realistic number of series: routes, commands and events
+    for index in range(50):
+        metrics.api_latency.observe(0.1, f'GET /route/{index}')
+        metrics.db_latency.observe(0.001, f'Model{index % 5}', 'select')
+    start = time.perf_counter()
+    body = metrics.render()
+    print(f'{"render (one scrape)":<28} {(time.perf_counter() - start) * 1000:8.2f} ms, {len(body)} bytes')
+
+if __name__ == '__main__':
+    main()
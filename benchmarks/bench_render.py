@@ -0,0 +1,58 @@
+"""
+Quote card rendering: renders/sec and bytes per image for the old temp-file path and the in-memory renderer.
+
+The legacy path mirrors the old `create_quote_image`: both fonts loaded with `ImageFont.truetype`
+on every call, the PNG saved to `temp/`, read back for upload and removed.
+
+    python benchmarks/bench_render.py
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from PIL import ImageFont
+from util import images
+from util.images import create_quote_image, ASSETS_DIR
+
+QUOTE = '''"Ich würd sagen up your ass" - Nina, okay, crazy statement
+"dann würd ich sagen gerne" - Jonathan nein danke'''
+RENDERS = 50
+
+def legacy_render(temp_dir):
+    ImageFont.truetype(os.path.join(ASSETS_DIR, "ggsans-Bold.ttf"), 24)
+    ImageFont.truetype(os.path.join(ASSETS_DIR, "ggsans-Normal.ttf"), 24)
+    image = create_quote_image(QUOTE, "John Doe", image_format='png')
+    path = os.path.join(temp_dir, f'quote_{time.monotonic_ns()}.png')
+    with open(path, 'wb') as f:
+        f.write(image.getbuffer())
+    with open(path, 'rb') as f:
+        data = f.read()
+    os.remove(path)
+    return len(data)
+
+def measure(render):
+    size = render()
+    start = time.perf_counter()
+    for _ in range(RENDERS):
+        render()
+    return RENDERS / (time.perf_counter() - start), size
+
+def in_memory(image_format, compress_level=None):
+    def render():
+        if compress_level is not None:
+            images.PNG_COMPRESS_LEVEL = compress_level
+        return create_quote_image(QUOTE, "John Doe", image_format=image_format).getbuffer().nbytes
+    return render
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as temp_dir:
+        rows = [('legacy (truetype per call + temp file)', measure(lambda: legacy_render(temp_dir)))]
+    for level in (1, 6, 9):
+        rows.append((f'in-memory png compress_level={level}', measure(in_memory('png', level))))
+    rows.append((f'in-memory webp quality={images.WEBP_QUALITY}', measure(in_memory('webp'))))
+    print(f'{"path":<42} {"renders/s":>10} {"bytes":>8}')
+    for name, (rate, size) in rows:
+        print(f'{name:<42} {rate:>10.1f} {size:>8}')
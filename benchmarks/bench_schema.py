@@ -0,0 +1,79 @@
+"""
+Query plans and latencies of the /quote, /guess and /guildinfo queries before and after the schema migrations.
+
+Seeds a local SQLite database with the original schema (32 bit ids, only the implicit foreign key index),
+times the queries, applies `util.migrations`, and times them again.
+
+    python benchmarks/bench_schema.py [quotes] [guilds]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+path = os.path.join(tempfile.mkdtemp(), 'bench_schema.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{path}'
+
+from util.db import db
+from util.migrations import run_migrations
+
+QUOTES = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+GUILDS = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+RUNS = 20
+
+ORIGINAL_SCHEMA = [
+    'CREATE TABLE guilds (guildid INTEGER NOT NULL PRIMARY KEY, quoteChannel INTEGER, quoteRegex TEXT, quotesProcessedUntil DATETIME NOT NULL)',
+    'CREATE TABLE quotes (messageid INTEGER NOT NULL PRIMARY KEY, guildid_id INTEGER NOT NULL, author INTEGER NOT NULL, content TEXT NOT NULL, FOREIGN KEY (guildid_id) REFERENCES guilds (guildid))',
+    'CREATE INDEX quotes_guildid_id ON quotes (guildid_id)',
+]
+
+def seed():
+    rng = random.Random(0)
+    guilds = [rng.getrandbits(60) for _ in range(GUILDS)]
+    authors = [f'Author {i}' for i in range(200)]
+    with db.atomic():
+        for statement in ORIGINAL_SCHEMA:
+            db.execute_sql(statement)
+        db.execute_sql('INSERT INTO guilds VALUES ' + ','.join(f'({guild}, 1, NULL, 0)' for guild in guilds))
+        rows = [(rng.getrandbits(62), rng.choice(guilds), rng.choice(authors), f'"quote number {i}"') for i in range(QUOTES)]
+        for start in range(0, len(rows), 5000):
+            db.execute_sql('INSERT INTO quotes VALUES ' + ','.join(['(?, ?, ?, ?)'] * len(rows[start:start + 5000])), [v for row in rows[start:start + 5000] for v in row])
+    # the guild with the most quotes
+    return db.execute_sql('SELECT guildid_id FROM quotes GROUP BY guildid_id ORDER BY COUNT(*) DESC LIMIT 1').fetchone()[0]
+
+def queries(guild):
+    messageid = db.execute_sql('SELECT messageid FROM quotes WHERE guildid_id = ? LIMIT 1', [guild]).fetchone()[0]
+    return {
+        '/quote,/guess old: count': ('SELECT COUNT(*) FROM quotes WHERE guildid_id = ?', [guild]),
+        '/quote,/guess old: ORDER BY RANDOM()': ('SELECT * FROM quotes WHERE guildid_id = ? ORDER BY RANDOM() LIMIT 1', [guild]),
+        '/quote,/guess new: load ids (once)': ('SELECT messageid FROM quotes WHERE guildid_id = ?', [guild]),
+        '/quote,/guess new: pick by id': ('SELECT * FROM quotes WHERE messageid = ?', [messageid]),
+        '/guildinfo: count': ('SELECT COUNT(*) FROM quotes WHERE guildid_id = ?', [guild]),
+        'by author': ('SELECT messageid FROM quotes WHERE guildid_id = ? AND author = ?', [guild, 'Author 7']),
+    }
+
+def report(title, guild):
+    print(f'\n== {title}')
+    for name, (sql, params) in queries(guild).items():
+        plan = ' / '.join(row[-1] for row in db.execute_sql('EXPLAIN QUERY PLAN ' + sql, params).fetchall())
+        start = time.perf_counter()
+        for _ in range(RUNS):
+            db.execute_sql(sql, params).fetchall()
+        elapsed = (time.perf_counter() - start) / RUNS
+        print(f'{name:<40} {elapsed * 1000:>9.3f} ms  {plan}')
+
+if __name__ == '__main__':
+    with db.connection_context():
+        guild = seed()
+        count = db.execute_sql('SELECT COUNT(*) FROM quotes WHERE guildid_id = ?', [guild]).fetchone()[0]
+        print(f'{QUOTES} quotes in {GUILDS} guilds, largest guild has {count}')
+        report('original schema', guild)
+    run_migrations()
+    with db.connection_context():
+        # the migrated indexes must match the table
+        assert db.execute_sql('PRAGMA integrity_check').fetchone()[0] == 'ok'
+        db.execute_sql('ANALYZE')
+        report('after migrations', guild)
@@ -0,0 +1,110 @@
+"""
+/search with the in-process index against a `LIKE '%...%'` scan, first page and a deep page.
+
+Seeds a local SQLite database with one guild of generated quotes (zipf distributed words, so there are
+common and rare ones), builds the guild's index and times both ways of finding a page of results.
+
+    python benchmarks/bench_search.py [quotes]
+"""
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+path = os.path.join(tempfile.mkdtemp(), 'bench_search.db')
+os.environ['DATABASE_URL'] = f'sqlite:///{path}'
+
+from util.db import db, Guild, Quote
+from util.migrations import run_migrations
+from util.search import quote_index, tokenize, SEARCH_PAGE_SIZE
+
+QUOTES = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+GUILD = 1234567890123456789
+RUNS = 20
+DEEP_PAGE = 50 # page number of the deep page
+
+def seed():
+    rng = random.Random(0)
+    words = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(3, 9))) for _ in range(5000)]
+    weights = [1 / (rank + 1) for rank in range(len(words))]
+    authors = [f'Author {i}' for i in range(200)]
+    messageid = 10**17
+    rows = []
+    for _ in range(QUOTES):
+        messageid += rng.randint(1, 10**9)
+        content = ' '.join(rng.choices(words, weights, k=rng.randint(4, 20))).capitalize() + '.'
+        rows.append({'messageid': messageid, 'guildid': GUILD, 'content': content, 'author': rng.choice(authors)})
+    with db.connection_context():
+        Guild.create(guildid=GUILD)
+        with db.atomic():
+            for start in range(0, len(rows), 2000):
+                Quote.insert_many(rows[start:start + 2000]).execute()
+    return words
+
+def like(text, offset=0, before=None):
+    sql = 'SELECT * FROM quotes WHERE guildid_id = ?' + ' AND content LIKE ?' * len(tokenize(text))
+    params = [GUILD] + [f'%{word}%' for word in tokenize(text)]
+    if before is not None:
+        sql += ' AND messageid < ?'
+        params.append(before)
+    sql += f' ORDER BY messageid DESC LIMIT {SEARCH_PAGE_SIZE} OFFSET {offset}'
+    return db.execute_sql(sql, params).fetchall()
+
+def like_count(text):
+    sql = 'SELECT COUNT(*) FROM quotes WHERE guildid_id = ?' + ' AND content LIKE ?' * len(tokenize(text))
+    return db.execute_sql(sql, [GUILD] + [f'%{word}%' for word in tokenize(text)]).fetchone()[0]
+
+def timed(func):
+    start = time.perf_counter()
+    for _ in range(RUNS):
+        func()
+    return (time.perf_counter() - start) / RUNS * 1000
+
+async def timed_async(func):
+    start = time.perf_counter()
+    for _ in range(RUNS):
+        await func()
+    return (time.perf_counter() - start) / RUNS * 1000
+
+async def main():
+    start = time.perf_counter()
+    words = seed()
+    print(f'Seeded {QUOTES} quotes in {time.perf_counter() - start:.1f}s')
+
+    start = time.perf_counter()
+    await quote_index._get(GUILD)
+    stats = quote_index.stats()
+    print(f'Built the index in {time.perf_counter() - start:.2f}s: {stats["quotes"]} quotes, {stats["words"]} words')
+
+    searches = {
+        'common word': words[0],
+        'two words': f'{words[3]} {words[10]}',
+        'rare word': words[-1],
+        'prefix': words[1][:2],
+    }
+    print(f'\n{"search":<14} {"matches (index/like)":>22} {"like p1":>10} {"index p1":>10} {"like deep":>10} {"like keyset":>12} {"index deep":>11}  ms')
+    with db.connection_context():
+        for name, text in searches.items():
+            page = await quote_index.search(GUILD, text)
+            # the cursor of the deep page, found by paging through with the index
+            cursor = None
+            for _ in range(DEEP_PAGE - 1):
+                step = await quote_index.search(GUILD, text, before=cursor)
+                if not step.older:
+                    break
+                cursor = step.quotes[-1].messageid
+            like_first = timed(lambda: like(text))
+            index_first = await timed_async(lambda: quote_index.search(GUILD, text))
+            like_deep = timed(lambda: like(text, offset=(DEEP_PAGE - 1) * SEARCH_PAGE_SIZE))
+            like_keyset = timed(lambda: like(text, before=cursor))
+            index_deep = await timed_async(lambda: quote_index.search(GUILD, text, before=cursor))
+            print(f'{name:<14} {f"{page.total}/{like_count(text)}":>22} {like_first:>10.2f} {index_first:>10.2f} {like_deep:>10.2f} {like_keyset:>12.2f} {index_deep:>11.2f}')
+    print('\nLIKE matches substrings anywhere in a word, the index whole words (the last one as a prefix), so the counts differ.')
+
+if __name__ == '__main__':
+    run_migrations()
+    asyncio.run(main())
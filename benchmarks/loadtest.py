@@ -0,0 +1,291 @@
+"""
+Offline load test of the bot's handlers. Imports `main` without connecting anywhere: the REST client and the
+interaction webhooks are replaced by a stand-in that answers after `--api-latency` seconds and counts the calls,
+the database is a fresh SQLite file (or `--database` for e.g. a local MySQL), and gateway events are built from
+payloads and handed to the handlers directly.
+
+Scenarios:
+    quotes      quote messages in the quote channel, arriving at --rate per second
+    chatter     messages in the quote channel that aren't quotes (they get an x that is removed again)
+    offtopic    messages in other channels, which are filtered out
+    guess-cN    /guess with N players at once, for every N in --concurrency
+
+Every scenario reports throughput, p50/p99 latency (from the arrival of an event to the end of its handler),
+REST calls and database queries. The results are written to benchmarks/results/<commit>.json,
+`--compare <commit>` prints the change against an earlier run.
+
+    python benchmarks/loadtest.py
+    python benchmarks/loadtest.py --messages 2000 --rate 200 --scenario quotes chatter
+    python benchmarks/loadtest.py --compare 2990263
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from datetime import datetime, timezone
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+sys.path.insert(0, os.path.join(ROOT, 'src'))
+
+parser = argparse.ArgumentParser(description="Replay synthetic traffic through the bot's handlers.")
+parser.add_argument('--scenario', nargs='*', help='scenarios to run, default all')
+parser.add_argument('--messages', type=int, default=1000, help='events per message scenario')
+parser.add_argument('--rate', type=float, default=100, help='messages per second')
+parser.add_argument('--games', type=int, default=200, help='/guess invocations per concurrency level')
+parser.add_argument('--concurrency', default='1,8,32', help='players at once for the /guess scenarios')
+parser.add_argument('--quotes', type=int, default=1000, help='quotes stored before the run')
+parser.add_argument('--api-latency', type=float, default=0.05, help='seconds the fake REST API takes per call')
+parser.add_argument('--reaction-interval', type=float, default=0.0, help='REACTION_INTERVAL, 0 so the reaction backlog drains at once')
+parser.add_argument('--database', help='DATABASE_URL, default a temporary SQLite file')
+parser.add_argument('--compare', help='commit (or results file) to compare against')
+parser.add_argument('--no-save', action='store_true', help="don't write the results file")
+args = parser.parse_args()
+
+# configured before the bot's modules read their settings
+os.environ['DATABASE_URL'] = args.database or f'sqlite:///{os.path.join(tempfile.mkdtemp(), "loadtest.db")}'
+os.environ['LOG_FILE'] = os.path.join(tempfile.mkdtemp(), 'loadtest.log')
+os.environ['REACTION_INTERVAL'] = str(args.reaction_interval)
+os.environ['METRICS_PORT'] = '0'
+os.environ['GUILD_IDS'] = ''
+os.environ.setdefault('RENDER_EXECUTOR', 'thread')
+os.environ.setdefault('LOG_LEVEL', 'ERROR') # e.g. "Render queue full" is expected under load
+
+import discord
+from discord.http import HTTPClient
+from discord.webhook.async_ import AsyncWebhookAdapter
+
+GUILD_ID = 1100000000000000000
+QUOTE_CHANNEL = 1100000000000000001
+OTHER_CHANNEL = 1100000000000000002
+BOT_ID = 1100000000000000003
+USER_ID = 1100000000000000004
+_ids = itertools.count(discord.utils.time_snowflake(datetime.now(timezone.utc)))
+
+def user_payload(user_id, name):
+    return {'id': str(user_id), 'username': name, 'discriminator': '0', 'avatar': None, 'global_name': name}
+
+def message_payload(channel_id, content, message_id=None, author_id=USER_ID):
+    return {
+        'id': str(message_id or next(_ids)), 'channel_id': str(channel_id), 'guild_id': str(GUILD_ID), 'type': 0,
+        'author': user_payload(author_id, 'loadtest'), 'content': content, 'timestamp': datetime.now(timezone.utc).isoformat(),
+        'edited_timestamp': None, 'tts': False, 'mention_everyone': False, 'mentions': [], 'mention_roles': [],
+        'attachments': [], 'embeds': [], 'pinned': False, 'flags': 0,
+    }
+
+class FakeDiscord:
+    """
+    Answers REST and webhook calls after `latency` seconds and counts them by route.
+    """
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = Counter()
+
+    def install(self):
+        fake = self
+
+        async def request(http, route, **kwargs):
+            fake.calls[f'{route.method} {route.path}'] += 1
+            await asyncio.sleep(fake.latency)
+            return None
+
+        async def webhook_request(adapter, route, session, **kwargs):
+            fake.calls[f'{route.method} {route.path}'] += 1
+            await asyncio.sleep(fake.latency)
+            if route.path.endswith('/callback'):
+                # like discord with `with_response`: responses that post or update a message return it
+                response_type = json.loads(kwargs['multipart'][0]['value'])['type']
+                callback = {'interaction': {'id': str(route.webhook_id), 'type': 2}}
+                if response_type in (4, 7):
+                    callback['resource'] = {'type': response_type, 'message': message_payload(QUOTE_CHANNEL, '', author_id=BOT_ID)}
+                return callback
+            if route.method in ('GET', 'POST', 'PATCH'):
+                # followups, edits and fetches of the response return the message
+                return message_payload(QUOTE_CHANNEL, '', author_id=BOT_ID)
+            return None
+
+        # patched on the classes before the bot is created, so the metrics wrapper wraps the fake
+        HTTPClient.request = request
+        AsyncWebhookAdapter.request = webhook_request
+
+fake = FakeDiscord(args.api_latency)
+fake.install()
+
+import main
+from util import metrics
+from util.db import db, Guild, Quote
+from util.migrations import run_migrations
+from util.guildconfig import guild_configs
+from util.reactions import reaction_scheduler
+from util.images import start_render_pool
+
+def setup():
+    run_migrations()
+    with db.connection_context():
+        Guild.insert(guildid=GUILD_ID, quoteChannel=QUOTE_CHANNEL).on_conflict_ignore().execute()
+        quotes = [{'messageid': next(_ids), 'guildid': GUILD_ID, 'content': f'Seeded quote number {i} with a few more words',
+                   'author': f'Author {i % 40}', 'channelid': QUOTE_CHANNEL} for i in range(args.quotes)]
+        with db.atomic():
+            for start in range(0, len(quotes), 500):
+                Quote.insert_many(quotes[start:start + 500]).on_conflict_ignore().execute()
+    state = main.bot._connection
+    state.user = discord.ClientUser(state=state, data=user_payload(BOT_ID, 'quotr'))
+    channel = lambda channel_id, name: {'id': str(channel_id), 'type': 0, 'name': name, 'position': 0, 'permission_overwrites': [], 'guild_id': str(GUILD_ID)}
+    role = {'id': str(GUILD_ID), 'name': '@everyone', 'permissions': str(discord.Permissions.all().value), 'position': 0,
+            'color': 0, 'colors': {'primary_color': 0, 'secondary_color': None, 'tertiary_color': None}, 'hoist': False, 'managed': False, 'mentionable': False}
+    member = lambda user_id, name: {'user': user_payload(user_id, name), 'roles': [], 'joined_at': datetime.now(timezone.utc).isoformat(), 'deaf': False, 'mute': False}
+    return state._add_guild_from_data({
+        'id': str(GUILD_ID), 'name': 'loadtest', 'owner_id': str(USER_ID), 'roles': [role], 'emojis': [], 'stickers': [], 'features': [],
+        'channels': [channel(QUOTE_CHANNEL, 'quotes'), channel(OTHER_CHANNEL, 'general')],
+        'members': [member(BOT_ID, 'quotr'), member(USER_ID, 'loadtest')], 'member_count': 2,
+    })
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0.0
+
+def db_queries():
+    return sum(count for count, _, _ in metrics.db_latency.summary().values())
+
+async def drain():
+    # the reactions of the last messages, so their calls count for the scenario that caused them
+    while reaction_scheduler.pending() or reaction_scheduler.timers.pending:
+        await asyncio.sleep(0.05)
+
+async def measure(name, run):
+    calls = sum(fake.calls.values())
+    queries = db_queries()
+    start = time.perf_counter()
+    latencies = await run()
+    elapsed = time.perf_counter() - start
+    await drain()
+    result = {
+        'events': len(latencies),
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'api_calls': sum(fake.calls.values()) - calls,
+        'db_queries': db_queries() - queries,
+    }
+    print(f'{name:<12} {result["events"]:>7} {result["throughput"]:>10.1f}/s {result["p50_ms"]:>9.1f} {result["p99_ms"]:>9.1f} {result["api_calls"]:>9} {result["db_queries"]:>10}', flush=True)
+    return result
+
+def replay(guild, channel_id, contents):
+    """
+    Open loop: messages arrive at `--rate` whether or not the earlier ones are done, latency includes waiting.
+    """
+    async def run():
+        channel = guild.get_channel(channel_id)
+        latencies = []
+
+        async def deliver(arrival, content):
+            await asyncio.sleep(max(0.0, arrival - time.perf_counter()))
+            message = discord.Message(state=main.bot._connection, channel=channel, data=message_payload(channel_id, content))
+            await main.on_message(message)
+            latencies.append(time.perf_counter() - arrival)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(deliver(start + index / args.rate, content) for index, content in enumerate(contents)))
+        return latencies
+    return run
+
+def guess_games(guild, players):
+    """
+    Closed loop: `players` users run /guess again as soon as their last one was answered.
+    """
+    async def run():
+        latencies = []
+        remaining = iter(range(args.games))
+
+        async def player():
+            for _ in remaining:
+                interaction = discord.Interaction(state=main.bot._connection, data={
+                    'id': str(next(_ids)), 'application_id': str(BOT_ID), 'type': 2, 'token': 'loadtest', 'version': 1,
+                    'guild_id': str(GUILD_ID), 'channel_id': str(QUOTE_CHANNEL), 'locale': 'en-US', 'guild_locale': 'en-US',
+                    'data': {'id': str(BOT_ID), 'name': 'guess', 'type': 1},
+                    'member': {'user': user_payload(USER_ID, 'loadtest'), 'roles': [], 'joined_at': datetime.now(timezone.utc).isoformat(),
+                               'deaf': False, 'mute': False, 'permissions': str(discord.Permissions.all().value)},
+                })
+                start = time.perf_counter()
+                ctx = await main.bot.get_application_context(interaction)
+                ctx.command = main.guess
+                await main.bot.invoke_application_command(ctx)
+                latencies.append(time.perf_counter() - start)
+
+        await asyncio.gather(*(player() for _ in range(players)))
+        return latencies
+    return run
+
+def scenarios(guild):
+    count = args.messages
+    found = {
+        'quotes': replay(guild, QUOTE_CHANNEL, [f'"Load test quote {index} about {index % 97} things" - Tester {index % 13}' for index in range(count)]),
+        'chatter': replay(guild, QUOTE_CHANNEL, [f'just chatting, message {index}' for index in range(count)]),
+        'offtopic': replay(guild, OTHER_CHANNEL, [f'"Not in the quote channel {index}" - Someone' for index in range(count)]),
+    }
+    for players in (int(level) for level in args.concurrency.split(',') if level.strip()):
+        found[f'guess-c{players}'] = guess_games(guild, players)
+    return found
+
+def commit():
+    try:
+        head = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        return head + ('-dirty' if dirty else '')
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def compare(results, reference):
+    path = reference if os.path.isfile(reference) else os.path.join(RESULTS_DIR, f'{reference}.json')
+    with open(path) as file:
+        before = json.load(file)
+    print(f'\nChange against {before["commit"]} ({before["date"]}):')
+    for name, result in results['scenarios'].items():
+        old = before['scenarios'].get(name)
+        if not old:
+            continue
+        changes = []
+        for key in ('throughput', 'p50_ms', 'p99_ms', 'api_calls', 'db_queries'):
+            if old[key]:
+                changes.append(f'{key} {(result[key] - old[key]) / old[key] * 100:+.0f}%')
+        print(f'{name:<12} ' + ', '.join(changes))
+
+async def run():
+    guild = setup()
+    await guild_configs.load()
+    selected = scenarios(guild)
+    unknown = set(args.scenario or ()) - set(selected)
+    if unknown:
+        parser.error(f'unknown scenarios: {", ".join(sorted(unknown))}')
+    print(f'{"scenario":<12} {"events":>7} {"throughput":>12} {"p50 ms":>9} {"p99 ms":>9} {"api calls":>9} {"db queries":>10}')
+    results = {}
+    for name, scenario in selected.items():
+        if not args.scenario or name in args.scenario:
+            results[name] = await measure(name, scenario)
+    return results
+
+if __name__ == '__main__':
+    start_render_pool()
+    results = {
+        'commit': commit(),
+        'date': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'config': {key: getattr(args, key) for key in ('messages', 'rate', 'games', 'concurrency', 'quotes', 'api_latency', 'reaction_interval')},
+        'database': 'sqlite' if not args.database else args.database.split(':', 1)[0],
+        'scenarios': asyncio.run(run()),
+    }
+    if not args.no_save:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        path = os.path.join(RESULTS_DIR, f'{results["commit"]}.json')
+        with open(path, 'w') as file:
+            json.dump(results, file, indent=2)
+        print(f'\nSaved to {os.path.relpath(path, ROOT)}')
+    if args.compare:
+        compare(results, args.compare)
@@ -0,0 +1,117 @@
+"""
+Runs the bot sharded across several processes that share the database.
+Every process gets a contiguous range of shards, its own metrics port and its own log file,
+and is restarted with a backoff if it exits.
+
+    python src/launcher.py --shards 8 --processes 4
+    python src/launcher.py --shards auto --processes 2   # asks discord for the recommended shard count
+    python src/launcher.py --shards 4 --processes 2 --dry-run   # prints the plan
+
+Run `python src/migrate.py` once before starting the launcher.
+"""
+from dotenv import load_dotenv
+import argparse
+import asyncio
+import signal
+import json
+import sys
+import os
+import urllib.request
+
+load_dotenv()
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+RESTART_BACKOFF = (5, 300) # seconds before restarting a worker, doubled per crash up to the maximum
+HEALTHY_AFTER = 600 # seconds a worker has to run for its backoff to reset
+
+sys.path.insert(0, SRC_DIR)
+from util.sharding import plan
+
+def recommended_shards():
+    # the same endpoint the library asks when it picks the shard count itself
+    request = urllib.request.Request(
+        'https://discord.com/api/v10/gateway/bot',
+        headers={'Authorization': f'Bot {os.getenv("DISCORD_TOKEN")}', 'User-Agent': 'DiscordBot (quotr launcher)'},
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)['shards']
+
+def worker_env(index, shard_count, shard_ids):
+    env = dict(os.environ)
+    env['SHARD_COUNT'] = str(shard_count)
+    env['SHARD_IDS'] = ','.join(map(str, shard_ids))
+    # each process has its own metrics endpoint and log file
+    metrics_port = int(os.getenv('METRICS_PORT', 9108))
+    env['METRICS_PORT'] = str(metrics_port + index if metrics_port else 0)
+    log_file, extension = os.path.splitext(os.getenv('LOG_FILE', 'discord.log'))
+    env['LOG_FILE'] = f'{log_file}.{index}{extension}'
+    return env
+
+class Worker:
+    def __init__(self, index, shard_count, shard_ids):
+        self.index = index
+        self.shard_ids = shard_ids
+        self.env = worker_env(index, shard_count, shard_ids)
+        self.command = [sys.executable, os.path.join(SRC_DIR, 'main.py')]
+        self.process = None
+        self.restarts = 0
+
+    def __str__(self):
+        return f'worker {self.index} (shards {",".join(map(str, self.shard_ids))})'
+
+    async def run(self, stopping: asyncio.Event):
+        backoff = RESTART_BACKOFF[0]
+        while not stopping.is_set():
+            loop = asyncio.get_running_loop()
+            started = loop.time()
+            self.process = await asyncio.create_subprocess_exec(*self.command, env=self.env)
+            print(f'Started {self} as pid {self.process.pid}, metrics on port {self.env["METRICS_PORT"]}', flush=True)
+            code = await self.process.wait()
+            if stopping.is_set():
+                break
+            if loop.time() - started > HEALTHY_AFTER:
+                backoff = RESTART_BACKOFF[0]
+            self.restarts += 1
+            print(f'{self} exited with {code}, restarting in {backoff}s', flush=True)
+            try:
+                await asyncio.wait_for(stopping.wait(), backoff)
+            except asyncio.TimeoutError:
+                pass
+            backoff = min(backoff * 2, RESTART_BACKOFF[1])
+
+    def terminate(self):
+        if self.process and self.process.returncode is None:
+            self.process.terminate()
+
+async def launch(shard_count, processes):
+    stopping = asyncio.Event()
+    workers = [Worker(index, shard_count, shard_ids) for index, shard_ids in enumerate(plan(shard_count, processes))]
+    loop = asyncio.get_running_loop()
+    def stop():
+        print('Stopping workers...', flush=True)
+        stopping.set()
+        for worker in workers:
+            worker.terminate()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop)
+    await asyncio.gather(*(worker.run(stopping) for worker in workers))
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the bot sharded across several processes.')
+    parser.add_argument('--shards', default=os.getenv('SHARD_COUNT') or 'auto', help='total number of shards, or "auto"')
+    parser.add_argument('--processes', type=int, default=int(os.getenv('SHARD_PROCESSES', os.cpu_count() or 1)), help='number of worker processes')
+    parser.add_argument('--dry-run', action='store_true', help='print the shard plan and exit')
+    args = parser.parse_args()
+
+    shard_count = recommended_shards() if args.shards == 'auto' else int(args.shards)
+    if shard_count < 1:
+        parser.error('--shards must be at least 1')
+    if args.dry_run:
+        for index, shard_ids in enumerate(plan(shard_count, args.processes)):
+            env = worker_env(index, shard_count, shard_ids)
+            print(f'worker {index}: SHARD_COUNT={env["SHARD_COUNT"]} SHARD_IDS={env["SHARD_IDS"]} METRICS_PORT={env["METRICS_PORT"]} LOG_FILE={env["LOG_FILE"]}')
+        return
+    asyncio.run(launch(shard_count, args.processes))
+
+if __name__ == '__main__':
+    main()
@@ -4,45 +4,94 @@ import os # default module
 from dotenv import load_dotenv
 from util.db import *
 import asyncio
+import io
+import tempfile
 from util.logger import logger
-from util.quotes import process_message, processChannelMessages, clearQuotes
-from util.images import create_quote_image
-import random
+from util.guildconfig import guild_configs
+from util.sampler import quote_sampler
+from util.messagecache import message_cache
+from util.regexes import validateRegex
+from util.regexguard import regex_sandbox
+from util.quotes import process_message, startScan, scan_tasks, clearQuotes, deleteQuotes, mergeDuplicates
+from util.debounce import MessageDebouncer
+from util.clearjob import clear_jobs
+from util.images import render_quote_image, start_render_pool, render_stats, RenderBusy, IMAGE_EXTENSION
+from util.reactions import reaction_scheduler
+from util.prefetch import guess_rounds, BACKGROUND_COLORS
+from util.sessions import game_sessions, components, GameSession
+from util.search import quote_index, recent_searches
+from util.transfer import stream_quotes, QuoteWriter
+from util.sharding import create_bot, shard_health, local_shards
+from util import metrics
 
 load_dotenv() # load all the variables from the env file
 intends = discord.Intents.default() # create the intents object
 intends.reactions = True # enable the reactions intent
 intends.messages = True # enable the messages intent
 intends.message_content = True # enable the message content intent
-bot = discord.Bot(intends=intends) # create the bot object
+bot = create_bot(intends=intends) # create the bot object, an AutoShardedBot if SHARD_COUNT is set
+metrics.instrument_bot(bot) # time commands, events and REST calls
 
-guild_ids = [int(guildid) for guildid in os.getenv('GUILD_IDS').split(',')] # get the guild ids from the env file
+# get the guild ids from the env file, without any the commands are registered globally
+guild_ids = [int(guildid) for guildid in os.getenv('GUILD_IDS', '').split(',') if guildid.strip()] or None
+
+# state that already has counters is read on scrape
+metrics.register_stats('db', db_stats.snapshot)
+metrics.register_stats('guild_config', guild_configs.stats)
+metrics.register_stats('message_cache', message_cache.stats)
+metrics.register_stats('reactions', reaction_scheduler.stats)
+metrics.register_stats('render', render_stats.snapshot)
+metrics.register_stats('regex', regex_sandbox.stats)
+metrics.register_stats('search', quote_index.stats)
+metrics.register_stats('guess_prefetch', guess_rounds.stats)
+metrics.register_stats('game_sessions', game_sessions.stats)
+metrics.GaugeFunc('quotr_shard_up', 'Whether the shard is connected.', lambda: {shard: health['up'] for shard, health in shard_health(bot).items()}, ('shard',))
+metrics.GaugeFunc('quotr_shard_latency_seconds', 'Gateway heartbeat latency by shard.', lambda: {shard: health['latency'] for shard, health in shard_health(bot).items()}, ('shard',))
+metrics.GaugeFunc('quotr_shard_guilds', 'Guilds by shard.', lambda: {shard: health['guilds'] for shard, health in shard_health(bot).items()}, ('shard',))
+
+def health():
+    # healthy once every shard of this process is connected
+    shards = shard_health(bot)
+    return bool(shards) and all(shard['up'] for shard in shards.values()), {'shards': {str(shard): health for shard, health in shards.items()}}
+metrics.set_health_check(health)
 
 @bot.event
 async def on_ready():
-    logger.info(f'Logged in as {bot.user.name} - {bot.user.id}')
+    logger.info(f'Logged in as {bot.user.name} - {bot.user.id} ({local_shards})')
     logger.info('------')
-    # check if the database is connected
-    connection_errors = 0
-    while db.is_closed():
-        if connection_errors > 5:
-            logger.error('Could not connect to the database after 5 attempts. Exiting...')
-            await bot.close()
-        connection_errors += 1
-        logger.info('Attempting to connect to the database...')
-        try:
-            db.connect()
-            logger.info('Database connected')
-        except Exception as e:
-            logger.error(f'Error connecting to database: {e}')
-            await asyncio.sleep(5)
+    # the pool reconnects on demand, this only reports whether the database is reachable right now
+    try:
+        await run_query(db.execute_sql, 'SELECT 1')
+        logger.info(f'Database reachable - {db_stats.snapshot()}')
+    except Exception as e:
+        logger.error(f'Database not reachable, queries will retry on demand: {e}')
+    await metrics.start_metrics_server()
+    guild_configs.start_loading()
     
+@bot.event
+async def on_shard_ready(shard_id):
+    logger.info(f'Shard {shard_id} ready')
+
+@bot.event
+async def on_shard_resumed(shard_id):
+    logger.info(f'Shard {shard_id} resumed')
+
+@bot.event
+async def on_shard_disconnect(shard_id):
+    logger.warning(f'Shard {shard_id} disconnected')
+    metrics.shard_disconnects.inc(shard_id)
+
+@bot.event
+async def on_disconnect():
+    if not local_shards.sharded:
+        metrics.shard_disconnects.inc(0)
+
 # on guild join, create a new guild in the database
 @bot.event
 async def on_guild_join(guild):
     logger.info(f'Joined guild: {guild.name} - {guild.id}')
     try:
-        Guild.create(guildid=guild.id)
+        await guild_configs.add(guild.id)
         logger.info(f'Created new guild in database: {guild.name} - {guild.id}')
     except Exception as e:
         logger.error(f'Error creating new guild in database: {e}')
@@ -52,7 +101,8 @@ async def on_guild_join(guild):
 async def on_guild_remove(guild):
     logger.info(f'Left guild: {guild.name} - {guild.id}')
     try:
-        Guild.delete().where(Guild.guildid == guild.id).execute()
+        await guild_configs.remove(guild.id)
+        quote_sampler.drop(guild.id)
         logger.info(f'Deleted guild from database: {guild.name} - {guild.id}')
     except Exception as e:
         logger.error(f'Error deleting guild from database: {e}')
@@ -60,47 +110,57 @@ async def on_guild_remove(guild):
 # on message write, if the message is in the guild's quote channel, and the message is a quote, save the quote to the database
 @bot.event
 async def on_message(message: discord.Message):
-    if message.author == bot.user:
+    if message.author == bot.user or message.guild is None:
         return
-    guild, _ = Guild.get_or_create(guildid=message.guild.id)
-    if message.channel.id != guild.quoteChannel:
-        return
-    message = await message.channel.fetch_message(message.id)
-    if message is None:
-        logger.error(f'Message not found: {message.id} - {message.channel.name} - {message.channel.id}')
+    if not guild_configs.is_quote_channel(message.guild.id, message.channel.id):
         return
+    # the gateway payload is the full message, no need to fetch it again
+    message_cache.put(message)
     await process_message(message)
 
+async def process_edit(event: discord.RawMessageUpdateEvent, before):
+    # get the message object
+    after = await message_cache.from_edit(bot, event)
+    if after is None or after.author == bot.user:
+        return True
+    if before is not None and before == after.content:
+        # the text is the same as before the first edit, e.g. only an embed was added
+        return False
+    return await process_message(after)
+
+async def process_delete(event: discord.RawMessageDeleteEvent):
+    await deleteQuotes(event.guild_id, [event.message_id])
+
+# edits and deletes of a message are collected for a moment and only the final state is processed
+edit_debouncer = MessageDebouncer(process_edit, process_delete)
+metrics.register_stats('edits', edit_debouncer.stats)
+
 @bot.event
 async def on_raw_message_edit(event: discord.RawMessageUpdateEvent):
-    guild, _ = Guild.get_or_create(guildid=event.guild_id)
-    if event.channel_id != guild.quoteChannel:
+    if event.guild_id is None or not guild_configs.is_quote_channel(event.guild_id, event.channel_id):
         return
-    message_id = event.message_id
-    # get the message object
-    after = await bot.get_channel(event.channel_id).fetch_message(message_id)
-    if after is None:
-        return
-    if after.author == bot.user:
-        return
-    await process_message(after)
-        
+    # the message as it was before this edit, if either cache still has it
+    cached = event.cached_message or message_cache.get(event.message_id)
+    edit_debouncer.edit(event.message_id, event, before=cached.content if cached else None)
                 
 # if a message is deleted, delete the quote from the database
+# raw events also arrive for messages that are not in the library's cache
 @bot.event
-async def on_message_delete(message: discord.Message):
-    if message.author == bot.user:
+async def on_raw_message_delete(event: discord.RawMessageDeleteEvent):
+    if event.guild_id is None or not guild_configs.is_quote_channel(event.guild_id, event.channel_id):
         return
-    guild, _ = Guild.get_or_create(guildid=message.guild.id)
-    if message.channel.id != guild.quoteChannel:
+    message_cache.discard(event.message_id)
+    edit_debouncer.delete(event.message_id, event)
+
+@bot.event
+async def on_raw_bulk_message_delete(event: discord.RawBulkMessageDeleteEvent):
+    if event.guild_id is None or not guild_configs.is_quote_channel(event.guild_id, event.channel_id):
         return
-    # delete the quote from the database
-    quote = Quote.get_or_none(Quote.messageid == message.id)
-    if quote:
-        quote.delete_instance()
-        logger.info(f'Deleted quote from database: {quote.quote} - {quote.author} - {message.id}')
-    else:
-        logger.info(f'Quote not found in database: {message.id}')
+    # a purge, nothing to debounce: drop what is pending for these messages and delete them in one go
+    edit_debouncer.cancel(event.message_ids)
+    for message_id in event.message_ids:
+        message_cache.discard(message_id)
+    await deleteQuotes(event.guild_id, event.message_ids)
 
 @bot.slash_command(name='setquotechannel', description='Set the quote channel for the guild', guild_ids=guild_ids)
 @commands.has_permissions(manage_guild=True)
@@ -112,28 +172,19 @@ async def set_quote_channel(ctx, channel: discord.TextChannel = None):
         await ctx.respond('Please select a text channel.', ephemeral=True)
         return
     await ctx.defer(ephemeral=True)
-    guild, _ = Guild.get_or_create(guildid=ctx.guild.id)
-    guild.quoteChannel = channel.id
-    guild.save()
+    if guild_configs.get(ctx.guild.id).quoteChannel != channel.id:
+        # the scan checkpoint belongs to the old channel
+        await guild_configs.update(ctx.guild.id, quoteChannel=channel.id, quotesProcessedUntil=None, scannedFrom=None)
     
     # send an embed message to the channel
     embed = discord.Embed(title='Quote Channel Set', description=f'The quote channel has been set to {channel.mention}. I\'ll scan the last `500` Messages for quotes. Any new messages will also be scanned.', color=0x00ff00)
     embed.add_field(name='Channel', value=channel.mention, inline=False)
     
     # start processing the channel messages, but don't wait for it to finish
-    task = asyncio.create_task(processChannelMessages(channel))
+    startScan(channel, 500)
     
-    # Add buttons
-    view = discord.ui.View(timeout=60)
-
     # Add Stop Button
-    button = discord.ui.Button(label='Stop Processing', style=discord.ButtonStyle.danger)
-    async def button_callback(interaction):
-        await interaction.response.send_message('Stopping processing...', ephemeral=True)
-        task.cancel()
-        await interaction.followup.send('Processing stopped', ephemeral=True)
-    button.callback = button_callback
-    view.add_item(button)
+    view = components.view(discord.ui.Button(label='Stop Processing', style=discord.ButtonStyle.danger, custom_id=components.custom_id('stopscan', ctx.guild.id)))
     
     await ctx.respond(embed=embed, view=view, ephemeral=True)
     
@@ -142,9 +193,9 @@ async def set_quote_channel(ctx, channel: discord.TextChannel = None):
 # scan command
 @bot.slash_command(name='scan', description='Scan quote channel for quotes', guild_ids=guild_ids)
 @commands.has_permissions(manage_guild=True)
-async def scan(ctx, limit: int = 500):
+async def scan(ctx, limit: int = None):
     await ctx.defer(ephemeral=True)
-    guild, _ = Guild.get_or_create(guildid=ctx.guild.id)
+    guild = guild_configs.get(ctx.guild.id)
     if guild.quoteChannel == None:
         await ctx.respond('Please set a quote channel first.', ephemeral=True)
         return
@@ -153,167 +204,333 @@ async def scan(ctx, limit: int = 500):
         await ctx.respond('Quote channel not found. Please set a quote channel first.', ephemeral=True)
         return
     # start processing the channel messages, but don't wait for it to finish
-    task = asyncio.create_task(processChannelMessages(channel, limit))
-    
-    # create a view
-    view = discord.ui.View(timeout=120)
+    startScan(channel, limit)
     
     # add a button to stop the scan
-    button = discord.ui.Button(label='Stop Scan', style=discord.ButtonStyle.danger)
-    async def button_callback(interaction):
-        await interaction.response.send_message('Stopping scan...', ephemeral=True)
-        task.cancel()
-        await interaction.followup.send('Scan stopped', ephemeral=True)
-    
-    button.callback = button_callback
-    view.add_item(button)
+    view = components.view(discord.ui.Button(label='Stop Scan', style=discord.ButtonStyle.danger, custom_id=components.custom_id('stopscan', ctx.guild.id)))
     
     # send an embed message to the channel
-    embed = discord.Embed(title='Quote Channel Scanning', description=f'Scanning the quote channel {channel.mention} for quotes. This may take a while.', color=0x00ff00)
+    embed = discord.Embed(title='Quote Channel Scanning', description=f'Scanning the quote channel {channel.mention} for quotes, starting after the last scanned message. This may take a while.', color=0x00ff00)
     embed.add_field(name='Channel', value=channel.mention, inline=False)
     await ctx.respond(embed=embed, ephemeral=True, view=view)
 
 @bot.slash_command(name='setquoteregex', description='Advanced. Group 1 is the quote, group 2 is the author. Reverse the groups with reverse=True', guild_ids=guild_ids)
 @commands.has_permissions(manage_guild=True)
 async def set_quote_regex(ctx, regex: str, reverse: bool = False):
-    guild, _ = Guild.get_or_create(Guild.guildid == ctx.guild.id)
-    guild.quoteRegex = regex
-    guild.save()
+    error = validateRegex(regex)
+    if error:
+        await ctx.respond(error, ephemeral=True)
+        return
+    await ctx.defer(ephemeral=True)
+    # run the pattern against inputs known to trigger catastrophic backtracking before accepting it
+    error = await regex_sandbox.validate(regex)
+    if error:
+        await ctx.respond(error, ephemeral=True)
+        return
+    await guild_configs.update(ctx.guild.id, quoteRegex=regex, quoteRegexReverse=reverse, quoteRegexDisabled=False)
     await ctx.respond(f'Quote regex set to {regex}')
 
+@components.handler('stopscan')
+async def stop_scan(interaction: discord.Interaction, guild_id):
+    task = scan_tasks.get(int(guild_id))
+    if task is None:
+        await interaction.response.send_message('No scan is running.', ephemeral=True)
+        return
+    await interaction.response.send_message('Stopping scan...', ephemeral=True)
+    task.cancel()
+    await interaction.followup.send('Scan stopped', ephemeral=True)
+
+async def check_user(interaction: discord.Interaction, user_id):
+    # the buttons carry the id of the user who ran the command
+    if interaction.user.id != int(user_id):
+        await interaction.response.send_message('You are not allowed to use this button.', ephemeral=True)
+        return False
+    return True
+
+def clear_job_view(job, user_id):
+    # Cancel while the job runs, Resume once it was cancelled
+    if job.finished:
+        return None
+    if job.running:
+        button = discord.ui.Button(label='Stop', style=discord.ButtonStyle.danger, custom_id=components.custom_id('clearstop', user_id))
+    else:
+        button = discord.ui.Button(label='Resume', style=discord.ButtonStyle.primary, custom_id=components.custom_id('clearresume', user_id))
+    return components.view(button)
+
+def start_clear_job(job, interaction, user_id):
+    async def on_progress(job):
+        content = f'Quotes cleared. {job.progress()}' + (' - done' if job.finished else '')
+        await interaction.edit_original_response(content=content, view=clear_job_view(job, user_id))
+    job.start(on_progress)
+
 @bot.slash_command(name='clearquotes', description='Clear all quotes from the database', guild_ids=guild_ids)
 @commands.has_permissions(manage_guild=True)
 async def clear_quotes(ctx):
     # Ask for confirmation
-    view = discord.ui.View(timeout=60)
-    button = discord.ui.Button(label='Confirm', style=discord.ButtonStyle.danger)
-    async def button_callback(interaction):
-        if interaction.user != ctx.author:
-            await interaction.response.send_message('You are not allowed to use this button.', ephemeral=True)
-            return
-        await interaction.response.send_message('Clearing quotes...', ephemeral=True)
-        # for each quote in the database, check if the message has a reaction
-        await clearQuotes(ctx.channel, ctx.guild.id, bot.user)
-        await interaction.followup.send('Quotes cleared', ephemeral=True)
-    button.callback = button_callback
-    view.add_item(button)
-    button = discord.ui.Button(label='Cancel', style=discord.ButtonStyle.primary)
-    async def button_callback(interaction):
-        if interaction.user != ctx.author:
-            await interaction.response.send_message('You are not allowed to use this button.', ephemeral=True)
-            return
-        await interaction.response.send_message('Cancelled', ephemeral=True)
-    button.callback = button_callback
-    view.add_item(button)
+    view = components.view(
+        discord.ui.Button(label='Confirm', style=discord.ButtonStyle.danger, custom_id=components.custom_id('clearconfirm', ctx.author.id)),
+        discord.ui.Button(label='Cancel', style=discord.ButtonStyle.primary, custom_id=components.custom_id('clearcancel', ctx.author.id)),
+    )
     embed = discord.Embed(title='Clear Quotes', description='Are you sure you want to clear all quotes from the database?', color=0xff0000)
     await ctx.respond(embed=embed, view=view, ephemeral=True)
+
+@components.handler('clearconfirm')
+async def confirm_clear(interaction: discord.Interaction, user_id):
+    if not await check_user(interaction, user_id):
+        return
+    previous = clear_jobs.get(interaction.guild_id)
+    if previous and previous.running:
+        await interaction.response.send_message('Reactions of the last clear are still being removed.', ephemeral=True)
+        return
+    await interaction.response.edit_message(content='Clearing quotes...', embed=None, view=None)
+    # the rows are deleted right away, the reactions are removed in the background
+    job = await clearQuotes(bot, interaction.guild_id, guild_configs.get(interaction.guild_id).quoteChannel)
+    start_clear_job(job, interaction, user_id)
+
+@components.handler('clearcancel')
+async def cancel_clear(interaction: discord.Interaction, user_id):
+    if not await check_user(interaction, user_id):
+        return
+    await interaction.response.send_message('Cancelled', ephemeral=True)
+
+@components.handler('clearstop')
+async def stop_clear(interaction: discord.Interaction, user_id):
+    if not await check_user(interaction, user_id):
+        return
+    job = clear_jobs.get(interaction.guild_id)
+    if job is None or not job.running:
+        await interaction.response.send_message('No reactions are being removed right now.', ephemeral=True)
+        return
+    await job.cancel()
+    await interaction.response.edit_message(content=f'Quotes cleared. {job.progress()} - stopped', view=clear_job_view(job, user_id))
+
+@components.handler('clearresume')
+async def resume_clear(interaction: discord.Interaction, user_id):
+    if not await check_user(interaction, user_id):
+        return
+    job = clear_jobs.get(interaction.guild_id)
+    if job is None or job.finished:
+        # e.g. the bot restarted since, the quotes are gone either way
+        await interaction.response.edit_message(content='Quotes cleared. Nothing left to resume.', view=None)
+        return
+    await interaction.response.defer()
+    start_clear_job(job, interaction, user_id)
+
+@bot.slash_command(name='mergeduplicates', description='Merge quotes that were posted more than once into the first post', guild_ids=guild_ids)
+@commands.has_permissions(manage_guild=True)
+async def merge_duplicates(ctx):
+    await ctx.defer(ephemeral=True)
+    merged = await mergeDuplicates(ctx.guild.id)
+    if merged:
+        await ctx.respond(f'Merged {merged} duplicate quotes.', ephemeral=True)
+    else:
+        await ctx.respond('No duplicate quotes found.', ephemeral=True)
     
+@bot.slash_command(name='exportquotes', description='Download all quotes of the guild as a file', guild_ids=guild_ids)
+@commands.has_permissions(manage_guild=True)
+async def export_quotes(ctx, format: discord.Option(str, choices=['jsonl', 'csv'], default='jsonl')):
+    await ctx.defer(ephemeral=True)
+    # streamed batch by batch into a file on disk, so a large guild doesn't end up in memory
+    with tempfile.TemporaryFile() as raw:
+        file = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+        writer = QuoteWriter(file, format)
+        async for quote in stream_quotes(ctx.guild.id):
+            writer.write(quote)
+        file.flush()
+        file.detach()
+        size = raw.tell()
+        if size > ctx.guild.filesize_limit:
+            await ctx.respond(f'The export of {writer.count} quotes is too large to upload ({size // 1024 // 1024} MB), please use `src/transfer.py` on the server.', ephemeral=True)
+            return
+        raw.seek(0)
+        await ctx.respond(f'Exported {writer.count} quotes.', file=discord.File(raw, filename=f'quotes-{ctx.guild.id}.{format}'), ephemeral=True)
+    logger.info(f'Exported {writer.count} quotes of guild {ctx.guild.id}')
+
 @bot.slash_command(name='quote', description='Get a random quote from the database', guild_ids=guild_ids)
 async def get_quote(ctx):
-    quotes = Quote.select().where(Quote.guildid == ctx.guild.id)
-    if quotes.count() == 0:
+    quote = await quote_sampler.random_quote(ctx.guild.id)
+    if quote is None:
         await ctx.respond('No quotes found in the database.', ephemeral=True)
         return
-    quote = quotes.order_by(fn.RAND()).get()
     embed = discord.Embed(title='Random Quote', description=quote.content, color=0x00ff00)
     embed.add_field(name='Author', value=quote.author, inline=False)
-    # jump to the message
-    # get guild from the database
-    guild = Guild.get_or_none(guildid=ctx.guild.id)
-    if guild:
-        # get the channel from the database
-        channel = bot.get_channel(guild.quoteChannel)
-        if channel:
-            try:
-                message = await channel.fetch_message(quote.messageid)
-                if message:
-                    embed.add_field(name='Message Link', value=f'[Jump to Message]({message.jump_url})', inline=False)
-            except discord.NotFound:
-                embed.add_field(name='Message Link', value='Message not found', inline=False)
+    # jump to the message, quotes stored before the channel was recorded were posted in the quote channel
+    jump_url = quote.jump_url(guild_configs.get(ctx.guild.id).quoteChannel)
+    if jump_url:
+        embed.add_field(name='Message Link', value=f'[Jump to Message]({jump_url})', inline=False)
     await ctx.respond(embed=embed)
     
+def search_results(key, text, author, page):
+    # one line per quote, the buttons carry the search and the message id to continue from
+    title = (f'Search: {text}' + (f' by {author}' if author else ''))[:256]
+    if not page.quotes:
+        return discord.Embed(title=title, description='No quotes found.', color=0xff0000), None
+    quote_channel = guild_configs.get(page.quotes[0].guildid_id).quoteChannel
+    lines = []
+    for quote in page.quotes:
+        content = quote.content if len(quote.content) <= 200 else quote.content[:197] + '...'
+        jump_url = quote.jump_url(quote_channel)
+        lines.append(f'{content} - *{quote.author}*' + (f' [Jump]({jump_url})' if jump_url else ''))
+    embed = discord.Embed(title=title, description='\n\n'.join(lines), color=0x00ff00)
+    embed.set_footer(text=f'{page.total} quotes found')
+    view = components.view(
+        discord.ui.Button(label='Newer', disabled=not page.newer, custom_id=components.custom_id('search', key, 'after', page.quotes[0].messageid)),
+        discord.ui.Button(label='Older', disabled=not page.older, custom_id=components.custom_id('search', key, 'before', page.quotes[-1].messageid)),
+    )
+    return embed, view
+
+@bot.slash_command(name='search', description='Search the quotes of the guild', guild_ids=guild_ids)
+async def search_quotes(ctx, text: str, author: str = None):
+    await ctx.defer(ephemeral=True)
+    page = await quote_index.search(ctx.guild.id, text, author)
+    recent_searches.put(ctx.interaction.id, text, author)
+    embed, view = search_results(ctx.interaction.id, text, author, page)
+    await ctx.respond(embed=embed, view=view, ephemeral=True)
+
+@components.handler('search')
+async def search_page(interaction: discord.Interaction, key, direction, messageid):
+    search = recent_searches.get(int(key))
+    if search is None:
+        await interaction.response.send_message('This search expired, please search again.', ephemeral=True)
+        return
+    text, author = search
+    # keyset pagination: the page before or after the message id on the current page
+    page = await quote_index.search(interaction.guild_id, text, author, **{direction: int(messageid)})
+    embed, view = search_results(int(key), text, author, page)
+    await interaction.response.edit_message(embed=embed, view=view)
+
+def guess_embed(quote, revealed_by=None, image=None):
+    embed = discord.Embed(title='Guess the Quote', description=quote.content, color=0x00ff00)
+    embed.add_field(name='Who said that??', value=quote.author if revealed_by else ':eyes:', inline=True)
+    # Original message, built from what was stored with the quote
+    if quote.submitterName:
+        embed.set_author(name=f"Submitted by {quote.submitterName}", icon_url=quote.submitterAvatar)
+    if revealed_by:
+        jump_url = quote.jump_url(guild_configs.get(quote.guildid_id).quoteChannel)
+        if jump_url:
+            embed.add_field(name='Message Link', value=f'[Jump to Message]({jump_url})', inline=True)
+        embed.set_footer(text='Quote revealed by ' + revealed_by.name, icon_url=revealed_by.display_avatar.url)
+    if image:
+        embed.set_image(url=f'attachment://{image}')
+    return embed
+
+def guess_view(messageid, color, revealed=False):
+    # everything a click needs is in the custom ids, so the buttons keep working after a restart
+    buttons = []
+    if not revealed:
+        buttons.append(discord.ui.Button(label='Reveal', style=discord.ButtonStyle.primary, custom_id=components.custom_id('reveal', messageid, color)))
+    buttons.append(discord.ui.Button(label='Not a quote!', style=discord.ButtonStyle.danger, custom_id=components.custom_id('notquote', messageid)))
+    return components.view(*buttons)
+
 @bot.slash_command(name='guess', description='Start a guessing game', guild_ids=guild_ids)
 async def guess(ctx: discord.ApplicationContext):
-    await ctx.defer()
-    # Get a random quote from the database
-    quotes = Quote.select().where(Quote.guildid == ctx.guild.id)
-    if quotes.count() == 0:
+    # a prefetched round is picked and rendered already, so it's answered with a single response
+    guess_round = guess_rounds.pop(ctx.guild.id)
+    if guess_round is None:
+        await ctx.defer()
+        guess_round = await guess_rounds.build(ctx.guild.id)
+    guess_rounds.refill(ctx.guild.id)
+    if guess_round is None:
         await ctx.respond('No quotes found in the database.', ephemeral=True)
         return
-    quote = quotes.order_by(fn.RAND()).get()
+    quote = guess_round.quote
+    color = BACKGROUND_COLORS.index(guess_round.background_color)
+    # the revealed card waits in the session store until someone clicks Reveal
+    game_sessions.put(f'{quote.messageid}:{color}', GameSession(quote, guess_round.background_color, guess_round.revealed))
+    view = guess_view(quote.messageid, color)
     
-    # Create Images
-    background_color = random.choice(["#7289da", "#ed5555", "#43b581", "#f04747", "#faa61a", "#a3a3a3"])
-    path = create_quote_image(quote.content, background_color=background_color)
-    file = discord.File(path, filename=f'{ctx.channel_id}.png')
-    os.remove(path)
-    
-    # Create the embed
-    embed = discord.Embed(title='Guess the Quote', description=quote.content, color=0x00ff00)
-    embed.add_field(name='Who said that??', value=':eyes:', inline=True)
-    
-    # Get original message
-    guild = Guild.get_or_none(guildid=ctx.guild.id)
-    jump_url = None
-    if guild:
-        channel = bot.get_channel(guild.quoteChannel)
-        if channel:
-            try:
-                message = await channel.fetch_message(quote.messageid)
-                if message:
-                    embed.set_author(name=f"Submitted by {message.author.name}", icon_url=message.author.avatar.url)
-                    jump_url = message.jump_url
-            except discord.NotFound:
-                logger.error(f'Message not found: {quote.messageid} - {channel.name} - {channel.id}')
-    
-    # Create the view
-    view = discord.ui.View(timeout=120)
-    
-    # Add button to reveal the quote
-    revealButton = discord.ui.Button(label='Reveal', style=discord.ButtonStyle.primary)
-    async def button_callback(interaction):
-        # set the author
-        embed.set_field_at(0, name='Who said that??', value=quote.author, inline=True)
-        
-        # set the jump url
-        if jump_url:
-            embed.add_field(name='Message Link', value=f'[Jump to Message]({message.jump_url})', inline=True)
-        
-        # create the image with the author
-        path = create_quote_image(quote.content, quote.author, background_color=background_color)
-        file = discord.File(path, filename=f'{ctx.channel_id}-2.png')
-        os.remove(path)
-        
-        embed.set_image(url=f'attachment://{ctx.channel_id}-2.png')
-        embed.set_footer(text='Quote revealed by ' + interaction.user.name, icon_url=interaction.user.avatar.url)
-        view.remove_item(revealButton)
-        await interaction.response.edit_message(embed=embed, file=file, view=view)
-    
-    revealButton.callback = button_callback
-    view.add_item(revealButton)
-    
-    # add button to delete the quote
-    deleteButton = discord.ui.Button(label='Not a quote!', style=discord.ButtonStyle.danger)
-    async def button_callback(interaction: discord.Interaction):
-        await interaction.delete_original_response()
-        await interaction.response.send_message('Deleting quote...', ephemeral=True)
-        Quote.delete().where(Quote.messageid == quote.messageid).execute()
-        await interaction.followup.send('Quote deleted', ephemeral=True)
-    deleteButton.callback = button_callback
-    view.add_item(deleteButton)
+    if guess_round.hidden:
+        filename = f'{ctx.channel_id}.{IMAGE_EXTENSION}'
+        file = discord.File(io.BytesIO(guess_round.hidden), filename=filename)
+        await ctx.respond(embed=guess_embed(quote, image=filename), file=file, view=view)
+    else:
+        # too many renders queued, play without the card instead of making everyone wait
+        logger.warning(f'Render queue full, sending quote without image: {ctx.guild.id}')
+        await ctx.respond(embed=guess_embed(quote), view=view)
+
+@components.handler('reveal')
+async def reveal_quote(interaction: discord.Interaction, messageid, color):
+    session = game_sessions.pop(f'{messageid}:{color}')
+    if session is None:
+        # evicted, expired or the bot restarted since the game started, the quote is read again
+        quote = await run_query(Quote.get_or_none, Quote.messageid == int(messageid))
+        if quote is None:
+            await interaction.response.send_message('This quote was deleted.', ephemeral=True)
+            return
+        session = GameSession(quote, BACKGROUND_COLORS[int(color) % len(BACKGROUND_COLORS)])
+    quote = session.quote
+    view = guess_view(quote.messageid, color, revealed=True)
+    filename = f'{interaction.channel_id}-2.{IMAGE_EXTENSION}'
+    if session.revealed:
+        # rendered with the round, so the reveal is a single response too
+        file = discord.File(io.BytesIO(session.revealed), filename=filename)
+        await interaction.response.edit_message(embed=guess_embed(quote, interaction.user, filename), file=file, attachments=[], view=view)
+        return
+    await interaction.response.defer()
     
-    embed.set_image(url=f'attachment://{ctx.channel_id}.png')
-    await ctx.respond(embed=embed, file=file, view=view)
+    # the render queue was full when the round was built, or the session is gone
+    try:
+        image = await render_quote_image(quote.content, quote.author, background_color=session.background_color)
+    except RenderBusy:
+        logger.warning(f'Render queue full, revealing quote without image: {interaction.guild_id}')
+        await interaction.edit_original_response(embed=guess_embed(quote, interaction.user), attachments=[], view=view)
+        return
+    file = discord.File(image, filename=filename)
+    await interaction.edit_original_response(embed=guess_embed(quote, interaction.user, filename), file=file, attachments=[], view=view)
+
+@components.handler('notquote')
+async def not_a_quote(interaction: discord.Interaction, messageid):
+    await interaction.delete_original_response()
+    await interaction.response.send_message('Deleting quote...', ephemeral=True)
+    await run_query(lambda: Quote.delete().where(Quote.messageid == int(messageid)).execute())
+    quote_sampler.remove(interaction.guild_id, int(messageid))
+    await interaction.followup.send('Quote deleted', ephemeral=True)
+
+@bot.listen('on_interaction')
+async def route_components(interaction: discord.Interaction):
+    # the library still handles slash commands, this only picks up our buttons
+    await components.dispatch(interaction)
     
 @bot.slash_command(name='guildinfo', description='Get information about the guild', guild_ids=guild_ids)
 async def guild_info(ctx):
-    guild, _ = Guild.get_or_create(guildid=ctx.guild.id)
+    guild, _ = await run_query(Guild.get_or_create, guildid=ctx.guild.id)
     embed = discord.Embed(title='Guild Info', description=f'Information about the guild {ctx.guild.name}', color=0x00ff00)
     embed.add_field(name='Guild ID', value=guild.guildid, inline=False)
     embed.add_field(name='Quote Channel', value=guild.quoteChannel, inline=False)
-    embed.add_field(name='Quote Regex', value=guild.quoteRegex, inline=False)
+    quote_regex = guild.quoteRegex
+    if quote_regex and guild.quoteRegexDisabled:
+        quote_regex = f'{quote_regex} (disabled: timed out repeatedly, set it again with /setquoteregex)'
+    embed.add_field(name='Quote Regex', value=quote_regex, inline=False)
     embed.add_field(name='Quotes Processed Until', value=guild.quotesProcessedUntil, inline=False)
-    embed.add_field(name='Quotes Processed', value=Quote.select().where(Quote.guildid == guild).count(), inline=False)
+    if guild.quotesProcessedUntil is not None:
+        history = 'complete' if guild.scannedFrom == 0 else 'partly, `/scan` without a limit imports older messages'
+        embed.add_field(name='Channel History Scanned', value=history, inline=False)
+    quote_count = await run_query(lambda: Quote.select().where(Quote.guildid == guild).count())
+    embed.add_field(name='Quotes Processed', value=quote_count, inline=False)
     await ctx.respond(embed=embed)
 
-bot.run(os.getenv('DISCORD_TOKEN')) # run the bot with the token
\ No newline at end of file
+def format_latency(summary, limit=8):
+    # busiest first: "name: count x avg / p95"
+    rows = sorted(summary.items(), key=lambda item: item[1][0], reverse=True)[:limit]
+    lines = [f'`{" ".join(labels) or "all"}`: {count}x {avg * 1000:.0f}ms avg / {p95 * 1000:.0f}ms p95' for labels, (count, avg, p95) in rows]
+    return '\n'.join(lines) or 'No data yet'
+
+@bot.slash_command(name='botstats', description='Show latency and load statistics of the bot', guild_ids=guild_ids)
+@commands.has_permissions(manage_guild=True)
+async def bot_stats(ctx):
+    embed = discord.Embed(title='Bot Stats', color=0x00ff00)
+    embed.add_field(name='Commands', value=format_latency(metrics.command_latency.summary()), inline=False)
+    embed.add_field(name='Events', value=format_latency(metrics.event_latency.summary(), 5), inline=False)
+    embed.add_field(name='Discord API', value=f'{metrics.api_calls.total()} calls, {metrics.api_rate_limited.total()} rate limited\n' + format_latency(metrics.api_latency.summary(), 5), inline=False)
+    embed.add_field(name='Database', value=format_latency(metrics.db_latency.summary(), 5) + f'\n{db_stats.snapshot()}', inline=False)
+    embed.add_field(name='Rendering', value=format_latency(metrics.render_latency.summary()) + f' - {render_stats.rejected} rejected', inline=False)
+    embed.add_field(name='Caches', value=f'Guild configs: {guild_configs.stats()}\nMessages: {message_cache.stats()}\nReactions: {reaction_scheduler.stats()}\nSearch: {quote_index.stats()}', inline=False)
+    shards = [f'`{shard}`: ' + ('up' if health['up'] else 'down') + (f', {health["latency"] * 1000:.0f}ms' if health['latency'] is not None else '') + f', {health["guilds"]} guilds'
+              for shard, health in sorted(shard_health(bot).items())]
+    embed.add_field(name=f'Shards ({local_shards})', value='\n'.join(shards[:20]) or 'Not connected', inline=False)
+    await ctx.respond(embed=embed, ephemeral=True)
+
+# importing the module only sets up the bot (e.g. for benchmarks/loadtest.py), running it starts it
+if __name__ == '__main__':
+    start_render_pool() # fork the render workers before the event loop and db threads exist
+    bot.run(os.getenv('DISCORD_TOKEN')) # run the bot with the token
\ No newline at end of file
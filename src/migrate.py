@@ -0,0 +1,7 @@
+# Applies pending database migrations. Run once per deploy, before starting the bot.
+from util.migrations import run_migrations
+from util.logger import logger
+
+if __name__ == "__main__":
+    applied = run_migrations()
+    logger.info(f'Applied migrations: {applied}' if applied else 'No migrations to apply')
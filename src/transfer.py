@@ -0,0 +1,51 @@
+"""
+Exports a guild's quotes to JSON lines or CSV and imports such a file, e.g. to move quotes between deployments
+without rescanning the channel. Both stream, so memory stays the same however many quotes there are.
+
+    python src/transfer.py export <guild id> -o quotes.jsonl
+    python src/transfer.py export <guild id> --format csv > quotes.csv
+    python src/transfer.py import quotes.jsonl [--guild <guild id>]
+
+The format follows the file extension unless --format is given. Import while the bot is stopped,
+a running bot only learns about the imported quotes after a restart.
+"""
+import argparse
+import sys
+import time
+from util.transfer import iter_quotes, read_quotes, import_quotes, QuoteWriter, FORMATS
+
+def file_format(path, format):
+    if format:
+        return format
+    extension = path.rsplit('.', 1)[-1].lower() if path and path != '-' else ''
+    return extension if extension in FORMATS else 'jsonl'
+
+def main():
+    parser = argparse.ArgumentParser(description="Export or import a guild's quotes.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    export = commands.add_parser('export', help='write the quotes of a guild to a file')
+    export.add_argument('guild', type=int, help='the guild id')
+    export.add_argument('-o', '--output', default='-', help='the file to write, default stdout')
+    export.add_argument('--format', choices=FORMATS)
+    load = commands.add_parser('import', help='store the quotes of an exported file')
+    load.add_argument('file', help='the file to read, - for stdin')
+    load.add_argument('--format', choices=FORMATS)
+    load.add_argument('--guild', type=int, help='import into this guild instead of the exported one')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == 'export':
+        file = sys.stdout if args.output == '-' else open(args.output, 'w', encoding='utf-8', newline='')
+        with file:
+            writer = QuoteWriter(file, file_format(args.output, args.format))
+            for quote in iter_quotes(args.guild):
+                writer.write(quote)
+        print(f'Exported {writer.count} quotes in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+    else:
+        file = sys.stdin if args.file == '-' else open(args.file, encoding='utf-8', newline='')
+        with file:
+            counts = import_quotes(read_quotes(file, file_format(args.file, args.format)), args.guild)
+        print(f'Imported {sum(counts.values())} quotes into {len(counts)} guilds in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
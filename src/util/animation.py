@@ -0,0 +1,111 @@
+from PIL import Image, ImageSequence
+import math
+import io
+import os
+from util.logger import logger
+
+GIF_MAX_FRAMES = int(os.getenv("QUOTE_GIF_MAX_FRAMES", 40)) # background frames kept, evenly spaced over the animation
+GIF_MAX_BYTES = int(os.getenv("QUOTE_GIF_MAX_BYTES", 8 * 1024 * 1024)) # cards above this drop every other frame, Discord allows 10MB
+RAMP_COLORS = 32 # palette entries between the card and text color, for anti-aliased text
+TRANSPARENT = 255 # palette index of the card area in every frame after the first
+
+def _blend(start, end, steps):
+    return [tuple(round(a + (b - a) * step / (steps - 1)) for a, b in zip(start, end)) for step in range(steps)]
+
+class AnimatedBackground:
+    """
+    The frames of an animated background, decoded once, scaled to cover the largest card and mapped to one
+    palette that also holds the card's colors. A card is then quantized once and pasted on the first frame,
+    the other frames leave the card area transparent, so it is neither composited nor encoded again per frame.
+    """
+    def __init__(self, path, width, height, foreground, max_frames=GIF_MAX_FRAMES):
+        self.path = path
+        self.width = width
+        self.height = height # the tallest card, shorter ones are cut from the middle
+        self.foreground = foreground # (card color, text color) as RGB tuples
+        self.max_frames = max_frames
+        self.frames = None
+        self.durations = None
+        self.palette = None
+
+    def load(self):
+        """
+        Decodes and prepares the frames, call it before render workers are forked so they share them.
+        """
+        if self.frames is not None:
+            return self
+        with Image.open(self.path) as gif:
+            frames, durations = [], []
+            for frame in ImageSequence.Iterator(gif):
+                durations.append(frame.info.get('duration', 100))
+                frames.append(frame.convert('RGB'))
+        # evenly spaced frames, each shown for as long as the ones it replaces
+        step = max(1, math.ceil(len(frames) / self.max_frames))
+        durations = [sum(durations[start:start + step]) for start in range(0, len(frames), step)]
+        frames = frames[::step]
+
+        # one palette: the background's colors, a ramp from the card to the text color and the transparent index,
+        # which repeats the card color so quantizing never picks it
+        card, text = self.foreground
+        montage = Image.new('RGB', (frames[0].width, frames[0].height * len(frames)))
+        for index, frame in enumerate(frames):
+            montage.paste(frame, (0, frame.height * index))
+        colors = montage.quantize(TRANSPARENT - RAMP_COLORS, method=Image.Quantize.MEDIANCUT).getpalette()
+        colors = colors[:(TRANSPARENT - RAMP_COLORS) * 3]
+        colors += [0] * ((TRANSPARENT - RAMP_COLORS) * 3 - len(colors))
+        for color in _blend(card, text, RAMP_COLORS) + [card]:
+            colors.extend(color)
+        self.palette = Image.new('P', (1, 1))
+        self.palette.putpalette(colors)
+
+        # scale to cover the card, cropped around the center
+        scale = max(self.width / frames[0].width, self.height / frames[0].height)
+        size = (math.ceil(frames[0].width * scale), math.ceil(frames[0].height * scale))
+        left, top = (size[0] - self.width) // 2, (size[1] - self.height) // 2
+        self.frames = [
+            frame.resize(size, Image.BICUBIC).crop((left, top, left + self.width, top + self.height))
+            .quantize(palette=self.palette, dither=Image.Dither.NONE)
+            for frame in frames
+        ]
+        self.durations = durations
+        logger.info(f'Loaded {len(self.frames)} background frames from {os.path.basename(self.path)}')
+        return self
+
+    def render(self, card, mask, max_bytes=GIF_MAX_BYTES):
+        """
+        Puts a card on the background.
+
+        Args:
+            card (PIL.Image.Image): The card as drawn for a still image, `self.width` wide.
+            mask (PIL.Image.Image): Where the card covers the background, an "L" image of the card's size.
+            max_bytes (int, optional): GIFs above this are encoded again with every other frame.
+
+        Returns:
+            io.BytesIO: The encoded GIF.
+        """
+        self.load()
+        top = (self.height - card.height) // 2
+        box = (0, top, self.width, top + card.height)
+        overlay = card.quantize(palette=self.palette, dither=Image.Dither.NONE)
+        frames = []
+        for index, background in enumerate(self.frames):
+            frame = background.crop(box)
+            frame.paste(overlay if index == 0 else TRANSPARENT, (0, 0, card.width, card.height), mask)
+            frames.append(frame)
+        step = 1
+        while True:
+            durations = [sum(self.durations[start:start + step]) for start in range(0, len(frames), step)]
+            buffer = self._encode(frames[::step], durations)
+            if buffer.getbuffer().nbytes <= max_bytes or len(durations) == 1:
+                break
+            step *= 2
+            logger.warning(f'Animated card is {buffer.getbuffer().nbytes} bytes, encoding every {step}. frame')
+        return buffer
+
+    def _encode(self, frames, durations):
+        buffer = io.BytesIO()
+        # disposal 1 keeps the previous frame, so the card drawn by the first one shows through the transparent area
+        frames[0].save(buffer, format='GIF', save_all=True, append_images=frames[1:], duration=durations,
+                       loop=0, disposal=1, transparency=TRANSPARENT, optimize=False)
+        buffer.seek(0)
+        return buffer
@@ -0,0 +1,104 @@
+from collections import deque
+import asyncio
+import discord
+import os
+from util.reactions import channel_limiter, reaction_scheduler, QUOTE_REACTION
+from util.logger import logger
+
+CLEAR_CONCURRENCY = int(os.getenv("CLEAR_CONCURRENCY", 4)) # reactions removed in parallel (across channels)
+CLEAR_PROGRESS_INTERVAL = 5 # seconds between progress updates
+
+class ClearJob:
+    """
+    Removes the bot's checkmark from the messages of cleared quotes in the background.
+    The quotes themselves are already deleted when the job starts. Workers share the channel rate limiter
+    with the reaction scheduler. A cancelled job keeps its remaining messages and can be resumed.
+    """
+    def __init__(self, bot: discord.Bot, guild_id: int, targets):
+        self.bot = bot
+        self.guild_id = guild_id
+        self.remaining = deque(targets) # (message id, channel id)
+        self.total = len(self.remaining)
+        self.done = 0
+        self.failed = 0
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    @property
+    def finished(self):
+        return self.done + self.failed >= self.total
+
+    def progress(self):
+        return f'Removing reactions: {self.done + self.failed}/{self.total}' + (f' ({self.failed} failed)' if self.failed else '')
+
+    async def _remove(self, message_id, channel_id):
+        await channel_limiter.wait(channel_id)
+        message = self.bot.get_partial_messageable(channel_id).get_partial_message(message_id)
+        try:
+            await message.remove_reaction(QUOTE_REACTION, self.bot.user)
+            self.done += 1
+        except discord.NotFound:
+            # message deleted, nothing to clean up
+            self.done += 1
+        except discord.HTTPException as e:
+            self.failed += 1
+            logger.error(f'Error removing reaction from message: {message_id} - {e}')
+        reaction_scheduler.forget(message_id)
+
+    async def _worker(self):
+        while self.remaining:
+            message_id, channel_id = self.remaining.popleft()
+            try:
+                await self._remove(message_id, channel_id)
+            except asyncio.CancelledError:
+                # not finished, so it's picked up again on resume
+                self.remaining.appendleft((message_id, channel_id))
+                raise
+
+    async def _progress(self, on_progress):
+        # returns the callback, or None once posting failed
+        if on_progress:
+            try:
+                await on_progress(self)
+            except discord.HTTPException as e:
+                # e.g. the interaction token expired, the job itself keeps going
+                logger.warning(f'Could not post clear progress: {e}')
+                return None
+        return on_progress
+
+    async def _run(self, on_progress):
+        workers = [asyncio.create_task(self._worker()) for _ in range(min(CLEAR_CONCURRENCY, len(self.remaining)))]
+        try:
+            while workers:
+                await asyncio.wait(workers, timeout=CLEAR_PROGRESS_INTERVAL)
+                if all(worker.done() for worker in workers):
+                    break
+                on_progress = await self._progress(on_progress)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+        # also when there was nothing to clear, the response waits for this
+        await self._progress(on_progress)
+        logger.info(f'Clear job of guild {self.guild_id} finished: {self.done} removed, {self.failed} failed')
+
+    def start(self, on_progress=None):
+        """
+        Starts (or resumes) the job. `on_progress` is awaited with the job every few seconds and at the end.
+        """
+        if not self.running:
+            self._task = asyncio.create_task(self._run(on_progress))
+        return self._task
+
+    async def cancel(self):
+        """
+        Stops the job and waits until its workers put back what they were working on, so it can be resumed.
+        """
+        if self.running:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+clear_jobs = {} # guild id -> ClearJob
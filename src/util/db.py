@@ -1,37 +1,194 @@
 from peewee import *
+from playhouse.pool import PooledMySQLDatabase
+from playhouse.db_url import connect as connect_url
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from util.metrics import instrument_database
+import threading
+import asyncio
 import os
 
 load_dotenv()
 
-db = MySQLDatabase(
-    'quotr_bot',
-    user=os.getenv("MYSQL_USER"),
-    password=os.getenv("MYSQL_PASSWORD"),
-    host=os.getenv("MYSQL_HOST"),
-    port=3306,
-)
+DB_MAX_WORKERS = int(os.getenv("DB_MAX_WORKERS", 4)) # threads (and pooled connections) used for queries
+DB_QUERY_TIMEOUT = float(os.getenv("DB_QUERY_TIMEOUT", 10)) # seconds a single query may take
+
+# Nothing connects at import time. The database is chosen here and connected on the first query,
+# the schema is managed by `util.migrations` (run `python src/migrate.py` on deploy).
+db = DatabaseProxy()
+
+def create_database():
+    # DATABASE_URL (e.g. sqlite:///quotr.db) replaces the MySQL settings, handy for local runs and benchmarks
+    if os.getenv("DATABASE_URL"):
+        return connect_url(os.getenv("DATABASE_URL"))
+    return PooledMySQLDatabase(
+        'quotr_bot',
+        user=os.getenv("MYSQL_USER"),
+        password=os.getenv("MYSQL_PASSWORD"),
+        host=os.getenv("MYSQL_HOST"),
+        port=3306,
+        max_connections=DB_MAX_WORKERS,
+        stale_timeout=300,
+        timeout=DB_QUERY_TIMEOUT, # wait for a free pooled connection
+        connect_timeout=DB_QUERY_TIMEOUT,
+        read_timeout=DB_QUERY_TIMEOUT,
+        write_timeout=DB_QUERY_TIMEOUT,
+    )
+
+def init_database(database=None):
+    """
+    Points the models at a database, by default the one configured in the environment.
+    """
+    database = database or create_database()
+    instrument_database(database, (Guild, Quote))
+    db.initialize(database)
+    return database
 
 class Guild(Model):
-    guildid = IntegerField(primary_key=True)
-    quoteChannel = IntegerField(null=True)
+    # discord snowflakes are 64 bit
+    guildid = BigIntegerField(primary_key=True)
+    quoteChannel = BigIntegerField(null=True)
     quoteRegex = TextField(null=True)
-    quotesProcessedUntil = DateTimeField(default=0)
-    
+    quoteRegexReverse = BooleanField(default=False)
+    quoteRegexDisabled = BooleanField(default=False) # set after the custom regex timed out repeatedly
+    quotesProcessedUntil = DateTimeField(null=True) # newest scanned message, None if never scanned
+    scannedFrom = BigIntegerField(null=True) # oldest scanned message, 0 once the start of the channel was reached
+
     class Meta:
         database = db
         table_name = 'guilds'
-        
+
 class Quote(Model):
-    messageid = IntegerField(primary_key=True)
+    messageid = BigIntegerField(primary_key=True)
     guildid = ForeignKeyField(Guild, backref='quotes')
-    author = IntegerField()
+    author = CharField(max_length=255) # the name from the quote text, not a user id
     content = TextField()
-    
+    # where the quote was posted and by whom, so links and headers need no API call
+    channelid = BigIntegerField(null=True)
+    submitterid = BigIntegerField(null=True)
+    submitterName = CharField(max_length=100, null=True)
+    submitterAvatar = CharField(max_length=255, null=True)
+    sourceHash = CharField(max_length=32, null=True) # hash of the message text, edits that don't change it are skipped
+    contentHash = CharField(max_length=32, null=True) # hash of the normalized quote and author, reposts of a quote are duplicates
+
     class Meta:
         database = db
         table_name = 'quotes'
+        indexes = (
+            (('guildid', 'messageid'), False), # a guild's quote ids (sampler, clear, export)
+            (('guildid', 'author'), False), # a guild's quotes by author
+            (('guildid', 'contentHash'), False), # duplicate lookups
+        )
+
+    def jump_url(self, channel_id=None):
+        channel_id = self.channelid or channel_id
+        if not channel_id:
+            return None
+        return f'https://discord.com/channels/{self.guildid_id}/{channel_id}/{self.messageid}'
+
+
+class DBStats:
+    """
+    Counters for the query executor. `queued` are queries waiting for a worker thread,
+    `in_flight` are queries currently running against the database.
+    """
+    def __init__(self):
+        self.queued = 0
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.reconnects = 0
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        # counters are touched from the event loop and the worker threads
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def snapshot(self):
+        return {
+            'queued': self.queued,
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'failed': self.failed,
+            'timed_out': self.timed_out,
+            'reconnects': self.reconnects,
+        }
+
+db_stats = DBStats()
+_executor = ThreadPoolExecutor(max_workers=DB_MAX_WORKERS, thread_name_prefix='quotr-db')
+
+def _connect():
+    try:
+        db.connect()
+    except (OperationalError, InterfaceError):
+        # the pool pings a connection before handing it out, so this failed before anything was sent
+        # (server restart, a refused connect) and is safe to retry once
+        db_stats.incr('reconnects')
+        db.connect()
+
+def _run_in_connection(func, args, kwargs):
+    db_stats.incr('queued', -1)
+    db_stats.incr('in_flight')
+    try:
+        _connect()
+        try:
+            return func(*args, **kwargs)
+        except (OperationalError, InterfaceError):
+            # the statement may have run before the connection died, so it is not retried,
+            # but the connection is dropped instead of going back to the pool
+            getattr(db.obj, 'manual_close', db.close)()
+            raise
+        finally:
+            if not db.is_closed():
+                db.close()
+    finally:
+        db_stats.incr('in_flight', -1)
+
+async def run_query(func, *args, timeout=None, **kwargs):
+    """
+    Runs a blocking peewee call on the database executor, so the event loop never waits on MySQL.
+
+    Args:
+        func (callable): The function to run, e.g. `Guild.get_or_create` or a lambda building a query.
+        *args: Positional arguments for `func`.
+        timeout (float, optional): Seconds to wait for the result. Defaults to `DB_QUERY_TIMEOUT`.
+        **kwargs: Keyword arguments for `func`.
+
+    Returns:
+        The return value of `func`.
+
+    Raises:
+        asyncio.TimeoutError: If the query did not finish within the timeout. A query that already reached
+            the database keeps running and may still commit, so don't repeat a write after a timeout.
+    """
+    db_stats.incr('queued')
+    future = _executor.submit(_run_in_connection, func, args, kwargs)
+    try:
+        result = await asyncio.wait_for(asyncio.wrap_future(future), timeout or DB_QUERY_TIMEOUT)
+    except asyncio.TimeoutError:
+        if future.cancelled():
+            # never reached a worker, so it is still counted as queued
+            db_stats.incr('queued', -1)
+        db_stats.incr('timed_out')
+        raise
+    except Exception:
+        db_stats.incr('failed')
+        raise
+    db_stats.incr('completed')
+    return result
+
+
+def upsert_many(model, rows, preserve, fields=None):
+    """
+    Builds one multi-row INSERT that updates the `preserve` columns of rows whose primary key already exists.
+    Run it with `run_query(query.execute)`. Rows are dicts, or tuples in the order of `fields`.
+    """
+    query = model.insert_many(rows, fields=fields)
+    if isinstance(db.obj, MySQLDatabase):
+        return query.on_conflict(preserve=preserve)
+    # sqlite and postgres need to be told which constraint the conflict is on
+    return query.on_conflict(conflict_target=[model._meta.primary_key], preserve=preserve)
 
-    
-db.connect()
-db.create_tables([Guild, Quote], safe=True)
\ No newline at end of file
+init_database()
@@ -0,0 +1,72 @@
+import asyncio
+import os
+from util.reactions import TimerWheel
+from util.logger import logger
+
+EDIT_DEBOUNCE = float(os.getenv("EDIT_DEBOUNCE", 2.0)) # seconds edit and delete events of a message are collected before processing
+
+class MessageDebouncer:
+    """
+    Collects the edit and delete events of a message for `EDIT_DEBOUNCE` seconds after the first one
+    and then processes only the final state: the last edit, or the delete if the message is gone.
+    Discord sends several edits for one user edit (link embeds, quick fixes), which used to be processed one by one.
+
+    `on_edit(event, before)` gets the last edit event and the message content from before the first edit (if known)
+    and returns False if the message turned out unchanged, `on_delete(event)` gets the delete event.
+    """
+    def __init__(self, on_edit, on_delete, delay=EDIT_DEBOUNCE):
+        self.on_edit = on_edit
+        self.on_delete = on_delete
+        self.delay = delay
+        self.timers = TimerWheel(tick=0.25)
+        self._pending = {} # message id -> [kind, last event, content before the first edit]
+        self._running = set() # message ids being processed right now
+        self.events = 0
+        self.processed = 0
+        self.unchanged = 0
+
+    def edit(self, message_id, event, before=None):
+        self._add(message_id, 'edit', event, before)
+
+    def delete(self, message_id, event):
+        self._add(message_id, 'delete', event, None)
+
+    def _add(self, message_id, kind, event, before):
+        self.events += 1
+        entry = self._pending.get(message_id)
+        if entry is not None:
+            # a delete is final, nothing after it can bring the message back
+            if entry[0] != 'delete':
+                entry[0], entry[1] = kind, event
+            return
+        self._pending[message_id] = [kind, event, before]
+        self.timers.schedule(self.delay, self._due, message_id)
+
+    def cancel(self, message_ids):
+        for message_id in message_ids:
+            self._pending.pop(message_id, None)
+
+    def _due(self, message_id):
+        if message_id in self._running:
+            # still busy with the previous state of this message, look again later
+            self.timers.schedule(self.delay, self._due, message_id)
+            return
+        entry = self._pending.pop(message_id, None)
+        if entry is not None:
+            asyncio.create_task(self._process(message_id, *entry))
+
+    async def _process(self, message_id, kind, event, before):
+        self._running.add(message_id)
+        try:
+            if kind == 'delete':
+                await self.on_delete(event)
+            elif await self.on_edit(event, before) is False:
+                self.unchanged += 1
+            self.processed += 1
+        except Exception as e:
+            logger.error(f'Error processing {kind} of message {message_id}: {e}')
+        finally:
+            self._running.discard(message_id)
+
+    def stats(self):
+        return {'events': self.events, 'processed': self.processed, 'unchanged': self.unchanged, 'pending': len(self._pending)}
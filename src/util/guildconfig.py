@@ -0,0 +1,125 @@
+import asyncio
+from util.db import Guild, run_query
+from util.logger import logger
+from util.regexes import get_extractor, drop_extractor
+from util.sharding import local_shards
+
+LOAD_RETRY_MAX_DELAY = 60 # seconds between attempts to load the configuration while the database is down
+
+class GuildConfig:
+    """
+    The parts of a guild row that are needed on every message, kept in memory.
+    """
+    __slots__ = ('guildid', 'quoteChannel', 'quoteRegex', 'quoteRegexReverse', 'quoteRegexDisabled')
+
+    def __init__(self, guildid, quoteChannel=None, quoteRegex=None, quoteRegexReverse=False, quoteRegexDisabled=False):
+        self.guildid = guildid
+        self.quoteChannel = quoteChannel
+        self.quoteRegex = quoteRegex
+        self.quoteRegexReverse = quoteRegexReverse
+        self.quoteRegexDisabled = quoteRegexDisabled
+
+    @classmethod
+    def from_row(cls, guild: Guild):
+        return cls(guild.guildid, guild.quoteChannel, guild.quoteRegex, guild.quoteRegexReverse, guild.quoteRegexDisabled)
+
+    @property
+    def extractor(self):
+        # compiled once and rebuilt only when the guild's regex changes
+        return get_extractor(self.guildid, self.quoteRegex, self.quoteRegexReverse)
+
+class GuildConfigCache:
+    """
+    Write-through cache of every guild's configuration.
+    Loaded once at startup, then kept in sync by the commands and events that change a guild.
+    A sharded process only holds the guilds of its own shards, the others never send it events.
+    """
+    def __init__(self, shards=local_shards):
+        self.shards = shards
+        self._configs = {}
+        self._removed = set() # guilds removed before the configuration was loaded
+        self.loaded = False
+        self._loading = None
+        self.hits = 0
+        self.misses = 0
+
+    async def load(self):
+        rows = await run_query(lambda: list(Guild.select()))
+        configs = {row.guildid: GuildConfig.from_row(row) for row in rows if self.shards.owns(row.guildid)}
+        # guilds changed by update(), add() or remove() while the rows were read are newer than the rows
+        for guild_id in self._removed:
+            configs.pop(guild_id, None)
+        configs.update(self._configs)
+        self._configs = configs
+        self._removed.clear()
+        self.loaded = True
+        logger.info(f'Loaded configuration for {len(self._configs)} guilds ({self.shards})')
+
+    def start_loading(self):
+        """
+        Loads the configuration in the background, retrying with backoff until the database answers.
+        Messages are ignored until then, so giving up isn't an option. Safe to call again while it runs.
+        """
+        if not self.loaded and (self._loading is None or self._loading.done()):
+            self._loading = asyncio.create_task(self._load_until_loaded())
+        return self._loading
+
+    async def _load_until_loaded(self):
+        delay = 1
+        while not self.loaded:
+            try:
+                await self.load()
+            except Exception as e:
+                logger.error(f'Could not load the guild configuration, retrying in {delay}s: {e}')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, LOAD_RETRY_MAX_DELAY)
+
+    def get(self, guild_id: int) -> GuildConfig:
+        """
+        Returns the cached configuration of a guild without any I/O.
+        Unknown guilds get an empty configuration (no quote channel).
+        """
+        config = self._configs.get(guild_id)
+        if config is not None:
+            self.hits += 1
+            return config
+        self.misses += 1
+        config = GuildConfig(guild_id)
+        if self.loaded:
+            # the guild has no row yet, remember that until it gets configured
+            self._configs[guild_id] = config
+        return config
+
+    def is_quote_channel(self, guild_id: int, channel_id: int) -> bool:
+        return self.get(guild_id).quoteChannel == channel_id
+
+    async def update(self, guild_id: int, **fields) -> GuildConfig:
+        """
+        Writes the given fields to the database, then to the cache.
+        """
+        def write():
+            guild, _ = Guild.get_or_create(guildid=guild_id)
+            for name, value in fields.items():
+                setattr(guild, name, value)
+            guild.save()
+            return guild
+        guild = await run_query(write)
+        config = GuildConfig.from_row(guild)
+        self._configs[guild_id] = config
+        return config
+
+    async def add(self, guild_id: int):
+        guild, _ = await run_query(Guild.get_or_create, guildid=guild_id)
+        self._configs[guild_id] = GuildConfig.from_row(guild)
+
+    async def remove(self, guild_id: int):
+        await run_query(lambda: Guild.delete().where(Guild.guildid == guild_id).execute())
+        self._configs.pop(guild_id, None)
+        if not self.loaded:
+            self._removed.add(guild_id)
+        drop_extractor(guild_id)
+
+    def stats(self):
+        return {'guilds': len(self._configs), 'hits': self.hits, 'misses': self.misses}
+
+guild_configs = GuildConfigCache()
@@ -1,32 +1,75 @@
-from PIL import Image, ImageDraw, ImageFont
-import textwrap
+from PIL import Image, ImageDraw, ImageColor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
 import asyncio
+import time
+import io
+import os
+from util.layout import ASSETS_DIR, QUOTE_FONT_SIZES, QUOTE_MAX_LINES, font_chain, fit_text, truncate, draw_runs
+from util.animation import AnimatedBackground
+from util.logger import worker_logging
+from util.metrics import render_latency, render_queue_wait
 
-def create_quote_image(quote, author=None, background_color="#7289da"):
+IMAGE_FORMAT = os.getenv("QUOTE_IMAGE_FORMAT", "png").lower() # png, webp or gif (animated background)
+PNG_COMPRESS_LEVEL = int(os.getenv("QUOTE_IMAGE_COMPRESS_LEVEL", 6)) # 0 (fast, big) to 9 (slow, small)
+WEBP_QUALITY = int(os.getenv("QUOTE_IMAGE_WEBP_QUALITY", 90))
+IMAGE_EXTENSION = IMAGE_FORMAT if IMAGE_FORMAT in ('webp', 'gif') else 'png'
+RENDER_EXECUTOR = os.getenv("RENDER_EXECUTOR", "process").lower() # process or thread
+RENDER_WORKERS = int(os.getenv("RENDER_WORKERS", 2))
+RENDER_QUEUE_SIZE = int(os.getenv("RENDER_QUEUE_SIZE", 8)) # renders waiting or running before new ones are refused
+CARD_COLOR = "#1e2124"
+TEXT_COLOR = "#ffffff"
+
+def _card_height(lines, size):
+    # the rounded rectangle: the quote's lines, the author line and the padding around them
+    line_spacing = round(15 * size / 24)
+    return lines * (size + line_spacing) - line_spacing + 24 + 15 + 10 + 30 * 2
+
+# animated cards cut their background from frames as high as the tallest card
+animated_background = AnimatedBackground(
+    os.path.join(ASSETS_DIR, 'background.gif'), 800, max(_card_height(QUOTE_MAX_LINES, size) for size in QUOTE_FONT_SIZES) + 50 * 2,
+    (ImageColor.getrgb(CARD_COLOR), ImageColor.getrgb(TEXT_COLOR)),
+)
+
+def encode_image(image, image_format=None):
+    """
+    Encodes an image into an in-memory buffer, ready to be passed to `discord.File`.
+    """
+    buffer = io.BytesIO()
+    if (image_format or IMAGE_FORMAT) == 'webp':
+        image.save(buffer, format='WEBP', quality=WEBP_QUALITY, method=4)
+    else:
+        image.save(buffer, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+    buffer.seek(0)
+    return buffer
+
+def create_quote_image(quote, author=None, background_color="#7289da", image_format=None):
+    """
+    Renders a quote card. The quote is wrapped by pixel width and shrunk if it is very long,
+    the layout is cached, so rendering the same quote again (e.g. for Reveal) only draws.
+    As a gif the card is put on the animated background instead of `background_color`.
+
+    Returns:
+        io.BytesIO: The encoded image (see `IMAGE_EXTENSION` for the file type).
+    """
     # Padding variables
     padding = 50
     text_padding = 30
-    line_spacing = 15
-    
-    # Fonts
-    bold_font = ImageFont.truetype("assets/ggsans-Bold.ttf", 24)
-    regular_font = ImageFont.truetype("assets/ggsans-Normal.ttf", 24)
-    text_color = "#ffffff"
+    image_width = 800
+    text_width = image_width - 2 * (padding + text_padding)
+    text_color = TEXT_COLOR
     
-    # Calculate text dimensions
-    wrapped_text = []
-    for line in quote.splitlines():
-        wrapped_line = textwrap.fill(line, width=60)
-        wrapped_text.append(wrapped_line)
-    text_height = len(wrapped_text) * bold_font.size + (len(wrapped_text) - 1) * line_spacing
-        
-    author_text = f"- {author if author else '?'}"
-    author_height = regular_font.size + line_spacing + 10
-    total_height = text_height + author_height + text_padding * 2
+    # Lay out the text, the card is exactly as high as its lines
+    layout = fit_text(quote, "ggsans-Bold.ttf", text_width)
+    quote_font = font_chain("ggsans-Bold.ttf", layout.size)
+    line_spacing = round(15 * layout.size / 24)
+    total_height = _card_height(len(layout.lines), layout.size)
     
+    author_font = font_chain("ggsans-Normal.ttf", 24)
+    author_text = truncate(author_font, f"- {author if author else '?'}", text_width)
+    author_layout = author_font.runs(author_text)
     
     # Create the image
-    image_width = 800
     image_height = total_height + padding * 2
     image = Image.new("RGB", (image_width, image_height), background_color)
     draw = ImageDraw.Draw(image)
@@ -36,29 +79,133 @@ def create_quote_image(quote, author=None, background_color="#7289da"):
     rect_y0 = padding
     rect_x1 = image_width - padding
     rect_y1 = rect_y0 + total_height
-    draw.rounded_rectangle([rect_x0, rect_y0, rect_x1, rect_y1], radius=20, fill="#1e2124")
+    draw.rounded_rectangle([rect_x0, rect_y0, rect_x1, rect_y1], radius=20, fill=CARD_COLOR)
     
     # Draw the quote text
     current_y = rect_y0 + text_padding
-    for line in wrapped_text:  # wrapped_text is now a list of lines
-        draw.text((rect_x0 + text_padding, current_y), line, font=bold_font, fill=text_color)
-        current_y += bold_font.size * len(line.splitlines()) + line_spacing
+    for runs in layout.lines:
+        draw_runs(image, draw, quote_font, runs, rect_x0 + text_padding, current_y, text_color)
+        current_y += layout.size + line_spacing
     
     # Draw the author text
-    author_x = rect_x1 - text_padding - regular_font.getlength(author_text)
-    author_y = current_y
-    draw.text((author_x, author_y), author_text, font=regular_font, fill=text_color)
-    
-    # Save the image
-    image_path = f"temp/quote_{int(asyncio.get_event_loop().time())}.png"
-    image.save(image_path)
-    return image_path
+    author_x = rect_x1 - text_padding - author_font.width(author_text)
+    draw_runs(image, draw, author_font, author_layout, author_x, current_y, text_color)
     
+    if (image_format or IMAGE_FORMAT) == 'gif':
+        # only the card is drawn per quote, the background frames are prepared once
+        mask = Image.new("L", image.size)
+        ImageDraw.Draw(mask).rounded_rectangle([rect_x0, rect_y0, rect_x1, rect_y1], radius=20, fill=255)
+        return animated_background.render(image, mask)
+    return encode_image(image, image_format)
+
+
+
+class RenderBusy(Exception):
+    """
+    Raised by `render_quote_image` when the render queue is full.
+    """
+
+class RenderStats:
+    def __init__(self):
+        self.rendered = 0
+        self.rejected = 0
+        self.failed = 0
+        self.pending = 0
+        self.queue_wait_total = 0.0
+        self.queue_wait_max = 0.0
+        self.render_time_total = 0.0
+        self.render_time_max = 0.0
+
+    def record(self, queue_wait, render_time):
+        render_queue_wait.observe(queue_wait)
+        render_latency.observe(render_time)
+        self.rendered += 1
+        self.queue_wait_total += queue_wait
+        self.queue_wait_max = max(self.queue_wait_max, queue_wait)
+        self.render_time_total += render_time
+        self.render_time_max = max(self.render_time_max, render_time)
+
+    def snapshot(self):
+        rendered = self.rendered or 1
+        return {
+            'rendered': self.rendered,
+            'rejected': self.rejected,
+            'failed': self.failed,
+            'pending': self.pending,
+            'queue_wait_avg': self.queue_wait_total / rendered,
+            'queue_wait_max': self.queue_wait_max,
+            'render_time_avg': self.render_time_total / rendered,
+            'render_time_max': self.render_time_max,
+        }
+
+render_stats = RenderStats()
+_render_executor = None
+
+def _render_job(submitted_at, args, kwargs):
+    # runs in the render worker; wall clock time so the wait can be measured across processes
+    started_at = time.time()
+    data = create_quote_image(*args, **kwargs).getvalue()
+    return data, started_at - submitted_at, time.time() - started_at
+
+def start_render_pool():
+    """
+    Creates the render executor. Call it before the event loop starts any threads (the log listener is the only one):
+    process workers are forked, so they inherit the already loaded fonts instead of re-importing the bot.
+    Their log records are sent back to the bot's log, see `worker_logging`.
+    """
+    global _render_executor
+    if _render_executor is not None:
+        return _render_executor
+    # fonts and glyph metrics, loaded before the workers are forked so they share them
+    font_chain("ggsans-Bold.ttf", 24)
+    font_chain("ggsans-Normal.ttf", 24)
+    if IMAGE_FORMAT == 'gif':
+        animated_background.load()
+    if RENDER_EXECUTOR == 'thread':
+        # Pillow releases the GIL while rasterizing and compressing
+        _render_executor = ThreadPoolExecutor(max_workers=RENDER_WORKERS, thread_name_prefix='quotr-render')
+    else:
+        context = multiprocessing.get_context('fork')
+        _render_executor = ProcessPoolExecutor(max_workers=RENDER_WORKERS, mp_context=context, initializer=worker_logging(context))
+        # workers are forked on the first submit, do that now rather than from the running bot
+        _render_executor.submit(os.getpid).result()
+    return _render_executor
+
+async def render_quote_image(quote, author=None, background_color="#7289da"):
+    """
+    Renders a quote card on the render executor without blocking the event loop.
+
+    Returns:
+        io.BytesIO: The encoded image (see `IMAGE_EXTENSION` for the file type).
+
+    Raises:
+        RenderBusy: If `RENDER_QUEUE_SIZE` renders are already waiting or running.
+    """
+    if render_stats.pending >= RENDER_QUEUE_SIZE:
+        render_stats.rejected += 1
+        raise RenderBusy()
+    executor = start_render_pool()
+    loop = asyncio.get_running_loop()
+    render_stats.pending += 1
+    try:
+        data, queue_wait, render_time = await loop.run_in_executor(
+            executor, _render_job, time.time(), (quote, author, background_color), {}
+        )
+    except Exception:
+        render_stats.failed += 1
+        raise
+    finally:
+        render_stats.pending -= 1
+    render_stats.record(queue_wait, render_time)
+    return io.BytesIO(data)
+
 
 if __name__ == "__main__":
     # Example usage
     quote = """
 "Ich würd sagen up your ass" - Nina, okay, crazy statement
 "dann würd ich sagen gerne" - Jonathan nein danke"""
-    image_path = create_quote_image(quote, "John Doe")
-    print(f"Quote image saved at: {image_path}")
\ No newline at end of file
+    image = create_quote_image(quote, "John Doe")
+    with open(f"quote.{IMAGE_EXTENSION}", "wb") as f:
+        f.write(image.getbuffer())
+    print(f"Quote image saved at: quote.{IMAGE_EXTENSION}")
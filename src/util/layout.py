@@ -0,0 +1,200 @@
+from PIL import Image, ImageDraw, ImageFont
+from functools import lru_cache
+import unicodedata
+import math
+import re
+import os
+
+ASSETS_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'assets')
+# fonts for characters the card fonts have no glyph for (CJK, emoji, ...), the first that has one is used.
+# Scalable fonts are drawn directly, bitmap color fonts like Noto Color Emoji are drawn at their size and scaled.
+FALLBACK_FONTS = [path.strip() for path in os.getenv("QUOTE_FALLBACK_FONTS", ','.join([
+    '/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc',
+    '/usr/share/fonts/truetype/noto/NotoColorEmoji.ttf',
+])).split(',') if path.strip()]
+BITMAP_FONT_SIZE = 109 # the only size color emoji fonts come in
+NOTDEF_PROBE = '\U0010fffd' # a private use character no font has, it renders the missing glyph box
+QUOTE_FONT_SIZES = (24, 22, 20, 18, 16) # tried in order until a quote fits in QUOTE_MAX_LINES
+QUOTE_MAX_LINES = int(os.getenv("QUOTE_MAX_LINES", 14)) # lines at the smallest size, longer quotes are cut with an ellipsis
+ELLIPSIS = '…'
+# breaks between words, and around every CJK character since those are written without spaces
+TOKEN_PATTERN = re.compile(r'\s+|[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]|[^\s\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]+')
+
+@lru_cache(maxsize=None)
+def load_font(name, size):
+    # truetype parses the whole font file, so every font/size pair is loaded once
+    return ImageFont.truetype(os.path.join(ASSETS_DIR, name), size)
+
+@lru_cache(maxsize=None)
+def load_fallback_font(path, size):
+    """
+    Returns (font, scale) for a fallback font, or None if it is missing or can't be used.
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        return ImageFont.truetype(path, size), 1.0
+    except OSError:
+        pass
+    try:
+        # bitmap fonts only load at their own size and are scaled to the text size
+        return ImageFont.truetype(path, BITMAP_FONT_SIZE), size / BITMAP_FONT_SIZE
+    except OSError:
+        return None
+
+def _mask(font, text):
+    mask = font.getmask(text)
+    return mask.size, bytes(mask)
+
+class FontChain:
+    """
+    A font at one size with its fallbacks. Every character is looked up once:
+    which font has a glyph for it, and how far it advances the pen.
+    """
+    def __init__(self, name, size):
+        self.size = size
+        self.fonts = [(load_font(name, size), 1.0)]
+        self.fonts += [font for font in (load_fallback_font(path, size) for path in FALLBACK_FONTS) if font]
+        self.ascent = self.fonts[0][0].getmetrics()[0]
+        self._notdef = [_mask(font, NOTDEF_PROBE) for font, _ in self.fonts]
+        self._glyphs = {} # character -> (font index, advance)
+
+    def glyph(self, char):
+        glyph = self._glyphs.get(char)
+        if glyph is None:
+            index = 0 if char.isspace() else self._font_for(char)
+            if index is None:
+                # joiners, variation selectors and marks no font has are left out instead of drawn as boxes
+                index = -1 if unicodedata.category(char) in ('Cf', 'Mn', 'Me') else 0
+            if index < 0:
+                glyph = (-1, 0.0)
+            else:
+                font, scale = self.fonts[index]
+                glyph = (index, font.getlength(char) * scale)
+            self._glyphs[char] = glyph
+        return glyph
+
+    def _font_for(self, char):
+        for index, (font, _) in enumerate(self.fonts):
+            if _mask(font, char) != self._notdef[index]:
+                return index
+        return None
+
+    def width(self, text):
+        return sum(self.glyph(char)[1] for char in text)
+
+    def runs(self, text):
+        """
+        Splits text into runs of one font: [(font index, text, x offset)].
+        """
+        runs = []
+        x = 0.0
+        for char in text:
+            index, advance = self.glyph(char)
+            if index < 0:
+                continue
+            if runs and runs[-1][0] == index:
+                runs[-1][1].append(char)
+            else:
+                runs.append((index, [char], x))
+            x += advance
+        return tuple((index, ''.join(chars), offset) for index, chars, offset in runs)
+
+@lru_cache(maxsize=None)
+def font_chain(name, size) -> FontChain:
+    return FontChain(name, size)
+
+class TextLayout:
+    """
+    Wrapped text ready to draw: its lines as font runs, the line widths and the font size they were laid out at.
+    """
+    __slots__ = ('name', 'size', 'lines', 'widths')
+
+    def __init__(self, name, size, lines, widths):
+        self.name = name
+        self.size = size
+        self.lines = lines # per line a tuple of runs from `FontChain.runs`
+        self.widths = widths
+
+def _wrap(chain, text, max_width):
+    # greedy wrapping by pixel width, explicit line breaks are kept and words wider than a line are split
+    lines = []
+    for paragraph in text.split('\n'):
+        line, width, space = '', 0.0, ''
+        for token in TOKEN_PATTERN.findall(paragraph):
+            if token.isspace():
+                space = token if line else ''
+                continue
+            token_width = chain.width(token)
+            space_width = chain.width(space)
+            if line and width + space_width + token_width <= max_width:
+                line, width = line + space + token, width + space_width + token_width
+            else:
+                if line:
+                    lines.append((line, width))
+                line, width = '', 0.0
+                for char in token:
+                    advance = chain.glyph(char)[1]
+                    if line and width + advance > max_width:
+                        lines.append((line, width))
+                        line, width = '', 0.0
+                    line, width = line + char, width + advance
+            space = ''
+        lines.append((line, width))
+    return lines
+
+def truncate(chain, text, max_width):
+    """
+    Cuts text to `max_width` pixels, ending it with an ellipsis if anything was cut.
+    """
+    if chain.width(text) <= max_width:
+        return text
+    limit = max_width - chain.width(ELLIPSIS)
+    width = 0.0
+    for end, char in enumerate(text):
+        width += chain.glyph(char)[1]
+        if width > limit:
+            return text[:end].rstrip() + ELLIPSIS
+    return text
+
+@lru_cache(maxsize=1024)
+def layout_text(text, name, size, max_width, max_lines=None) -> TextLayout:
+    """
+    Wraps text to `max_width` pixels at one font size. Cached, so drawing the same text again only draws.
+    """
+    chain = font_chain(name, size)
+    lines = _wrap(chain, text, max_width)
+    if max_lines and len(lines) > max_lines:
+        last = truncate(chain, lines[max_lines - 1][0] + ELLIPSIS, max_width)
+        lines = lines[:max_lines - 1] + [(last, chain.width(last))]
+    return TextLayout(name, size, tuple(chain.runs(line) for line, _ in lines), tuple(width for _, width in lines))
+
+@lru_cache(maxsize=1024)
+def fit_text(text, name, max_width, sizes=QUOTE_FONT_SIZES, max_lines=QUOTE_MAX_LINES) -> TextLayout:
+    """
+    Lays out text at the largest of `sizes` it fits in `max_lines` at, long texts shrink instead of growing the card.
+    Text that doesn't even fit at the smallest size is cut after `max_lines`.
+    """
+    for size in sizes[:-1]:
+        layout = layout_text(text, name, size, max_width)
+        if len(layout.lines) <= max_lines:
+            return layout
+    return layout_text(text, name, sizes[-1], max_width, max_lines)
+
+def draw_runs(image, draw, chain, runs, x, y, fill):
+    """
+    Draws one laid out line with its top left at (x, y).
+    """
+    baseline = y + chain.ascent
+    for index, text, offset in runs:
+        font, scale = chain.fonts[index]
+        if scale == 1.0:
+            # fallback fonts may be color fonts (emoji), the card font is drawn plain
+            draw.text((x + offset, baseline), text, font=font, fill=fill, anchor='ls', embedded_color=index > 0)
+            continue
+        # bitmap glyphs are drawn at their size and scaled down to the line
+        ascent, descent = font.getmetrics()
+        glyphs = Image.new('RGBA', (max(1, math.ceil(font.getlength(text))), ascent + descent))
+        ImageDraw.Draw(glyphs).text((0, ascent), text, font=font, fill=fill, anchor='ls', embedded_color=True)
+        glyphs = glyphs.resize((max(1, round(glyphs.width * scale)), max(1, round(glyphs.height * scale))), Image.LANCZOS)
+        image.paste(glyphs, (round(x + offset), round(baseline - ascent * scale)), glyphs)
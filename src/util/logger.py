@@ -1,4 +1,10 @@
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 import logging
+import functools
+import atexit
+import queue
+import json
+import os
 
 class CustomFormatter(logging.Formatter):
 
@@ -22,13 +28,97 @@ class CustomFormatter(logging.Formatter):
         formatter = logging.Formatter(log_fmt)
         return formatter.format(record)
 
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per line, so the log can be parsed without regexes.
+    """
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'file': record.filename,
+            'line': record.lineno,
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets at most `burst` records per call site through every `interval` seconds and drops the rest,
+    so per-message log lines can't flood the log during a scan. Warnings and errors always pass.
+    The next record that passes carries the number of dropped ones.
+    """
+    def __init__(self, burst=20, interval=10.0):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self._sites = {} # (path, line) -> [window start, passed, dropped]
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.pathname, record.lineno)
+        site = self._sites.get(key)
+        if site is None or record.created - site[0] >= self.interval:
+            dropped = site[2] if site else 0
+            self._sites[key] = [record.created, 1, 0]
+            if dropped:
+                record.msg = f'{record.msg} ({dropped} similar messages dropped)'
+            return True
+        if site[1] < self.burst:
+            site[1] += 1
+            return True
+        site[2] += 1
+        return False
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower() # text or json
+LOG_FILE = os.getenv("LOG_FILE", "discord.log")
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", 5))
+
 logger = logging.getLogger('discord')
-logger.setLevel(logging.DEBUG)
-handler = logging.FileHandler(filename='discord.log', encoding='utf-8', mode='w')
-handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-logger.addHandler(handler)
+logger.setLevel(LOG_LEVEL)
+
+# the event loop only puts records on a queue, a background thread formats and writes them
+handler = RotatingFileHandler(filename=LOG_FILE, encoding='utf-8', maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS)
+if LOG_FORMAT == 'json':
+    handler.setFormatter(JSONFormatter())
+else:
+    handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
 
 console_handler = logging.StreamHandler()
 console_handler.setLevel(logging.INFO)
 console_handler.setFormatter(CustomFormatter())
-logger.addHandler(console_handler)
\ No newline at end of file
+
+log_queue = queue.SimpleQueue()
+queue_handler = QueueHandler(log_queue)
+queue_handler.addFilter(RateLimitFilter())
+logger.addHandler(queue_handler)
+
+listener = QueueListener(log_queue, handler, console_handler, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
+
+_worker_listener = None
+
+def worker_logging(context):
+    """
+    Returns the initializer for worker processes forked with `context`. A forked worker has no listener thread,
+    so its records go through a process queue to a listener here, which writes them with the same handlers.
+    """
+    global _worker_listener
+    if _worker_listener is None:
+        _worker_listener = QueueListener(context.Queue(), handler, console_handler, respect_handler_level=True)
+        _worker_listener.start()
+        atexit.register(_worker_listener.stop)
+    return functools.partial(_init_worker, _worker_listener.queue)
+
+def _init_worker(worker_queue):
+    logger.removeHandler(queue_handler)
+    worker_handler = QueueHandler(worker_queue)
+    worker_handler.addFilter(RateLimitFilter())
+    logger.addHandler(worker_handler)
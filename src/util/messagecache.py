@@ -0,0 +1,66 @@
+from collections import OrderedDict
+import discord
+import os
+
+MESSAGE_CACHE_SIZE = int(os.getenv("MESSAGE_CACHE_SIZE", 1000)) # quote channel messages kept for edits
+
+class MessageCache:
+    """
+    A bounded LRU of quote channel messages. Handlers work from the gateway payload first,
+    this is the fallback before asking the REST API.
+    """
+    def __init__(self, maxsize=MESSAGE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._messages = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def put(self, message: discord.Message):
+        self._messages[message.id] = message
+        self._messages.move_to_end(message.id)
+        if len(self._messages) > self.maxsize:
+            self._messages.popitem(last=False)
+
+    def get(self, message_id: int):
+        message = self._messages.get(message_id)
+        if message is not None:
+            self._messages.move_to_end(message_id)
+        return message
+
+    def discard(self, message_id: int):
+        self._messages.pop(message_id, None)
+
+    async def resolve(self, bot: discord.Bot, channel, message_id: int):
+        """
+        Returns a message from this cache, the library's cache, or as a last resort the REST API.
+        """
+        message = self.get(message_id) or bot.get_message(message_id)
+        if message is not None:
+            self.hits += 1
+            return message
+        self.misses += 1
+        message = await channel.fetch_message(message_id)
+        self.put(message)
+        return message
+
+    async def from_edit(self, bot: discord.Bot, event: discord.RawMessageUpdateEvent):
+        """
+        Builds the edited message from the gateway payload. Discord sends the full message on edits,
+        only partial payloads (e.g. embed-only updates on old clients) fall back to `resolve`.
+        """
+        channel = bot.get_channel(event.channel_id)
+        if channel is None:
+            return None
+        message = getattr(event, 'new_message', None)
+        if message is None and 'author' in event.data and 'content' in event.data:
+            message = discord.Message(state=bot._connection, channel=channel, data=event.data)
+        if message is None:
+            self.discard(event.message_id)
+            return await self.resolve(bot, channel, event.message_id)
+        self.put(message)
+        return message
+
+    def stats(self):
+        return {'size': len(self._messages), 'hits': self.hits, 'misses': self.misses}
+
+message_cache = MessageCache()
@@ -0,0 +1,387 @@
+from functools import lru_cache
+import contextvars
+import threading
+import asyncio
+import logging
+import bisect
+import json
+import time
+import re
+import os
+import discord
+from util.logger import logger
+
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1") # only reachable from the host (or the scraper's sidecar)
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108)) # 0 disables the endpoint, /botstats keeps working
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+class Metric:
+    """
+    A metric with a fixed set of label names. Values are kept per label tuple,
+    recording is a dict update under a lock (the database threads record too), text is only built on scrape.
+    """
+    type = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def _labelstr(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+    def samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        lines.extend(f'{name}{labels} {_number(value)}' for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labels, value=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def get(self, *labels):
+        return self._values.get(labels, 0)
+
+    def total(self):
+        return sum(self._values.values())
+
+    def items(self):
+        with self._lock:
+            return list(self._values.items())
+
+    def samples(self):
+        for labels, value in self.items():
+            yield self.name, self._labelstr(labels), value
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        # buckets are stored non-cumulative (last one is +Inf) and summed up on scrape
+        with self._lock:
+            series = self._values.get(labels)
+            if series is None:
+                series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def items(self):
+        with self._lock:
+            return [(labels, (list(counts), total, count)) for labels, (counts, total, count) in self._values.items()]
+
+    def summary(self):
+        """
+        Returns {labels: (count, average, p95)} with the 95th percentile estimated from the buckets.
+        """
+        result = {}
+        for labels, (counts, total, count) in self.items():
+            result[labels] = (count, total / count if count else 0.0, _quantile(self.buckets, counts, count, 0.95))
+        return result
+
+    def samples(self):
+        for labels, (counts, total, count) in self.items():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket
+                yield self.name + '_bucket', self._labelstr(labels, [('le', _number(bound))]), cumulative
+            yield self.name + '_sum', self._labelstr(labels), total
+            yield self.name + '_count', self._labelstr(labels), count
+
+class GaugeFunc(Metric):
+    """
+    A gauge read from a callback at scrape time, for state that already lives elsewhere (cache sizes, queues).
+    The callback returns a number, or a dict of label value (or tuple of them) -> number.
+    """
+    type = 'gauge'
+
+    def __init__(self, name, help, func, labels=()):
+        super().__init__(name, help, labels)
+        self.func = func
+
+    def samples(self):
+        try:
+            value = self.func()
+        except Exception as e:
+            logger.warning(f'Could not read metric {self.name}: {e}')
+            return
+        if not isinstance(value, dict):
+            value = {(): value}
+        for labels, number in value.items():
+            if number is None:
+                continue
+            yield self.name, self._labelstr(labels if isinstance(labels, tuple) else (labels,)), number
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, bool):
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+def _quantile(buckets, counts, count, q):
+    if not count:
+        return 0.0
+    rank = q * count
+    cumulative = 0
+    for bound, bucket in zip(buckets, counts):
+        cumulative += bucket
+        if cumulative >= rank:
+            return bound
+    return float('inf')
+
+registry = []
+
+command_latency = Histogram('quotr_command_seconds', 'Slash command handler latency.', ('command',))
+command_errors = Counter('quotr_command_errors_total', 'Slash commands that raised an error.', ('command',))
+event_latency = Histogram('quotr_event_seconds', 'Gateway event handler latency.', ('event',))
+event_errors = Counter('quotr_event_errors_total', 'Gateway event handlers that raised an error.', ('event',))
+api_latency = Histogram('quotr_discord_api_seconds', 'Discord REST call latency including rate limit waits.', ('route',))
+api_calls = Counter('quotr_discord_api_calls_total', 'Discord REST calls by route and result.', ('route', 'status'))
+api_rate_limited = Counter('quotr_discord_api_rate_limited_total', 'Discord REST responses with status 429, by route.', ('route', 'scope'))
+db_latency = Histogram('quotr_db_query_seconds', 'Database query time by model and operation.', ('model', 'operation'))
+render_latency = Histogram('quotr_render_seconds', 'Quote image render time in the worker.')
+shard_disconnects = Counter('quotr_shard_disconnects_total', 'Gateway disconnects by shard.', ('shard',))
+render_queue_wait = Histogram('quotr_render_queue_wait_seconds', 'Time a render waited for a free worker.')
+
+def register_stats(prefix, func, help=None):
+    """
+    Exposes every number of a `stats()`/`snapshot()` dict as a gauge `quotr_<prefix>_<key>`.
+
+    Args:
+        prefix (str): The name of the component, e.g. 'db'.
+        func (callable): Returns the dict, called on every scrape.
+        help (str, optional): The help text, defaults to the prefix.
+    """
+    for key in func():
+        GaugeFunc(f'quotr_{prefix}_{key}', help or f'{prefix} {key}'.replace('_', ' '), lambda key=key: func()[key])
+
+def render():
+    return '\n'.join(metric.render() for metric in registry) + '\n'
+
+
+# Discord
+
+_current_route = contextvars.ContextVar('quotr_route', default='unknown')
+_pending_rate_limits = contextvars.ContextVar('quotr_pending_rate_limits', default=None) # route 429s of the current request not yet counted
+
+class RateLimitCounter(logging.Filter):
+    """
+    discord.py handles 429s inside `HTTPClient.request` and only logs them,
+    so they are counted from its log records. Needs the discord logger at WARNING or lower.
+    A global 429 is logged twice, first like a route one, so route 429s are only counted when the request
+    is done and a global line right after takes the route line's place.
+    """
+    def filter(self, record):
+        if not isinstance(record.msg, str):
+            return True
+        pending = _pending_rate_limits.get()
+        if record.msg.startswith('We are being rate limited'):
+            if pending is None:
+                api_rate_limited.inc(_current_route.get(), 'route')
+            else:
+                pending.append(_current_route.get())
+        elif record.msg.startswith('Global rate limit'):
+            if pending:
+                pending.pop()
+            api_rate_limited.inc(_current_route.get(), 'global')
+        return True
+
+def instrument_http(http):
+    """
+    Wraps the bot's REST client so every call is timed and counted by route template
+    (e.g. `PUT /channels/{channel_id}/messages/{message_id}/reactions/{emoji}/@me`).
+    """
+    request = http.request
+
+    async def timed_request(route, **kwargs):
+        label = f'{route.method} {route.path}'
+        token = _current_route.set(label)
+        pending = []
+        pending_token = _pending_rate_limits.set(pending)
+        start = time.perf_counter()
+        status = '2xx'
+        try:
+            return await request(route, **kwargs)
+        except discord.HTTPException as e:
+            status = str(e.status)
+            raise
+        except Exception:
+            status = 'error'
+            raise
+        finally:
+            _current_route.reset(token)
+            _pending_rate_limits.reset(pending_token)
+            for route in pending:
+                api_rate_limited.inc(route, 'route')
+            api_latency.observe(time.perf_counter() - start, label)
+            api_calls.inc(label, status)
+
+    http.request = timed_request
+    logging.getLogger('discord.http').addFilter(RateLimitCounter())
+
+def instrument_bot(bot: discord.Bot):
+    """
+    Times every slash command and event handler of the bot, and its REST calls.
+    """
+    instrument_http(bot.http)
+
+    invoke = bot.invoke_application_command
+    async def timed_invoke(ctx):
+        with command_latency.time(ctx.command.qualified_name if ctx.command else 'unknown'):
+            await invoke(ctx)
+    bot.invoke_application_command = timed_invoke
+
+    async def on_application_command_error(ctx, error):
+        # registering a listener replaces the library's default handler, which only printed to stderr
+        command_errors.inc(ctx.command.qualified_name if ctx.command else 'unknown')
+        logger.error(f'Error in command {ctx.command}: {error}', exc_info=error)
+    bot.add_listener(on_application_command_error)
+
+    run_event = bot._run_event
+    async def timed_run_event(coro, event_name, *args, **kwargs):
+        async def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                await coro(*args, **kwargs)
+            except Exception:
+                event_errors.inc(event_name)
+                raise
+            finally:
+                event_latency.observe(time.perf_counter() - start, event_name)
+        await run_event(timed, event_name, *args, **kwargs)
+    bot._run_event = timed_run_event
+
+
+# Database
+
+_SQL_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?[`"]?(\w+)', re.IGNORECASE)
+
+@lru_cache(maxsize=1024)
+def sql_labels(sql, models):
+    """
+    Returns (model, operation) for a statement, e.g. ('Quote', 'select').
+    peewee sends parameterized SQL, so the same few strings come back and are cached.
+    """
+    operation = sql.lstrip().split(None, 1)[0].lower() if sql.strip() else 'unknown'
+    table = _SQL_TABLE.search(sql)
+    if table is None:
+        return 'none', operation
+    return dict(models).get(table.group(1), table.group(1)), operation
+
+def instrument_database(database, models):
+    """
+    Times every statement a peewee database executes, labelled by model and operation.
+
+    Args:
+        database (peewee.Database): The database, not the proxy.
+        models (iterable): The models, to map table names back to model names.
+    """
+    models = tuple((model._meta.table_name, model.__name__) for model in models)
+    execute_sql = database.execute_sql
+
+    def timed_execute_sql(sql, params=None, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return execute_sql(sql, params, *args, **kwargs)
+        finally:
+            db_latency.observe(time.perf_counter() - start, *sql_labels(sql, models))
+
+    database.execute_sql = timed_execute_sql
+
+
+# Endpoint
+
+_server = None
+_health_check = None
+
+def set_health_check(func):
+    """
+    Sets what `/health` reports. `func` returns (healthy, details), details must be JSON serializable.
+    """
+    global _health_check
+    _health_check = func
+
+def _health():
+    if _health_check is None:
+        return '200 OK', b'{"healthy": true}\n'
+    healthy, details = _health_check()
+    body = json.dumps({'healthy': healthy, **details}).encode() + b'\n'
+    return ('200 OK' if healthy else '503 Service Unavailable'), body
+
+async def _handle(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        # skip the headers, nothing in them matters here
+        while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request.split()
+        path = parts[1].split(b'?')[0] if len(parts) >= 2 and parts[0] == b'GET' else None
+        content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        if path in (b'/', b'/metrics'):
+            status, body = '200 OK', render().encode()
+        elif path == b'/health':
+            status, body = _health()
+            content_type = 'application/json'
+        else:
+            status, body = '404 Not Found', b'Not found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """
+    Serves the metrics in the Prometheus text format on http://host:port/metrics, and `/health`.
+    Safe to call again (e.g. on every `on_ready`), the server is only started once.
+    """
+    global _server
+    if _server is not None or not port:
+        return _server
+    try:
+        _server = await asyncio.start_server(_handle, host, port)
+        logger.info(f'Serving metrics on http://{host}:{port}/metrics')
+    except OSError as e:
+        logger.error(f'Could not start the metrics endpoint on {host}:{port}: {e}')
+    return _server
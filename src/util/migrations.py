@@ -0,0 +1,114 @@
+from peewee import *
+from playhouse.migrate import SchemaMigrator, migrate
+from datetime import datetime
+from util.db import db, Guild, Quote
+from util.logger import logger
+
+class SchemaVersion(Model):
+    version = IntegerField(primary_key=True)
+    name = CharField(max_length=100)
+    appliedAt = DateTimeField(default=datetime.utcnow)
+
+    class Meta:
+        database = db
+        table_name = 'schema_version'
+
+def _is_mysql():
+    return isinstance(db.obj, MySQLDatabase)
+
+def create_tables():
+    # only tables that don't exist yet, and without indexes: on an older database an index could name a column
+    # a later migration adds (sqlite then indexes a string literal and the index doesn't match the table)
+    for model in (Guild, Quote):
+        if not model.table_exists():
+            model._schema.create_table(safe=True)
+
+def add_missing_columns():
+    # columns added to the models after the first deployment
+    migrator = SchemaMigrator.from_database(db.obj)
+    for model in (Guild, Quote):
+        table = model._meta.table_name
+        existing = {column.name for column in db.get_columns(table)}
+        missing = [field for field in model._meta.sorted_fields if field.column_name not in existing]
+        if missing:
+            migrate(*[migrator.add_column(table, field.column_name, field) for field in missing])
+
+def bigint_snowflakes():
+    # INT is 32 bit on MySQL and can't hold discord ids. sqlite integers are 64 bit already.
+    if not _is_mysql():
+        return
+    statements = [
+        'ALTER TABLE guilds MODIFY guildid BIGINT NOT NULL',
+        'ALTER TABLE guilds MODIFY quoteChannel BIGINT NULL',
+        'ALTER TABLE guilds MODIFY quotesProcessedUntil DATETIME NULL DEFAULT NULL',
+        'ALTER TABLE quotes MODIFY messageid BIGINT NOT NULL',
+        'ALTER TABLE quotes MODIFY guildid_id BIGINT NOT NULL',
+        # the author is the name matched in the quote, it was never a number
+        'ALTER TABLE quotes MODIFY author VARCHAR(255) NOT NULL',
+    ]
+    # both sides of the foreign key change type, which MySQL only allows with the checks off
+    db.execute_sql('SET FOREIGN_KEY_CHECKS=0')
+    try:
+        for statement in statements:
+            db.execute_sql(statement)
+    finally:
+        db.execute_sql('SET FOREIGN_KEY_CHECKS=1')
+    # 0 was used for "never scanned"
+    Guild.update(quotesProcessedUntil=None).where(fn.YEAR(Guild.quotesProcessedUntil) == 0).execute()
+
+def quote_indexes():
+    # the indexes of Quote, run again by the migrations that add indexed columns
+    indexes = db.get_indexes(Quote._meta.table_name)
+    names = {index.name for index in indexes}
+    # the foreign key index may exist under another name (e.g. the one MySQL creates for the constraint)
+    columns = {tuple(index.columns) for index in indexes}
+    for index in Quote._meta.fields_to_index():
+        if index._name not in names and tuple(field.column_name for field in index._expressions) not in columns:
+            db.execute(index)
+
+def quote_content_hash():
+    # the column and its index, then the hash of every stored quote so existing duplicates can be found
+    from util.quotes import contentHash
+    add_missing_columns()
+    quote_indexes()
+    while True:
+        rows = list(Quote.select(Quote.messageid, Quote.content, Quote.author).where(Quote.contentHash.is_null()).limit(1000).tuples())
+        if not rows:
+            break
+        hashes = Case(Quote.messageid, [(messageid, contentHash(content, author)) for messageid, content, author in rows])
+        Quote.update(contentHash=hashes).where(Quote.messageid.in_([row[0] for row in rows])).execute()
+
+# (version, name, function) - append only, never change a migration that was released
+MIGRATIONS = [
+    (1, 'create tables', create_tables),
+    (2, 'add missing columns', add_missing_columns),
+    (3, 'bigint snowflakes', bigint_snowflakes),
+    (4, 'quote indexes', quote_indexes),
+    (5, 'quote source hash', add_missing_columns),
+    (6, 'quote content hash', quote_content_hash),
+    (7, 'scan backfill cursor', add_missing_columns),
+]
+
+def run_migrations():
+    """
+    Applies every migration that wasn't applied yet, in order, and records it in `schema_version`.
+
+    Returns:
+        list: The versions that were applied.
+    """
+    applied = []
+    with db.connection_context():
+        db.create_tables([SchemaVersion], safe=True)
+        done = {row.version for row in SchemaVersion.select(SchemaVersion.version)}
+        for version, name, migration in MIGRATIONS:
+            if version in done:
+                continue
+            logger.info(f'Applying migration {version}: {name}')
+            # DDL commits implicitly on MySQL, the transaction only covers the data changes
+            with db.atomic():
+                migration()
+                SchemaVersion.create(version=version, name=name)
+            applied.append(version)
+    if not applied:
+        logger.info('Database schema is up to date')
+    return applied
@@ -0,0 +1,153 @@
+from collections import OrderedDict, deque
+import asyncio
+import random
+import os
+from util.sampler import quote_sampler
+from util.images import render_quote_image, render_stats, RenderBusy, RENDER_QUEUE_SIZE
+from util.logger import logger
+
+GUESS_PREFETCH = int(os.getenv("GUESS_PREFETCH", 2)) # ready /guess rounds kept per guild, 0 disables prefetching
+GUESS_PREFETCH_MEMORY = int(os.getenv("GUESS_PREFETCH_MEMORY", 32 * 1024 * 1024)) # bytes of rendered cards kept over all guilds
+GUESS_SHUFFLE_BAG = os.getenv('GUESS_SHUFFLE_BAG', 'true').lower() == 'true' # don't repeat quotes in /guess until all were played
+BACKGROUND_COLORS = ["#7289da", "#ed5555", "#43b581", "#f04747", "#faa61a", "#a3a3a3"]
+
+class GuessRound:
+    """
+    Everything a /guess round needs: the quote row (with the submitter and channel stored with it)
+    and both cards. A card is None if it could not be rendered in time.
+    """
+    __slots__ = ('quote', 'background_color', 'hidden', 'revealed')
+
+    def __init__(self, quote, background_color, hidden=None, revealed=None):
+        self.quote = quote
+        self.background_color = background_color
+        self.hidden = hidden # encoded image bytes
+        self.revealed = revealed
+
+    @property
+    def size(self):
+        return len(self.hidden or b'') + len(self.revealed or b'')
+
+class GuessPrefetcher:
+    """
+    Keeps a few ready rounds per guild, so /guess can answer with a single response instead of
+    picking and rendering while the user waits. After a round is taken the guild's buffer is refilled in the background.
+    Rounds of quotes that are deleted or edited are dropped, and the least recently played guilds are evicted
+    once the rendered cards exceed `GUESS_PREFETCH_MEMORY`.
+    """
+    def __init__(self, size=GUESS_PREFETCH, memory=GUESS_PREFETCH_MEMORY):
+        self.size = size
+        self.memory = memory
+        self._rounds = OrderedDict() # guild id -> deque of rounds, least recently played first
+        self._refills = {} # guild id -> refill task
+        self._building = set() # (guild id, message id) of rounds being rendered
+        self._stale = set() # (guild id, message id) of rounds invalidated while rendering
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.dropped = 0
+        quote_sampler.subscribe(self.invalidate)
+
+    async def build(self, guild_id):
+        """
+        Picks a quote and renders both cards in parallel. Returns None if the guild has no quotes.
+        """
+        quote = await quote_sampler.random_quote(guild_id, 'guess' if GUESS_SHUFFLE_BAG else None)
+        if quote is None:
+            return None
+        background_color = random.choice(BACKGROUND_COLORS)
+        key = (guild_id, quote.messageid)
+        self._building.add(key)
+        try:
+            images = await asyncio.gather(
+                render_quote_image(quote.content, background_color=background_color),
+                render_quote_image(quote.content, quote.author, background_color=background_color),
+                return_exceptions=True,
+            )
+        finally:
+            self._building.discard(key)
+        if key in self._stale:
+            # the quote was deleted or edited while it was rendering
+            self._stale.discard(key)
+            self.dropped += 1
+            return await self.build(guild_id)
+        for image in images:
+            if isinstance(image, BaseException) and not isinstance(image, RenderBusy):
+                raise image
+        hidden, revealed = (None if isinstance(image, RenderBusy) else image.getvalue() for image in images)
+        return GuessRound(quote, background_color, hidden, revealed)
+
+    def pop(self, guild_id):
+        """
+        Takes a ready round without any I/O, or returns None if the guild's buffer is empty.
+        """
+        rounds = self._rounds.get(guild_id)
+        if not rounds:
+            self.misses += 1
+            return None
+        self._rounds.move_to_end(guild_id)
+        guess_round = rounds.popleft()
+        self.bytes -= guess_round.size
+        self.hits += 1
+        return guess_round
+
+    def refill(self, guild_id):
+        if self.size <= 0:
+            return
+        task = self._refills.get(guild_id)
+        if task is None or task.done():
+            self._refills[guild_id] = asyncio.create_task(self._refill(guild_id))
+
+    async def _refill(self, guild_id):
+        try:
+            while len(self._rounds.get(guild_id, ())) < self.size:
+                if render_stats.pending >= RENDER_QUEUE_SIZE // 2:
+                    # players waiting on a render come first, the next /guess tries again
+                    break
+                guess_round = await self.build(guild_id)
+                if guess_round is None or guess_round.hidden is None or guess_round.revealed is None:
+                    break
+                self._rounds.setdefault(guild_id, deque()).append(guess_round)
+                self._rounds.move_to_end(guild_id)
+                self.bytes += guess_round.size
+                self._evict()
+        except Exception as e:
+            logger.error(f'Could not prefetch a guess round for guild {guild_id}: {e}')
+        finally:
+            self._refills.pop(guild_id, None)
+
+    def _evict(self):
+        while self.bytes > self.memory and self._rounds:
+            _, rounds = self._rounds.popitem(last=False)
+            self.bytes -= sum(guess_round.size for guess_round in rounds)
+            self.dropped += len(rounds)
+
+    def invalidate(self, guild_id, messageid=None):
+        """
+        Drops the buffered rounds of a quote, or all of the guild's rounds if `messageid` is None.
+        """
+        self._stale.update(key for key in self._building if key[0] == guild_id and messageid in (None, key[1]))
+        rounds = self._rounds.get(guild_id)
+        if not rounds:
+            return
+        kept = deque(guess_round for guess_round in rounds if messageid is not None and guess_round.quote.messageid != messageid)
+        if len(kept) == len(rounds):
+            return
+        self.bytes -= sum(guess_round.size for guess_round in rounds) - sum(guess_round.size for guess_round in kept)
+        self.dropped += len(rounds) - len(kept)
+        if kept:
+            self._rounds[guild_id] = kept
+        else:
+            del self._rounds[guild_id]
+
+    def stats(self):
+        return {
+            'guilds': len(self._rounds),
+            'rounds': sum(len(rounds) for rounds in self._rounds.values()),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'dropped': self.dropped,
+        }
+
+guess_rounds = GuessPrefetcher()
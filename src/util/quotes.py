@@ -1,82 +1,359 @@
+import asyncio
 import discord
-from util.db import Guild, Quote
-from util.regexes import extractQuote
+from util.db import Guild, Quote, db, run_query, upsert_many
+from peewee import fn
+from util.guildconfig import guild_configs
+from util.sampler import quote_sampler
+from util.search import quote_index
+from util.regexguard import regex_sandbox, regex_failures, RegexTimeout
+from util.clearjob import ClearJob, clear_jobs
+from util.reactions import reaction_scheduler, QUOTE_REACTION, NOT_QUOTE_REACTION
 from util.logger import logger
-import asyncio
+from datetime import datetime, timezone
+import hashlib
+import unicodedata
+import time
+
+SCAN_PAGE_SIZE = 100 # messages per history request and per database transaction
+NOT_QUOTE_DISPLAY = 5 # seconds the x stays on a message that isn't a quote
+MERGE_BATCH_SIZE = 500 # duplicates deleted per statement by /mergeduplicates
+# straight, curly and angle quote marks, whether a quote is wrapped in them doesn't make it a different quote
+QUOTE_MARKS = dict.fromkeys(map(ord, '"\'`´‘’‚‛“”„‟«»‹›「」『』'))
+
+async def extractMessageQuote(message: discord.Message):
+    """
+    Extracts the quote and author from a message with its guild's extractor.
+    A custom regex runs in the regex sandbox, the built-in patterns run inline.
+    """
+    config = guild_configs.get(message.guild.id)
+    extractor = config.extractor
+    if extractor.customRegex and not config.quoteRegexDisabled:
+        try:
+            match = await regex_sandbox.match(extractor.customRegex, message.content)
+            regex_failures.success(config.guildid)
+            if match:
+                return extractor.fromCustomMatch(message.content, match)
+        except RegexTimeout:
+            logger.warning(f'Custom regex timed out on message: {message.id} - {config.guildid}')
+            if regex_failures.timeout(config.guildid):
+                await guild_configs.update(config.guildid, quoteRegexDisabled=True)
+                logger.warning(f'Disabled custom regex of guild {config.guildid}: {extractor.customRegex}')
+        except ValueError as e:
+            logger.error(f'Custom regex failed on message: {message.id} - {e}')
+        except OSError as e:
+            logger.error(f'Regex sandbox unavailable for message: {message.id} - {e}')
+    return extractor.extract(message.content, builtinOnly=True)
+
+def sourceHash(content: str) -> str:
+    return hashlib.blake2b(content.encode('utf-8'), digest_size=16).hexdigest()
+
+def normalizeQuote(text: str) -> str:
+    """
+    The text a quote is compared by: unicode compatibility forms folded, quote marks removed,
+    whitespace collapsed and case folded.
+    """
+    text = unicodedata.normalize('NFKC', text or '').translate(QUOTE_MARKS)
+    return ' '.join(text.split()).casefold()
+
+def contentHash(quote: str, author: str) -> str:
+    normalized = f'{normalizeQuote(quote)}\0{normalizeQuote(author)}'
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=16).hexdigest()
+
+def submitterFields(message: discord.Message):
+    return {
+        'channelid': message.channel.id,
+        'submitterid': message.author.id,
+        'submitterName': message.author.name,
+        'submitterAvatar': message.author.display_avatar.url,
+        'sourceHash': sourceHash(message.content),
+    }
 
 async def process_message(message: discord.Message):
+    """
+    Stores, updates or removes the quote of a message and sets its reaction.
+
+    Returns:
+        bool: False if the message is a stored quote whose text didn't change, so nothing was done.
+    """
     # check if the message has a checkmark or trash reaction
     if any(reaction.emoji == '🗑️' for reaction in message.reactions):
-        logger.info(f'Message excluded: {message.id}')
-        return
-    # add a repeat emoji and remove the checkmark reaction if it exists
-    await message.add_reaction('🔁')
-    try:
-        await message.remove_reaction('✅', message.guild.me)
-    except discord.NotFound:
-        pass
+        logger.debug('Message excluded: %s', message.id)
+        return True
+    existing_quote = await run_query(Quote.get_or_none, Quote.messageid == message.id)
+    if existing_quote and existing_quote.sourceHash == sourceHash(message.content):
+        # e.g. an embed was added to the message
+        logger.debug('Quote unchanged: %s', message.id)
+        return False
     
-    
-    existing_quote = Quote.get_or_none(Quote.messageid == message.id)
-    
-    logger.info(f'Existing quote: {existing_quote}')
-    
-    logger.info(f'Message content: {message.content}')
+    # per-message lines use lazy %-formatting, at INFO they cost a level check and nothing else
+    logger.debug('Existing quote: %s', existing_quote)
+    logger.debug('Message content: %s', message.content)
     # extract the quote and author from the message
-    matches = extractQuote(message.content)
+    matches = await extractMessageQuote(message)
     if matches:
         quote = matches[0]
         author = matches[1] if len(matches) > 1 else None
-        # check if the quote already exists in the database
-        if not existing_quote:
+        content_hash = contentHash(quote, author)
+        duplicate = await run_query(lambda: Quote.select(Quote.messageid).where(
+            Quote.guildid == message.guild.id, Quote.contentHash == content_hash, Quote.messageid != message.id).first())
+        if duplicate:
+            # a repost of a stored quote, the first post stays the quote
+            if existing_quote:
+                await run_query(existing_quote.delete_instance)
+                quote_sampler.remove(message.guild.id, message.id)
+            logger.info('Duplicate of quote %s: %s', duplicate.messageid, message.id)
+        elif not existing_quote:
             # create a new quote entry in the database
-            Quote.create(guildid=message.guild.id, messageid=message.id, content=quote, author=author)
-            logger.info(f'Quote added: {quote} - {author} - {message.id}')
+            await run_query(Quote.create, guildid=message.guild.id, messageid=message.id, content=quote, author=author, contentHash=content_hash, **submitterFields(message))
+            quote_sampler.add(message.guild.id, message.id)
+            quote_index.add(message.guild.id, message.id, quote, author)
+            logger.info('Quote added: %s - %s', author, message.id)
         else:
-            Quote.update(content=quote, author=author).where(Quote.messageid == message.id).execute()
-            logger.info(f'Quote updated: {quote} - {author} - {message.id}')
-        await message.remove_reaction('🔁', message.guild.me)
-        await message.add_reaction('✅')
+            await run_query(Quote.update(content=quote, author=author, contentHash=content_hash, **submitterFields(message)).where(Quote.messageid == message.id).execute)
+            quote_sampler.changed(message.guild.id, message.id)
+            quote_index.add(message.guild.id, message.id, quote, author)
+            logger.info('Quote updated: %s - %s', author, message.id)
+        reaction_scheduler.set_state(message, {QUOTE_REACTION})
     else:
         if existing_quote:
-            existing_quote.delete_instance()
-            logger.info(f'Quote deleted: {message.id}')
-        logger.info(f'No quote found in message: {message.id}')
-        await message.remove_reaction('🔁', message.guild.me)
-        # add x emoji to the message and remove it after 5 seconds
-        await message.add_reaction('❌')
-        await asyncio.sleep(5)
-        await message.remove_reaction('❌', message.guild.me)
-
-async def processChannelMessages(channel: discord.TextChannel, limit = 500):
-    # get the guild from the database
-    processed_count = 0
-    start = None
-    while processed_count < limit:
-        async for message in channel.history(limit=100, before=start):
-            await process_message(message)
-            processed_count += 1
-            start = message.created_at  # update the starting point for the next batch
-            logger.info(f'Processed {processed_count} messages in {channel.name} - {channel.id}')
-            if processed_count >= 500:
-                break
-        await asyncio.sleep(0.5)  # to avoid hitting the rate limit
-
-async def clearQuotes(channel: discord.TextChannel, guild: int, botuser: discord.User):
-    quotes = Quote.select().where(Quote.guildid == guild, Quote.messageid != None)
-    for quote in quotes:
-        try:
-            message = await channel.fetch_message(quote.messageid)
-            if message:
-                # remove the bot's reaction from the message
-                await message.remove_reaction('✅', botuser)
-                logger.info(f'Removed reaction from message: {message.id} - {channel.name} - {channel.id}')
-        except discord.NotFound:
-            logger.error(f'Message not found: {quote.messageid} - {channel.name} - {channel.id}')
-        except Exception as e:
-            logger.error(f'Error removing reaction from message: {e}')
-    # delete all quotes from the database
-    Quote.delete().where(Quote.guildid == guild).execute()
-    guild, _ = Guild.get_or_create(guildid=guild)
-    guild.quotesProcessedUntil = 0
-    guild.save()
\ No newline at end of file
+            await run_query(existing_quote.delete_instance)
+            quote_sampler.remove(message.guild.id, message.id)
+            logger.info('Quote deleted: %s', message.id)
+        logger.debug('No quote found in message: %s', message.id)
+        # show an x on the message for a few seconds
+        reaction_scheduler.set_state(message, {NOT_QUOTE_REACTION}, expire=NOT_QUOTE_REACTION, expire_after=NOT_QUOTE_DISPLAY)
+    return True
+
+async def deleteQuotes(guild_id: int, message_ids):
+    """
+    Deletes the quotes of deleted messages in one statement.
+
+    Returns:
+        int: The number of quotes deleted.
+    """
+    message_ids = list(message_ids)
+    deleted = await run_query(lambda: Quote.delete().where(Quote.messageid.in_(message_ids)).execute())
+    if deleted:
+        for message_id in message_ids:
+            quote_sampler.remove(guild_id, message_id)
+        logger.info('Deleted %s quotes of deleted messages in guild %s', deleted, guild_id)
+    return deleted
+
+async def mergeDuplicates(guild_id: int):
+    """
+    Merges the quotes of a guild that have the same normalized text and author into the oldest one.
+    The duplicates are found with one grouped query and deleted in batches of `MERGE_BATCH_SIZE`.
+
+    Returns:
+        int: The number of duplicates deleted.
+    """
+    def merge():
+        with db.atomic():
+            kept = (Quote.select(Quote.contentHash, fn.MIN(Quote.messageid).alias('first'))
+                    .where(Quote.guildid == guild_id, Quote.contentHash.is_null(False))
+                    .group_by(Quote.contentHash).having(fn.COUNT(Quote.messageid) > 1).tuples())
+            first = {content_hash: messageid for content_hash, messageid in kept}
+            if not first:
+                return []
+            duplicates = []
+            hashes = list(first)
+            for start in range(0, len(hashes), MERGE_BATCH_SIZE):
+                batch = hashes[start:start + MERGE_BATCH_SIZE]
+                duplicates += [messageid for messageid, content_hash in Quote.select(Quote.messageid, Quote.contentHash)
+                               .where(Quote.guildid == guild_id, Quote.contentHash.in_(batch)).tuples()
+                               if messageid != first[content_hash]]
+            for start in range(0, len(duplicates), MERGE_BATCH_SIZE):
+                Quote.delete().where(Quote.messageid.in_(duplicates[start:start + MERGE_BATCH_SIZE])).execute()
+            return duplicates
+    duplicates = await run_query(merge)
+    for message_id in duplicates:
+        quote_sampler.remove(guild_id, message_id)
+    logger.info(f'Merged {len(duplicates)} duplicate quotes of guild {guild_id}')
+    return len(duplicates)
+
+def _checkpoint(value):
+    # quotesProcessedUntil is stored as naive UTC, None means the channel was never scanned
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=timezone.utc) if value.tzinfo is None else value
+    return None
+
+def _utc(value: datetime):
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+async def _processPage(guild_id: int, messages: list, me: discord.Member, progress: dict):
+    """
+    Extracts the quotes of one page of messages and writes them in a single transaction,
+    together with the scan progress (`progress`, the `Guild` fields the page moves).
+
+    Returns:
+        int: The number of quotes found in the page.
+    """
+    rows = {} # content hash -> row of the first message with it
+    duplicates = []
+    not_quotes = []
+    matched = []
+    for message in messages:
+        if message.author == me or any(reaction.emoji == '🗑️' for reaction in message.reactions):
+            continue
+        matches = await extractMessageQuote(message)
+        if matches:
+            content_hash = contentHash(matches[0], matches[1])
+            if content_hash in rows:
+                duplicates.append(message.id)
+            else:
+                rows[content_hash] = {'messageid': message.id, 'guildid': guild_id, 'content': matches[0], 'author': matches[1], 'contentHash': content_hash, **submitterFields(message)}
+            matched.append(message)
+        else:
+            not_quotes.append(message)
+
+    def write():
+        with db.atomic():
+            if rows:
+                # one lookup for the page, of two messages with the same quote the older one is kept
+                stored = Quote.select(Quote.messageid, Quote.contentHash).where(
+                    Quote.guildid == guild_id, Quote.contentHash.in_(list(rows))).tuples()
+                for messageid, content_hash in stored:
+                    row = rows.get(content_hash)
+                    if row is None or row['messageid'] == messageid:
+                        continue
+                    if messageid < row['messageid']:
+                        duplicates.append(rows.pop(content_hash)['messageid'])
+                    else:
+                        duplicates.append(messageid)
+            if rows:
+                upsert_many(Quote, list(rows.values()), preserve=[Quote.content, Quote.author, Quote.channelid, Quote.submitterid, Quote.submitterName, Quote.submitterAvatar, Quote.sourceHash, Quote.contentHash]).execute()
+            # messages edited since they were stored may not be quotes anymore, or be reposts now
+            removed = [message.id for message in not_quotes] + duplicates
+            if removed:
+                Quote.delete().where(Quote.messageid.in_(removed)).execute()
+            Guild.update(**progress).where(Guild.guildid == guild_id).execute()
+    await run_query(write)
+
+    for row in rows.values():
+        quote_sampler.add(guild_id, row['messageid'])
+        quote_sampler.changed(guild_id, row['messageid']) # may have been stored before with other content
+        quote_index.add(guild_id, row['messageid'], row['content'], row['author'])
+    for message_id in [message.id for message in not_quotes] + duplicates:
+        quote_sampler.remove(guild_id, message_id)
+    # scans only mark quotes, leftovers like an old x or repeat reaction are cleared
+    for message in matched:
+        reaction_scheduler.set_state(message, {QUOTE_REACTION})
+    for message in not_quotes:
+        reaction_scheduler.set_state(message, ())
+    await reaction_scheduler.throttle(messages[0].channel.id)
+    if duplicates:
+        logger.info('Skipped %s duplicate quotes in guild %s', len(duplicates), guild_id)
+    return len(rows)
+
+async def _pages(history):
+    # the messages of a history iterator in pages of `SCAN_PAGE_SIZE`
+    page = []
+    async for message in history:
+        page.append(message)
+        if len(page) >= SCAN_PAGE_SIZE:
+            yield page
+            page = []
+    if page:
+        yield page
+
+async def processChannelMessages(channel: discord.TextChannel, limit = None):
+    """
+    Scans a channel for quotes, one page of `SCAN_PAGE_SIZE` messages at a time. The scanned part of the channel
+    is one range of messages, from `Guild.scannedFrom` to `Guild.quotesProcessedUntil`, and grows in both directions:
+    first forward over the messages newer than the checkpoint, then backwards into the older history.
+    Both ends are stored after every page, so an interrupted scan resumes where it stopped.
+
+    Args:
+        channel (discord.TextChannel): The quote channel.
+        limit (int, optional): The maximum number of messages to scan, newer messages first. None scans everything,
+            including the rest of the history a first scan with a limit didn't reach.
+
+    Returns:
+        dict: The number of messages scanned, quotes found and the throughput in messages per second.
+    """
+    guild_id = channel.guild.id
+    guild, _ = await run_query(Guild.get_or_create, guildid=guild_id)
+    checkpoint = _checkpoint(guild.quotesProcessedUntil)
+    scanned_from = guild.scannedFrom
+
+    start = time.perf_counter()
+    scanned = 0
+    quotes = 0
+
+    async def flush(page, progress):
+        nonlocal scanned, quotes
+        # oldest first within a page, of two messages with the same quote the older one is kept
+        page.sort(key=lambda message: message.id)
+        quotes += await _processPage(guild_id, page, channel.guild.me, progress)
+        scanned += len(page)
+        rate = scanned / (time.perf_counter() - start)
+        logger.info(f'Scanned {scanned} messages ({quotes} quotes, {rate:.1f} msg/s) in {channel.name} - {channel.id}')
+
+    if checkpoint:
+        # messages posted since the last scan, oldest first so the checkpoint moves forward page by page
+        async for page in _pages(channel.history(limit=limit, after=checkpoint, oldest_first=True)):
+            await flush(page, {'quotesProcessedUntil': _utc(max(message.created_at for message in page))})
+
+    remaining = None if limit is None else limit - scanned
+    if scanned_from != 0 and remaining != 0:
+        before = discord.Object(scanned_from) if scanned_from else None
+        if checkpoint and before is None:
+            # scanned before the start of the range was stored: continue below the oldest quote
+            oldest = await run_query(lambda: Quote.select(fn.MIN(Quote.messageid)).where(Quote.guildid == guild_id).scalar())
+            before = discord.Object(oldest) if oldest else checkpoint
+        # older history, newest first so the start of the range moves backwards page by page
+        read = 0
+        async for page in _pages(channel.history(limit=remaining, before=before)):
+            read += len(page)
+            progress = {'scannedFrom': min(message.id for message in page)}
+            if checkpoint is None:
+                # the first page of a first scan holds the newest message
+                checkpoint = max(page, key=lambda message: message.id).created_at
+                progress['quotesProcessedUntil'] = _utc(checkpoint)
+            await flush(page, progress)
+        if checkpoint and (remaining is None or read < remaining):
+            # the history ended before the limit, the whole channel is scanned
+            await run_query(lambda: Guild.update(scannedFrom=0).where(Guild.guildid == guild_id).execute())
+
+    elapsed = time.perf_counter() - start
+    result = {'messages': scanned, 'quotes': quotes, 'seconds': elapsed, 'rate': scanned / elapsed if elapsed else 0.0}
+    logger.info(f'Finished scan of {channel.name} - {channel.id}: {result}')
+    return result
+
+scan_tasks = {} # guild id -> running scan
+
+def startScan(channel: discord.TextChannel, limit=None):
+    """
+    Starts `processChannelMessages` in the background. A scan still running in the guild is stopped first,
+    it would only scan the same messages again.
+    """
+    guild_id = channel.guild.id
+    previous = scan_tasks.get(guild_id)
+    if previous is not None:
+        previous.cancel()
+    task = scan_tasks[guild_id] = asyncio.create_task(processChannelMessages(channel, limit))
+    task.add_done_callback(lambda task: scan_tasks.pop(guild_id) if scan_tasks.get(guild_id) is task else None)
+    return task
+
+async def clearQuotes(bot: discord.Bot, guild: int, channel_id: int):
+    """
+    Deletes all quotes of a guild in one transaction and returns a `ClearJob` that removes
+    the checkmarks from their messages in the background.
+
+    Args:
+        bot (discord.Bot): The bot, used for the reaction calls.
+        guild (int): The guild id.
+        channel_id (int): The quote channel, used for quotes stored without their channel.
+    """
+    def delete():
+        with db.atomic():
+            targets = [(row.messageid, row.channelid or channel_id) for row in Quote.select(Quote.messageid, Quote.channelid).where(Quote.guildid == guild).namedtuples()]
+            Quote.delete().where(Quote.guildid == guild).execute()
+            Guild.update(quotesProcessedUntil=None, scannedFrom=None).where(Guild.guildid == guild).execute()
+        return targets
+    targets = await run_query(delete)
+    quote_sampler.clear(guild)
+    logger.info(f'Cleared {len(targets)} quotes of guild {guild}')
+    job = ClearJob(bot, guild, [target for target in targets if target[1]])
+    clear_jobs[guild] = job
+    return job
@@ -0,0 +1,200 @@
+from collections import OrderedDict
+import asyncio
+import discord
+import math
+import os
+from util.logger import logger
+
+QUOTE_REACTION = '✅'
+NOT_QUOTE_REACTION = '❌'
+PROCESSING_REACTION = '🔁'
+MANAGED_REACTIONS = (QUOTE_REACTION, NOT_QUOTE_REACTION, PROCESSING_REACTION)
+
+REACTION_INTERVAL = float(os.getenv("REACTION_INTERVAL", 0.3)) # seconds between reaction calls in one channel
+REACTION_STATE_SIZE = 10000 # messages whose reactions we remember
+
+class ChannelRateLimiter:
+    """
+    Spaces API calls per channel. Everything that reacts in a channel waits on the same limiter,
+    so concurrent producers share one budget instead of each assuming it has the channel to itself.
+    """
+    def __init__(self, interval=REACTION_INTERVAL):
+        self.interval = interval
+        self._next = {} # channel id -> loop time the next call may start
+
+    async def wait(self, channel_id):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        start = max(now, self._next.get(channel_id, now))
+        self._next[channel_id] = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+        if len(self._next) > 1000:
+            # forget channels that have been idle
+            self._next = {channel: next for channel, next in self._next.items() if next > now}
+
+class TimerWheel:
+    """
+    A hashed timing wheel: one task ticks through the slots and fires the timers that are due,
+    instead of one sleeping coroutine per timer.
+    """
+    def __init__(self, tick=1.0, slots=64):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.position = 0
+        self.pending = 0
+        self._task = None
+
+    def schedule(self, delay, callback, *args):
+        ticks = max(1, math.ceil(delay / self.tick))
+        rounds, offset = divmod(ticks, len(self.slots))
+        if offset == 0:
+            rounds, offset = rounds - 1, len(self.slots)
+        slot = (self.position + offset) % len(self.slots)
+        self.slots[slot].append([rounds, callback, args])
+        self.pending += 1
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while self.pending:
+            await asyncio.sleep(self.tick)
+            self.position = (self.position + 1) % len(self.slots)
+            due = []
+            remaining = []
+            for timer in self.slots[self.position]:
+                if timer[0] == 0:
+                    due.append(timer)
+                else:
+                    timer[0] -= 1
+                    remaining.append(timer)
+            self.slots[self.position] = remaining
+            self.pending -= len(due)
+            for _, callback, args in due:
+                try:
+                    callback(*args)
+                except Exception as e:
+                    logger.error(f'Timer callback failed: {e}')
+
+class ReactionScheduler:
+    """
+    Applies the bot's reactions on messages. Callers set the final state a message should have,
+    the scheduler diffs it against the reactions already on the message and only sends the calls that change something.
+    Calls are queued per channel and spaced by `REACTION_INTERVAL`, and a message that is queued again
+    before its turn is coalesced into a single update.
+    """
+    def __init__(self, limiter=None):
+        self.limiter = limiter or channel_limiter
+        self.timers = TimerWheel()
+        self._queues = {} # channel id -> OrderedDict(message id -> (message, desired reactions))
+        self._workers = {} # channel id -> worker task
+        self._active = {} # channel id -> message id the worker is updating right now
+        self._state = OrderedDict() # message id -> reactions the bot has on it
+        self.calls = 0
+        self.skipped = 0
+        self.coalesced = 0
+        self.failed = 0
+
+    def _current(self, message):
+        state = self._state.get(message.id)
+        if state is None:
+            state = frozenset(str(reaction.emoji) for reaction in message.reactions if reaction.me and str(reaction.emoji) in MANAGED_REACTIONS)
+        return state
+
+    def _remember(self, message_id, state):
+        self._state[message_id] = state
+        self._state.move_to_end(message_id)
+        if len(self._state) > REACTION_STATE_SIZE:
+            self._state.popitem(last=False)
+
+    def forget(self, message_id):
+        # the reactions were changed outside the scheduler, read them from the message again next time
+        self._state.pop(message_id, None)
+
+    def pending(self, channel_id=None):
+        if channel_id is None:
+            return sum(len(queue) for queue in self._queues.values())
+        return len(self._queues.get(channel_id, ()))
+
+    def set_state(self, message: discord.Message, desired, expire=None, expire_after=0):
+        """
+        Sets the reactions the bot should have on a message.
+
+        Args:
+            message (discord.Message): The message.
+            desired (set): The reactions out of `MANAGED_REACTIONS` the bot should have, e.g. {'✅'}.
+            expire (str, optional): A reaction to remove again after `expire_after` seconds.
+            expire_after (float, optional): Seconds until `expire` is removed.
+        """
+        desired = frozenset(desired)
+        queue = self._queues.get(message.channel.id)
+        if queue is not None and message.id in queue:
+            self.coalesced += 1
+            queue[message.id] = (message, desired)
+        elif desired == self._current(message) and self._active.get(message.channel.id) != message.id:
+            self.skipped += 1
+        else:
+            if queue is None:
+                queue = self._queues[message.channel.id] = OrderedDict()
+            queue[message.id] = (message, desired)
+            worker = self._workers.get(message.channel.id)
+            if worker is None or worker.done():
+                self._workers[message.channel.id] = asyncio.create_task(self._work(message.channel.id))
+        if expire:
+            self.timers.schedule(expire_after, self._expire, message, expire)
+
+    def _expire(self, message, reaction):
+        queued = self._queues.get(message.channel.id, {}).get(message.id)
+        desired = queued[1] if queued else self._current(message)
+        if reaction in desired:
+            self.set_state(message, desired - {reaction})
+
+    async def throttle(self, channel_id, max_pending=500):
+        """
+        Waits until the channel's queue is short enough, so bulk producers like a scan don't buffer unbounded work.
+        """
+        while self.pending(channel_id) > max_pending:
+            await asyncio.sleep(self.limiter.interval * 10)
+
+    async def _work(self, channel_id):
+        queue = self._queues[channel_id]
+        while queue:
+            message_id, (message, desired) = queue.popitem(last=False)
+            self._active[channel_id] = message_id
+            current = self._current(message)
+            for reaction in MANAGED_REACTIONS:
+                if (reaction in desired) == (reaction in current):
+                    continue
+                await self.limiter.wait(channel_id)
+                try:
+                    if reaction in desired:
+                        await message.add_reaction(reaction)
+                    else:
+                        await message.remove_reaction(reaction, message.guild.me)
+                    self.calls += 1
+                except discord.NotFound:
+                    # the message is gone, nothing left to update
+                    self.failed += 1
+                    break
+                except discord.HTTPException as e:
+                    self.failed += 1
+                    logger.error(f'Error updating reaction {reaction} on message: {message_id} - {e}')
+                    continue
+                current = current ^ {reaction}
+                self._remember(message_id, current)
+        self._queues.pop(channel_id, None)
+        self._workers.pop(channel_id, None)
+        self._active.pop(channel_id, None)
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'skipped': self.skipped,
+            'coalesced': self.coalesced,
+            'failed': self.failed,
+            'pending': self.pending(),
+            'timers': self.timers.pending,
+        }
+
+channel_limiter = ChannelRateLimiter()
+reaction_scheduler = ReactionScheduler()
@@ -21,6 +21,128 @@ def addRegex(pattern, groupHandler):
     """
     regexes.append((pattern, groupHandler))
 
+class QuoteExtractor:
+    """
+    Extracts quotes with precompiled patterns: a guild's custom regex (if any) first, then the built-in ones.
+    Build it once per regex configuration with `get_extractor` and reuse it for every message.
+    """
+    __slots__ = ('customRegex', 'customReverse', 'builtins', 'patterns')
+
+    def __init__(self, customRegex=None, customReverse=False):
+        self.customRegex = customRegex or None
+        self.customReverse = bool(customReverse)
+        self.builtins = tuple((re.compile(pattern), handler) for pattern, handler in regexes)
+        patterns = []
+        if customRegex:
+            if customReverse:
+                patterns.append((re.compile(customRegex), lambda match: (match.group(2), match.group(1))))
+            else:
+                patterns.append((re.compile(customRegex), lambda match: (match.group(1), match.group(2))))
+        self.patterns = tuple(patterns) + self.builtins
+
+    @staticmethod
+    def combine(message, start, quote, author):
+        """
+        Combines all content preceding the last match with its quote.
+
+        Returns:
+            tuple: A tuple containing the combined content and the author, or None if either is empty.
+        """
+        if not quote or not author:
+            return None
+        preceding_content = message[:start].strip()
+        if preceding_content:
+            return f'{preceding_content}\n"{quote}"', author
+        return f'"{quote}"', author
+
+    def fromCustomMatch(self, message, match):
+        """
+        Builds the result from a custom regex match found elsewhere (see `util.regexguard`).
+
+        Args:
+            message (str): The message the match was found in.
+            match (tuple): (start, group 1, group 2) of the last match.
+        """
+        start, first, second = match
+        if self.customReverse:
+            first, second = second, first
+        return self.combine(message, start, first, second)
+
+    def extract(self, message, builtinOnly=False):
+        """
+        Extracts the quote and author from a message.
+        If multiple quotes are present, only the last author's name is extracted,
+        and the preceding quotes are treated as part of the content.
+
+        Args:
+            message (str): The message to extract the quote from.
+            builtinOnly (bool, optional): If True, skips the custom regex.
+
+        Returns:
+            tuple: A tuple containing the combined content and the last author, or None if not found.
+        """
+        # Try each regex pattern
+        for pattern, handler in self.builtins if builtinOnly else self.patterns:
+            last_match = None
+            for last_match in pattern.finditer(message):
+                pass
+            if last_match:
+                last_quote, last_author = handler(last_match)
+                return self.combine(message, last_match.start(), last_quote, last_author)
+
+        return None
+
+def validateRegex(pattern):
+    """
+    Checks that a custom regex compiles and has the two groups the extractor needs.
+
+    Args:
+        pattern (str): The regex pattern to check.
+
+    Returns:
+        str: A description of the problem, or None if the pattern is usable.
+    """
+    try:
+        compiled = re.compile(pattern)
+    except re.error as e:
+        return f'Invalid regex: {e}'
+    if compiled.groups < 2:
+        return 'The regex needs two groups, one for the quote and one for the author.'
+    return None
+
+_default_extractor = None
+_guild_extractors = {} # guild id -> ((regex, reverse), extractor)
+
+def get_extractor(guild=None, customRegex=None, customReverse=False):
+    """
+    Returns the cached extractor for a guild, building it only when the guild's regex configuration changed.
+    Guilds without a custom regex share one extractor with the built-in patterns.
+
+    Args:
+        guild (int, optional): The guild id.
+        customRegex (str, optional): The guild's custom regex pattern.
+        customReverse (bool, optional): If True, reverses the group order for the custom regex.
+
+    Returns:
+        QuoteExtractor: The extractor to use for the guild's messages.
+    """
+    global _default_extractor
+    if not customRegex:
+        _guild_extractors.pop(guild, None)
+        if _default_extractor is None:
+            _default_extractor = QuoteExtractor()
+        return _default_extractor
+    key = (customRegex, bool(customReverse))
+    cached = _guild_extractors.get(guild)
+    if cached and cached[0] == key:
+        return cached[1]
+    extractor = QuoteExtractor(customRegex, customReverse)
+    _guild_extractors[guild] = (key, extractor)
+    return extractor
+
+def drop_extractor(guild):
+    _guild_extractors.pop(guild, None)
+
 def extractQuote(message, customRegex=None, customReverse=False):
     """
     Extracts the quote and author from a message using regex patterns.
@@ -35,33 +157,7 @@ def extractQuote(message, customRegex=None, customReverse=False):
     Returns:
         tuple: A tuple containing the combined content and the last author, or None if not found.
     """
-    if customRegex:
-        if customReverse:
-            addRegex(customRegex, lambda match: (match.group(2), match.group(1)))
-        else:
-            addRegex(customRegex, lambda match: (match.group(1), match.group(2)))
-
-    last_quote = None
-    last_author = None
-
-    # Try each regex pattern
-    for regex, handler in regexes:
-        matches = list(re.finditer(regex, message))
-        if matches:
-            last_match = matches[-1]
-            last_quote, last_author = handler(last_match)
-            # Combine all preceding content with the last quote
-            preceding_content = message[:last_match.start()].strip()
-            if preceding_content:
-                last_quote = f'{preceding_content}\n"{last_quote}"'
-            else:
-                last_quote = f'"{last_quote}"'
-            break
-
-    if last_quote and last_author:
-        return last_quote, last_author
-
-    return None
+    return get_extractor(None, customRegex, customReverse).extract(message)
 
 if __name__ == "__main__":
     # Example usage
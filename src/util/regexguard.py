@@ -0,0 +1,184 @@
+import asyncio
+import json
+import os
+import sys
+from util.logger import logger
+
+REGEX_MATCH_TIMEOUT = float(os.getenv("REGEX_MATCH_TIMEOUT", 0.25)) # seconds a custom regex may run on one message
+# seconds per corpus entry when setting a regex, never more than a match may take on a real message
+REGEX_VALIDATION_TIMEOUT = min(float(os.getenv("REGEX_VALIDATION_TIMEOUT", REGEX_MATCH_TIMEOUT)), REGEX_MATCH_TIMEOUT)
+REGEX_MAX_TIMEOUTS = int(os.getenv("REGEX_MAX_TIMEOUTS", 3)) # consecutive timeouts before a custom regex is disabled
+WORKER_START_TIMEOUT = 10 # seconds a new worker may take to import and report ready, outside any match budget
+REGEX_WORKERS = int(os.getenv("REGEX_WORKERS", 2)) # worker processes, a slow pattern of one guild doesn't hold up the others
+REGEX_KILL_GRACE = 1.0 # seconds past the budget before a worker that hasn't answered is killed
+
+WORKER_PATH = os.path.join(os.path.dirname(__file__), 'regexworker.py')
+
+# Inputs that make backtracking patterns blow up, e.g. (a+)+b, (.*)*: or ("?.+"?)+ - kept at discord's message length
+PATHOLOGICAL_CORPUS = [
+    'a' * 4000,
+    'a' * 4000 + '!',
+    '"' * 4000,
+    '"' + 'a' * 3998,
+    ':' * 4000,
+    'a:' * 2000,
+    ' ' * 4000,
+    '- ' * 2000,
+    '"a" ' * 1000,
+    '"a" - ' * 666,
+    'ab' * 2000,
+    '\n'.join(['"quote" - author'] * 200),
+]
+
+class RegexTimeout(Exception):
+    pass
+
+class _Worker:
+    # one slot of the pool, its process is started on first use and after it was killed
+    __slots__ = ('process',)
+
+    def __init__(self):
+        self.process = None
+
+class RegexSandbox:
+    """
+    Worker processes that run custom regexes. Python's `re` can't be interrupted, so a match that runs far past
+    its budget is stopped by killing its worker, which is restarted on the next request.
+    Whether a match was too slow is decided by the time the worker measured, so waiting for a free worker
+    or a busy event loop never counts against a guild's regex.
+    """
+    def __init__(self, workers=REGEX_WORKERS):
+        self._idle = asyncio.Queue()
+        for _ in range(workers):
+            self._idle.put_nowait(_Worker())
+        self.matches = 0
+        self.timeouts = 0
+        self.restarts = 0
+
+    async def _ensure_worker(self, worker):
+        if worker.process is None or worker.process.returncode is not None:
+            worker.process = await asyncio.create_subprocess_exec(
+                sys.executable, WORKER_PATH,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                limit=2 ** 20,
+            )
+            # the interpreter starts up before the first match is timed, a slow start isn't the pattern's fault
+            try:
+                ready = await asyncio.wait_for(worker.process.stdout.readline(), WORKER_START_TIMEOUT)
+            except BaseException:
+                self._abandon(worker)
+                raise
+            if not ready:
+                self._abandon(worker)
+                raise OSError('Regex worker exited on startup')
+        return worker.process
+
+    def _abandon(self, worker):
+        # the worker may still be running a match or hold a reply nobody will read, it must not answer the next request
+        process, worker.process = worker.process, None
+        if process and process.returncode is None:
+            process.kill()
+        self.restarts += 1
+
+    async def _kill(self, worker):
+        process = worker.process
+        self._abandon(worker)
+        if process:
+            await process.wait()
+
+    async def match(self, pattern, text, timeout=None):
+        """
+        Finds the last match of `pattern` in `text` in a worker process.
+
+        Returns:
+            tuple: (start, group 1, group 2) of the last match, or None if the pattern doesn't match.
+
+        Raises:
+            RegexTimeout: If the match took longer than the timeout.
+            ValueError: If the pattern is invalid.
+            OSError: If the worker can't be started.
+        """
+        timeout = timeout or REGEX_MATCH_TIMEOUT
+        worker = await self._idle.get()
+        try:
+            process = await self._ensure_worker(worker)
+            process.stdin.write((json.dumps({'pattern': pattern, 'text': text}) + '\n').encode())
+            try:
+                await process.stdin.drain()
+                # only a worker that is still busy well past the budget is killed, the budget itself is checked below
+                line = await asyncio.wait_for(process.stdout.readline(), timeout + REGEX_KILL_GRACE)
+            except asyncio.TimeoutError:
+                self.timeouts += 1
+                await self._kill(worker)
+                raise RegexTimeout(pattern)
+            except (BrokenPipeError, ConnectionResetError):
+                await self._kill(worker)
+                raise
+            except asyncio.CancelledError:
+                # the reply to this request would be read as the reply to the next one
+                self._abandon(worker)
+                raise
+            if not line:
+                # the worker died (e.g. out of memory), treat it like a timeout
+                await self._kill(worker)
+                self.timeouts += 1
+                raise RegexTimeout(pattern)
+        finally:
+            self._idle.put_nowait(worker)
+        self.matches += 1
+        response = json.loads(line)
+        if 'error' in response:
+            raise ValueError(response['error'])
+        if response['elapsed'] > timeout:
+            self.timeouts += 1
+            raise RegexTimeout(pattern)
+        return tuple(response['match']) if response['match'] else None
+
+    async def validate(self, pattern):
+        """
+        Runs a pattern against the pathological corpus.
+
+        Returns:
+            str: A description of the problem, or None if the pattern stayed within budget for every input.
+        """
+        for text in PATHOLOGICAL_CORPUS:
+            try:
+                await self.match(pattern, text, REGEX_VALIDATION_TIMEOUT)
+            except RegexTimeout:
+                return f'The regex is too slow on some messages (more than {REGEX_VALIDATION_TIMEOUT}s on a {len(text)} character input). Please simplify it.'
+            except ValueError as e:
+                return f'Invalid regex: {e}'
+            except OSError as e:
+                logger.error(f'Regex sandbox failed while validating {pattern}: {e}')
+                return 'The regex could not be checked right now. Please try again later.'
+        return None
+
+    def stats(self):
+        return {'matches': self.matches, 'timeouts': self.timeouts, 'restarts': self.restarts}
+
+class RegexFailureTracker:
+    """
+    Counts consecutive match timeouts per guild, so a pattern that keeps timing out can be disabled.
+    """
+    def __init__(self, limit=REGEX_MAX_TIMEOUTS):
+        self.limit = limit
+        self._timeouts = {}
+
+    def success(self, guild_id):
+        self._timeouts.pop(guild_id, None)
+
+    def timeout(self, guild_id) -> bool:
+        """
+        Records a timeout. Returns True once the guild reached the limit.
+        """
+        count = self._timeouts.get(guild_id, 0) + 1
+        if count >= self.limit:
+            self._timeouts.pop(guild_id, None)
+            logger.warning(f'Custom regex of guild {guild_id} timed out {count} times in a row')
+            return True
+        self._timeouts[guild_id] = count
+        return False
+
+regex_sandbox = RegexSandbox()
+regex_failures = RegexFailureTracker()
@@ -0,0 +1,43 @@
+"""
+Runs user-supplied regexes in a separate process, see `util.regexguard`.
+Reads one JSON request per line from stdin: {"pattern": ..., "text": ...}
+Writes "ready" once started, then one JSON response per line to stdout: {"match": [start, group1, group2] of the last match or null,
+"elapsed": seconds the match took}, or {"error": ...}
+"""
+import json
+import re
+import sys
+import time
+
+MAX_COMPILED = 256
+
+def main():
+    compiled = {}
+    # tells the parent the interpreter is up, so startup isn't counted against the first match
+    sys.stdout.write('"ready"\n')
+    sys.stdout.flush()
+    for line in sys.stdin:
+        request = json.loads(line)
+        try:
+            regex = compiled.get(request['pattern'])
+            if regex is None:
+                if len(compiled) >= MAX_COMPILED:
+                    compiled.clear()
+                regex = compiled[request['pattern']] = re.compile(request['pattern'])
+            # timed here, so the parent's queueing and event loop lag never count against the pattern
+            start = time.perf_counter()
+            last_match = None
+            for last_match in regex.finditer(request['text']):
+                pass
+            elapsed = time.perf_counter() - start
+            if last_match:
+                response = {'match': [last_match.start(), last_match.group(1), last_match.group(2)], 'elapsed': elapsed}
+            else:
+                response = {'match': None, 'elapsed': elapsed}
+        except (re.error, IndexError) as e:
+            response = {'error': str(e)}
+        sys.stdout.write(json.dumps(response) + '\n')
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+import asyncio
+import random
+from util.db import Quote, run_query
+from util.logger import logger
+
+class GuildQuoteIds:
+    """
+    The quote ids of one guild. Adding, removing and picking a random id are all O(1):
+    removal swaps the last id into the freed slot.
+    """
+    __slots__ = ('ids', 'positions', 'bags')
+
+    def __init__(self, ids=()):
+        self.ids = list(ids)
+        self.positions = {messageid: index for index, messageid in enumerate(self.ids)}
+        self.bags = {} # bag key (e.g. a channel id) -> shuffled ids not handed out yet
+
+    def add(self, messageid):
+        if messageid not in self.positions:
+            self.positions[messageid] = len(self.ids)
+            self.ids.append(messageid)
+
+    def remove(self, messageid):
+        index = self.positions.pop(messageid, None)
+        if index is None:
+            return
+        last = self.ids.pop()
+        if index < len(self.ids):
+            self.ids[index] = last
+            self.positions[last] = index
+
+    def reset(self, _=None):
+        self.ids.clear()
+        self.positions.clear()
+        self.bags.clear()
+
+    def pick(self):
+        return random.choice(self.ids) if self.ids else None
+
+    def pick_from_bag(self, key):
+        """
+        Picks without repeats per bag: every quote comes up once before any comes up again.
+        Quotes removed since the bag was filled are skipped, quotes added join with the next bag.
+        """
+        bag = self.bags.get(key)
+        while bag:
+            messageid = bag.pop()
+            if messageid in self.positions:
+                return messageid
+        if not self.ids:
+            return None
+        bag = self.ids.copy()
+        random.shuffle(bag)
+        self.bags[key] = bag
+        return bag.pop()
+
+class QuoteSampler:
+    """
+    Picks random quotes with a single primary key lookup instead of `ORDER BY RAND()`.
+    A guild's ids are loaded on first use and then kept up to date by every path that adds or removes quotes.
+    Since every such path goes through here, subscribers are told about removed and edited quotes.
+    """
+    def __init__(self):
+        self._guilds = {}
+        self._loading = {} # guild id -> load task
+        self._pending = {} # guild id -> changes made while the guild was loading
+        self._subscribers = [] # called with (guild id, message id) when a quote is removed or edited, message id None for all
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def _notify(self, guild_id, messageid=None):
+        for callback in self._subscribers:
+            callback(guild_id, messageid)
+
+    async def _load(self, guild_id):
+        try:
+            ids = await run_query(lambda: [row.messageid for row in Quote.select(Quote.messageid).where(Quote.guildid == guild_id).namedtuples()])
+            guild = GuildQuoteIds(ids)
+            # apply what happened while the query was running
+            for change, messageid in self._pending[guild_id]:
+                getattr(guild, change)(messageid)
+            self._guilds[guild_id] = guild
+            logger.info(f'Loaded {len(guild.ids)} quote ids for guild {guild_id}')
+            return guild
+        finally:
+            self._pending.pop(guild_id, None)
+            self._loading.pop(guild_id, None)
+
+    async def _get(self, guild_id) -> GuildQuoteIds:
+        guild = self._guilds.get(guild_id)
+        if guild is not None:
+            return guild
+        task = self._loading.get(guild_id)
+        if task is None:
+            self._pending[guild_id] = []
+            task = self._loading[guild_id] = asyncio.create_task(self._load(guild_id))
+        return await task
+
+    def _change(self, guild_id, change, messageid):
+        guild = self._guilds.get(guild_id)
+        if guild is not None:
+            getattr(guild, change)(messageid)
+        elif guild_id in self._pending:
+            self._pending[guild_id].append((change, messageid))
+
+    def add(self, guild_id, messageid):
+        self._change(guild_id, 'add', messageid)
+
+    def remove(self, guild_id, messageid):
+        self._change(guild_id, 'remove', messageid)
+        self._notify(guild_id, messageid)
+
+    def changed(self, guild_id, messageid):
+        # the quote was edited, its id stays
+        self._notify(guild_id, messageid)
+
+    def clear(self, guild_id):
+        if guild_id in self._pending:
+            self._pending[guild_id].append(('reset', None))
+        else:
+            self._guilds[guild_id] = GuildQuoteIds()
+        self._notify(guild_id)
+
+    def drop(self, guild_id):
+        self._guilds.pop(guild_id, None)
+        self._notify(guild_id)
+
+    async def count(self, guild_id) -> int:
+        return len((await self._get(guild_id)).ids)
+
+    async def random_quote(self, guild_id, bag=None):
+        """
+        Returns a random quote of the guild, or None if it has no quotes.
+
+        Args:
+            guild_id (int): The guild to pick from.
+            bag (hashable, optional): If given, picks from this shuffle bag (e.g. a channel id) so quotes don't repeat.
+        """
+        guild = await self._get(guild_id)
+        for _ in range(5):
+            messageid = guild.pick_from_bag(bag) if bag is not None else guild.pick()
+            if messageid is None:
+                return None
+            quote = await run_query(Quote.get_or_none, Quote.messageid == messageid)
+            if quote is not None:
+                return quote
+            # deleted behind our back (e.g. directly in the database)
+            self.remove(guild_id, messageid)
+        return None
+
+quote_sampler = QuoteSampler()
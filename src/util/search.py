@@ -0,0 +1,245 @@
+from collections import OrderedDict
+import asyncio
+import bisect
+import heapq
+import os
+import re
+import unicodedata
+from util.db import Quote, run_query
+from util.sampler import quote_sampler
+from util.logger import logger
+
+SEARCH_PAGE_SIZE = 10 # results per /search page
+SEARCH_INDEX_GUILDS = int(os.getenv("SEARCH_INDEX_GUILDS", 100)) # guild indexes kept in memory, the least recently searched are dropped
+SEARCH_LOAD_BATCH = 5000 # quotes read per query while an index is built
+TOKEN_PATTERN = re.compile(r'\w+')
+
+def normalize(text: str) -> str:
+    return unicodedata.normalize('NFKC', text or '').casefold()
+
+def tokenize(text: str):
+    return TOKEN_PATTERN.findall(normalize(text))
+
+class GuildIndex:
+    """
+    An inverted index of one guild's quotes: every word maps to the ids of the quotes containing it.
+    """
+    __slots__ = ('postings', 'documents', '_vocabulary')
+
+    def __init__(self):
+        self.postings = {} # word -> set of message ids
+        self.documents = {} # message id -> (words, normalized author)
+        self._vocabulary = None # sorted words for prefix lookups, rebuilt after new words were added
+
+    def add(self, messageid, content, author):
+        self.remove(messageid)
+        words = frozenset(tokenize(content))
+        self.documents[messageid] = (words, normalize(author))
+        for word in words:
+            ids = self.postings.get(word)
+            if ids is None:
+                ids = self.postings[word] = set()
+                self._vocabulary = None
+            ids.add(messageid)
+
+    def remove(self, messageid):
+        document = self.documents.pop(messageid, None)
+        if document is None:
+            return
+        for word in document[0]:
+            ids = self.postings[word]
+            ids.discard(messageid)
+            if not ids:
+                del self.postings[word]
+                self._vocabulary = None
+
+    def reset(self):
+        self.postings.clear()
+        self.documents.clear()
+        self._vocabulary = None
+
+    def _prefixed(self, prefix):
+        # the ids of all words starting with `prefix`, found by bisecting the sorted vocabulary
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self.postings)
+        start = end = bisect.bisect_left(self._vocabulary, prefix)
+        while end < len(self._vocabulary) and self._vocabulary[end].startswith(prefix):
+            end += 1
+        if end - start == 1:
+            return self.postings[self._vocabulary[start]]
+        return set().union(*(self.postings[word] for word in self._vocabulary[start:end]))
+
+    def matches(self, words, author=None):
+        """
+        Returns the ids of the quotes containing all `words`, the last one may also be the start of a word
+        so results show up while it is typed. `author` is matched as part of the quote's author.
+        """
+        if not words:
+            return set()
+        sets = [self.postings.get(word, set()) for word in words[:-1]]
+        sets.append(self._prefixed(words[-1]))
+        sets.sort(key=len)
+        result = sets[0]
+        for ids in sets[1:]:
+            if not result:
+                break
+            result = result & ids
+        if author:
+            result = {messageid for messageid in result if author in self.documents[messageid][1]}
+        return result # may be one of the postings, never change it
+
+class SearchPage:
+    __slots__ = ('quotes', 'total', 'newer', 'older')
+
+    def __init__(self, quotes, total, newer, older):
+        self.quotes = quotes # the quote rows of the page, newest first
+        self.total = total # quotes matching the search
+        self.newer = newer # whether there are results before / after this page
+        self.older = older
+
+class QuoteIndex:
+    """
+    Full text search over the quotes of a guild without scanning the table: a guild's index is built on its
+    first search and then kept up to date by the paths that store quotes and, through the sampler, by everything
+    that removes or edits them. Results are paged by message id (keyset), so deep pages cost the same as the first.
+    """
+    def __init__(self, capacity=SEARCH_INDEX_GUILDS):
+        self.capacity = capacity
+        self._guilds = OrderedDict() # guild id -> GuildIndex, least recently searched first
+        self._loading = {} # guild id -> load task
+        self._pending = {} # guild id -> changes made while the guild was loading
+        self.searches = 0
+        self.loads = 0
+        quote_sampler.subscribe(self.invalidate)
+
+    async def _load(self, guild_id):
+        try:
+            index = GuildIndex()
+            last = 0
+            while True:
+                # keyset batches, each indexed on the database thread that read it
+                def read(last=last):
+                    rows = list(Quote.select(Quote.messageid, Quote.content, Quote.author)
+                                .where(Quote.guildid == guild_id, Quote.messageid > last)
+                                .order_by(Quote.messageid).limit(SEARCH_LOAD_BATCH).tuples())
+                    for messageid, content, author in rows:
+                        index.add(messageid, content, author)
+                    return rows[-1][0] if rows else None
+                last = await run_query(read)
+                if last is None:
+                    break
+            # apply what happened while the index was built
+            for change, args in self._pending[guild_id]:
+                getattr(index, change)(*args)
+            self._guilds[guild_id] = index
+            self.loads += 1
+            while len(self._guilds) > self.capacity:
+                self._guilds.popitem(last=False)
+            logger.info(f'Built search index of guild {guild_id}: {len(index.documents)} quotes, {len(index.postings)} words')
+            return index
+        finally:
+            self._pending.pop(guild_id, None)
+            self._loading.pop(guild_id, None)
+
+    async def _get(self, guild_id) -> GuildIndex:
+        index = self._guilds.get(guild_id)
+        if index is not None:
+            self._guilds.move_to_end(guild_id)
+            return index
+        task = self._loading.get(guild_id)
+        if task is None:
+            self._pending[guild_id] = []
+            task = self._loading[guild_id] = asyncio.create_task(self._load(guild_id))
+        return await task
+
+    def _change(self, guild_id, change, *args):
+        # guilds that were never searched are indexed from the database on their first search
+        index = self._guilds.get(guild_id)
+        if index is not None:
+            getattr(index, change)(*args)
+        elif guild_id in self._pending:
+            self._pending[guild_id].append((change, args))
+
+    def add(self, guild_id, messageid, content, author):
+        # a stored or updated quote
+        self._change(guild_id, 'add', messageid, content, author)
+
+    def invalidate(self, guild_id, messageid=None):
+        # the quote was deleted or edited (the new text is added right after)
+        if messageid is not None:
+            self._change(guild_id, 'remove', messageid)
+        elif guild_id in self._pending:
+            self._pending[guild_id].append(('reset', ()))
+        else:
+            # all quotes changed (cleared or reloaded), the index is built again on the next search
+            self._guilds.pop(guild_id, None)
+
+    async def search(self, guild_id, text, author=None, before=None, after=None, limit=SEARCH_PAGE_SIZE) -> SearchPage:
+        """
+        Finds the quotes containing every word of `text`, newest first.
+
+        Args:
+            guild_id (int): The guild to search.
+            text (str): The words to search for, the last one may be incomplete.
+            author (str, optional): Part of the author's name.
+            before (int, optional): Returns the page of results older than this message id.
+            after (int, optional): Returns the page of results newer than this message id.
+            limit (int, optional): The page size.
+
+        Returns:
+            SearchPage: The page of quotes and whether there are newer or older results.
+        """
+        self.searches += 1
+        index = await self._get(guild_id)
+        matches = index.matches(tokenize(text), normalize(author).strip() or None)
+        # one more than the page tells if there is another page in the direction of paging
+        if after is not None:
+            page = heapq.nsmallest(limit + 1, (messageid for messageid in matches if messageid > after))
+            newer = len(page) > limit
+            page = page[:limit][::-1]
+            older = any(messageid <= after for messageid in matches)
+        else:
+            page = heapq.nlargest(limit + 1, matches if before is None else (messageid for messageid in matches if messageid < before))
+            older = len(page) > limit
+            page = page[:limit]
+            newer = before is not None and any(messageid >= before for messageid in matches)
+        quotes = []
+        if page:
+            rows = await run_query(lambda: {quote.messageid: quote for quote in Quote.select().where(Quote.messageid.in_(page))})
+            for messageid in page:
+                quote = rows.get(messageid)
+                if quote is None:
+                    # deleted behind our back (e.g. directly in the database)
+                    quote_sampler.remove(guild_id, messageid)
+                else:
+                    quotes.append(quote)
+        return SearchPage(quotes, len(matches), newer, older)
+
+    def stats(self):
+        return {
+            'guilds': len(self._guilds),
+            'quotes': sum(len(index.documents) for index in self._guilds.values()),
+            'words': sum(len(index.postings) for index in self._guilds.values()),
+            'searches': self.searches,
+            'loads': self.loads,
+        }
+
+class RecentSearches:
+    """
+    The text of recent searches by the id of their response, so the page buttons only need to carry the cursor.
+    """
+    def __init__(self, capacity=200):
+        self.capacity = capacity
+        self._searches = OrderedDict()
+
+    def put(self, key, text, author):
+        self._searches[key] = (text, author)
+        self._searches.move_to_end(key)
+        while len(self._searches) > self.capacity:
+            self._searches.popitem(last=False)
+
+    def get(self, key):
+        return self._searches.get(key)
+
+quote_index = QuoteIndex()
+recent_searches = RecentSearches()
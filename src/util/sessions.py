@@ -0,0 +1,135 @@
+from collections import OrderedDict
+import discord
+import time
+import os
+from util.sampler import quote_sampler
+from util.logger import logger
+
+GAME_SESSION_CAPACITY = int(os.getenv("GAME_SESSION_CAPACITY", 500)) # /guess sessions kept in memory
+GAME_SESSION_TTL = int(os.getenv("GAME_SESSION_TTL", 900)) # seconds an unrevealed session is kept in memory
+GAME_SESSION_MEMORY = int(os.getenv("GAME_SESSION_MEMORY", 32 * 1024 * 1024)) # bytes of revealed cards kept over all sessions
+CUSTOM_ID_PREFIX = 'quotr'
+
+class GameSession:
+    """
+    What a /guess message needs to be revealed without asking the database or the renderer again.
+    Everything else is encoded in the buttons, so a session that is gone (evicted, expired, restart) is rebuilt from the quote.
+    """
+    __slots__ = ('quote', 'background_color', 'revealed', 'expires')
+
+    def __init__(self, quote, background_color, revealed=None, expires=0.0):
+        self.quote = quote
+        self.background_color = background_color
+        self.revealed = revealed # encoded image bytes of the revealed card
+        self.expires = expires
+
+    @property
+    def size(self):
+        return len(self.revealed) if self.revealed else 0
+
+class SessionStore:
+    """
+    Game sessions by id, oldest first. Sessions expire `ttl` seconds after they were stored and the oldest
+    are evicted beyond `capacity` sessions or `memory` bytes of cards (animated ones are large),
+    so memory stays bounded however many games are running.
+    """
+    def __init__(self, capacity=GAME_SESSION_CAPACITY, ttl=GAME_SESSION_TTL, memory=GAME_SESSION_MEMORY):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.memory = memory
+        self.bytes = 0
+        self._sessions = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        quote_sampler.subscribe(self.invalidate)
+
+    def put(self, session_id, session: GameSession):
+        session.expires = time.monotonic() + self.ttl
+        self._remove(session_id)
+        self._sessions[session_id] = session
+        self.bytes += session.size
+        self._expire()
+        while len(self._sessions) > self.capacity or (self.bytes > self.memory and len(self._sessions) > 1):
+            self._remove(next(iter(self._sessions)))
+            self.evicted += 1
+
+    def _remove(self, session_id):
+        session = self._sessions.pop(session_id, None)
+        if session is not None:
+            self.bytes -= session.size
+        return session
+
+    def pop(self, session_id):
+        """
+        Takes a session out of the store, a game is revealed once. Returns None if it is gone.
+        """
+        session = self._remove(session_id)
+        if session is None or session.expires < time.monotonic():
+            self.misses += 1
+            return None
+        self.hits += 1
+        return session
+
+    def _expire(self):
+        # ordered by age, so the expired ones are at the front
+        now = time.monotonic()
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if session.expires >= now:
+                break
+            self._remove(session_id)
+            self.evicted += 1
+
+    def invalidate(self, guild_id, messageid=None):
+        # the quote was deleted or edited, the next reveal reads it again
+        stale = [session_id for session_id, session in self._sessions.items()
+                 if session.quote.guildid_id == guild_id and messageid in (None, session.quote.messageid)]
+        for session_id in stale:
+            self._remove(session_id)
+
+    def stats(self):
+        return {'sessions': len(self._sessions), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses, 'evicted': self.evicted}
+
+class ComponentRouter:
+    """
+    Routes button clicks by custom id (`quotr:<action>:<args>`) instead of per-message view callbacks,
+    so buttons keep working after a restart. Handlers are registered with `@components.handler('action')`
+    and called with the interaction and the arguments from the custom id.
+    """
+    def __init__(self):
+        self._handlers = {}
+
+    def handler(self, action):
+        def register(func):
+            self._handlers[action] = func
+            return func
+        return register
+
+    @staticmethod
+    def custom_id(action, *args):
+        return ':'.join(map(str, (CUSTOM_ID_PREFIX, action) + args))
+
+    @staticmethod
+    def view(*items):
+        # the library must not track these views, their clicks are routed by `dispatch`
+        view = discord.ui.View(timeout=None)
+        for item in items:
+            view.add_item(item)
+        view.stop()
+        return view
+
+    async def dispatch(self, interaction: discord.Interaction):
+        if interaction.type != discord.InteractionType.component:
+            return
+        parts = (interaction.custom_id or '').split(':')
+        if parts[0] != CUSTOM_ID_PREFIX or len(parts) < 2:
+            return
+        handler = self._handlers.get(parts[1])
+        if handler is None:
+            logger.warning(f'No handler for button: {interaction.custom_id}')
+            return
+        await handler(interaction, *parts[2:])
+
+game_sessions = SessionStore()
+components = ComponentRouter()
@@ -0,0 +1,90 @@
+import math
+import os
+import discord
+
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", 0)) # total shards of the bot, 0 runs a single unsharded connection
+SHARD_IDS = [int(shard) for shard in os.getenv("SHARD_IDS", "").split(',') if shard.strip()] or None # shards of this process, default all
+
+def shard_for(guild_id: int, shard_count: int) -> int:
+    # the formula discord uses to route a guild's gateway events
+    return (guild_id >> 22) % shard_count
+
+class ShardSet:
+    """
+    The shards this process runs. Discord only sends a guild's events to the shard it belongs to,
+    so per-guild state that is loaded up front (e.g. the guild configs) must be limited to the owned guilds,
+    everything that is filled lazily by events is partitioned by itself.
+    """
+    def __init__(self, count=SHARD_COUNT, ids=SHARD_IDS):
+        self.count = count
+        if not count:
+            self.ids = None
+        elif ids is None:
+            self.ids = frozenset(range(count))
+        else:
+            invalid = [shard for shard in ids if not 0 <= shard < count]
+            if invalid:
+                raise ValueError(f'Shard ids {invalid} are out of range for {count} shards')
+            self.ids = frozenset(ids)
+
+    @property
+    def sharded(self):
+        return bool(self.count)
+
+    def owns(self, guild_id: int) -> bool:
+        return not self.count or shard_for(guild_id, self.count) in self.ids
+
+    def __str__(self):
+        if not self.count:
+            return 'unsharded'
+        return f'shards {",".join(map(str, sorted(self.ids)))} of {self.count}'
+
+local_shards = ShardSet()
+
+def plan(shard_count: int, processes: int):
+    """
+    Splits the shards into contiguous ranges, one per process.
+
+    Args:
+        shard_count (int): The total number of shards.
+        processes (int): The number of worker processes, at most one per shard.
+
+    Returns:
+        list: The shard ids of every process, e.g. [[0, 1], [2, 3]].
+    """
+    processes = max(1, min(processes, shard_count))
+    size, extra = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for index in range(processes):
+        end = start + size + (1 if index < extra else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+def create_bot(shards: ShardSet = local_shards, **options) -> discord.Bot:
+    # the unsharded bot stays the default, sharding only starts once a shard count is configured
+    if shards.sharded:
+        return discord.AutoShardedBot(shard_count=shards.count, shard_ids=sorted(shards.ids), **options)
+    return discord.Bot(**options)
+
+def shard_health(bot: discord.Bot):
+    """
+    Returns {shard id: {'up', 'latency', 'guilds'}} for the shards of this process.
+    """
+    guilds = {}
+    for guild in bot.guilds:
+        guilds[guild.shard_id] = guilds.get(guild.shard_id, 0) + 1
+    shards = getattr(bot, 'shards', None)
+    if shards is None:
+        # unsharded, the one connection is shard 0
+        shards = {bot.shard_id or 0: bot}
+    health = {}
+    for shard_id, shard in shards.items():
+        latency = shard.latency
+        health[shard_id] = {
+            'up': bot.is_ready() and not shard.is_closed(),
+            'latency': latency if math.isfinite(latency) else None, # nan/inf until the first heartbeat
+            'guilds': guilds.get(shard_id, 0),
+        }
+    return health
@@ -0,0 +1,140 @@
+import csv
+import json
+from util.db import Guild, Quote, db, run_query, upsert_many
+from util.quotes import contentHash
+from util.logger import logger
+
+EXPORT_BATCH = 1000 # quotes read per query, memory stays at one batch whatever the guild's size
+IMPORT_BATCH = 500 # quotes written per INSERT
+FORMATS = ('jsonl', 'csv')
+# every column of a quote, in file order
+FIELDS = ('messageid', 'guildid', 'channelid', 'author', 'content', 'submitterid', 'submitterName', 'submitterAvatar', 'sourceHash', 'contentHash')
+INTEGER_FIELDS = ('messageid', 'guildid', 'channelid', 'submitterid')
+
+def _read_batch(guild_id, last):
+    # keyset paging instead of a cursor kept open, no connection or transaction is held between batches
+    columns = [Quote._meta.fields[field] for field in FIELDS]
+    return list(Quote.select(*columns).where(Quote.guildid == guild_id, Quote.messageid > last)
+                .order_by(Quote.messageid).limit(EXPORT_BATCH).tuples())
+
+def iter_quotes(guild_id: int):
+    """
+    Yields the quotes of a guild as dicts of `FIELDS`, oldest first, reading `EXPORT_BATCH` rows at a time.
+    """
+    last = 0
+    while True:
+        with db.connection_context():
+            rows = _read_batch(guild_id, last)
+        for row in rows:
+            yield dict(zip(FIELDS, row))
+        if len(rows) < EXPORT_BATCH:
+            return
+        last = rows[-1][0]
+
+async def stream_quotes(guild_id: int):
+    """
+    The same as `iter_quotes` for the bot, every batch is read on the database executor.
+    """
+    last = 0
+    while True:
+        rows = await run_query(_read_batch, guild_id, last)
+        for row in rows:
+            yield dict(zip(FIELDS, row))
+        if len(rows) < EXPORT_BATCH:
+            return
+        last = rows[-1][0]
+
+class QuoteWriter:
+    """
+    Writes quotes to a text file as JSON lines or CSV with a header row.
+    """
+    def __init__(self, file, format='jsonl'):
+        if format not in FORMATS:
+            raise ValueError(f'Unknown format: {format}')
+        self.file = file
+        self.count = 0
+        self._csv = None
+        if format == 'csv':
+            self._csv = csv.DictWriter(file, FIELDS)
+            self._csv.writeheader()
+
+    def write(self, quote: dict):
+        if self._csv:
+            self._csv.writerow(quote)
+        else:
+            self.file.write(json.dumps(quote, ensure_ascii=False) + '\n')
+        self.count += 1
+
+def read_quotes(file, format='jsonl'):
+    """
+    Yields the quotes of a file written by `QuoteWriter`, one at a time.
+
+    Raises:
+        ValueError: If a line is not a quote.
+    """
+    if format not in FORMATS:
+        raise ValueError(f'Unknown format: {format}')
+    if format == 'csv':
+        rows = csv.DictReader(file)
+    else:
+        rows = (json.loads(line) for line in file if line.strip())
+    for number, row in enumerate(rows, 1):
+        if not row.get('messageid') or not row.get('guildid') or row.get('content') is None:
+            raise ValueError(f'Quote {number} has no messageid, guildid or content')
+        quote = {}
+        for field in FIELDS:
+            value = row.get(field)
+            # csv has no null, empty columns are read as missing
+            if value == '' and field not in ('author', 'content'):
+                value = None
+            if value is not None and field in INTEGER_FIELDS:
+                value = int(value)
+            quote[field] = value
+        yield quote
+
+def import_quotes(quotes, guild_id=None):
+    """
+    Stores quotes with multi-row upserts, `IMPORT_BATCH` per statement and transaction.
+    Quotes that exist already are overwritten, so an import can be repeated.
+
+    Args:
+        quotes (iterable): Quote dicts as yielded by `read_quotes`.
+        guild_id (int, optional): Imports all quotes into this guild instead of the one they were exported from.
+
+    Returns:
+        dict: The number of quotes imported per guild.
+    """
+    counts = {}
+    batch = []
+    columns = [Quote._meta.fields[field] for field in FIELDS]
+    statements = {} # batch size -> upsert SQL, building it took longer than running it
+
+    def flush():
+        guilds = {quote[1] for quote in batch}
+        sql = statements.get(len(batch))
+        if sql is None:
+            sql, _ = upsert_many(Quote, batch, preserve=columns[1:], fields=columns).sql()
+            statements[len(batch)] = sql
+        with db.atomic():
+            Guild.insert_many([{'guildid': guild} for guild in guilds]).on_conflict_ignore().execute()
+            # the values are plain ints and strings, bound in row order
+            db.execute_sql(sql, [value for quote in batch for value in quote])
+        batch.clear()
+
+    with db.connection_context():
+        for quote in quotes:
+            if guild_id is not None:
+                quote['guildid'] = guild_id
+            if quote['author'] is None:
+                quote['author'] = ''
+            if not quote['contentHash']:
+                # exported before the hash existed, or written by hand
+                quote['contentHash'] = contentHash(quote['content'], quote['author'])
+            batch.append(tuple(quote[field] for field in FIELDS))
+            counts[quote['guildid']] = counts.get(quote['guildid'], 0) + 1
+            if len(batch) >= IMPORT_BATCH:
+                flush()
+        if batch:
+            flush()
+    logger.info(f'Imported quotes: {counts}')
+    return counts